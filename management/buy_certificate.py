@@ -8,13 +8,13 @@
 #  2) Pre-pay $16 into your account at https://www.gandi.net/prepaid/operations. Wait until the payment goes through.
 #  3) Activate your API key first on the test platform (wait a while, refresh the page) and then activate the production API at https://www.gandi.net/admin/api_key.
 
-import sys, re,  os.path, urllib.request
+import sys, re,  os.path, base64, urllib.request, urllib.parse, urllib.error
 import xmlrpc.client
-import rtyaml
 
 from utils import load_environment, shell
+from auth import DEFAULT_KEY_PATH
 from web_update import get_web_domains, get_domain_ssl_files, get_web_root
-from whats_next import check_certificate
+from certificates import check_certificate
 
 def buy_ssl_certificate(api_key, domain, command, env):
 	if domain != env['PRIMARY_HOSTNAME'] \
@@ -80,22 +80,12 @@ def buy_ssl_certificate(api_key, domain, command, env):
 		if dcv["dcv_method"] != "dns":
 			raise Exception("Certificate ordered with an unknown validation method.")
 
-		# Update our DNS data.
-
-		dns_config = env['STORAGE_ROOT'] + '/dns/custom.yaml'
-		if os.path.exists(dns_config):
-			dns_records = rtyaml.load(open(dns_config))
-		else:
-			dns_records = { }
+		# Update our DNS data. Have the management daemon add the record to
+		# the user's custom DNS records, which also updates the domain's zone.
 
 		qname = dcv['md5'] + '.' + domain
 		value = dcv['sha1'] + '.comodoca.com.'
-		dns_records[qname] = { "CNAME": value }
-
-		with open(dns_config, 'w') as f:
-			f.write(rtyaml.dump(dns_records))
-
-		shell('check_call', ['tools/dns_update'])
+		put_custom_dns_record(qname, "CNAME", value)
 
 		# Okay, done with this step.
 
@@ -144,6 +134,24 @@ def buy_ssl_certificate(api_key, domain, command, env):
 	else:
 		print("The certificate has an unknown status. Please check https://www.gandi.net/admin/ssl/%d/details for the status of this order." % cert['id'])
 
+def put_custom_dns_record(qname, rtype, value):
+	# Set a custom DNS record through the management daemon's API. The API
+	# key goes in the request's Authorization header (the key is the user
+	# name, and the password is empty) rather than on a command line where
+	# other users could see it.
+	with open(DEFAULT_KEY_PATH) as f:
+		api_key = f.read().strip()
+	req = urllib.request.Request(
+		'http://127.0.0.1:10222/dns/custom/%s/%s' % (urllib.parse.quote(qname, safe=''), rtype),
+		urllib.parse.urlencode({ "value": value }).encode("utf8"),
+		{ "Authorization": "Basic " + base64.b64encode((api_key + ":").encode("utf8")).decode("ascii") },
+		method="PUT")
+	try:
+		urllib.request.urlopen(req).read()
+	except urllib.error.HTTPError as e:
+		print("Updating DNS failed:", e.read().decode("utf8").strip())
+		sys.exit(1)
+
 if __name__ == "__main__":
 	if len(sys.argv) < 4:
 		print("Usage: python management/buy_certificate.py gandi_api_key domain_name {purchase, setup}")
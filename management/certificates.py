@@ -0,0 +1,302 @@
+# Reads SSL certificates and private keys.
+#
+# The names, expiration date and keys of a certificate are read here
+# (certificates are small and the parts we need are easy to find in the
+# DER encoding) rather than by running openssl, since we look at the
+# certificate of every domain on every web update. What we find is saved
+# in /var/lib/mailinabox/certificate-cache.json by the file's path,
+# modification time and size, so a file is only read again when it's
+# replaced. Checking that a certificate chains to a trusted CA still takes
+# `openssl verify`, and its answer is kept for a day.
+########################################################################
+
+import os, os.path, re, base64, hashlib, json, datetime, threading, time
+
+from utils import shell
+
+CERTIFICATE_CACHE_FILE = "/var/lib/mailinabox/certificate-cache.json"
+
+# How long to trust the result of `openssl verify` for a certificate that
+# hasn't changed, in seconds. The CAs installed on the box can change.
+VERIFY_CACHE_TIME = 24 * 60 * 60
+
+_cache = None
+_cache_lock = threading.RLock()
+
+########################################################################
+
+# DER.
+
+OID_COMMON_NAME = bytes.fromhex("550403") # 2.5.4.3
+OID_SUBJECT_ALT_NAME = bytes.fromhex("551d11") # 2.5.29.17
+OID_RSA_ENCRYPTION = bytes.fromhex("2a864886f70d010101") # 1.2.840.113549.1.1.1
+
+def der_read(data, pos=0):
+	# Read the DER element at data[pos]. Returns its tag, its contents, and
+	# the position of the next element.
+	tag = data[pos]
+	length = data[pos + 1]
+	pos += 2
+	if length & 0x80:
+		n = length & 0x7F
+		length = int.from_bytes(data[pos:pos + n], "big")
+		pos += n
+	if pos + length > len(data): raise ValueError("Truncated DER element.")
+	return tag, data[pos:pos + length], pos + length
+
+def der_children(data):
+	# The elements within a SEQUENCE or SET's contents.
+	pos = 0
+	while pos < len(data):
+		tag, content, pos = der_read(data, pos)
+		yield tag, content
+
+def der_time(tag, content):
+	s = content.decode("ascii").rstrip("Z")
+	if tag == 0x17: # UTCTime, two-digit year
+		s = ("19" if int(s[0:2]) >= 50 else "20") + s
+	return s[0:14]
+
+def parse_certificate(der):
+	# Return what we need to know about a DER-encoded X.509 certificate.
+	tag, cert, _ = der_read(der)
+	tbs_tag, tbs, _ = der_read(cert)
+	fields = list(der_children(tbs))
+	if fields[0][0] == 0xA0: fields.pop(0) # explicit version
+	serial, signature_alg, issuer, validity, subject, spki = fields[0:6]
+	extensions = [content for tag, content in fields[6:] if tag == 0xA3]
+
+	info = { }
+
+	# The Subject Common Name and the Subject Alternative Names.
+	info["common_names"] = []
+	for rdn_tag, rdn in der_children(subject[1]):
+		for atv_tag, atv in der_children(rdn):
+			(oid_tag, oid), (value_tag, value) = list(der_children(atv))[0:2]
+			if oid == OID_COMMON_NAME:
+				info["common_names"].append(value.decode("utf8", "replace"))
+	info["alt_names"] = []
+	for ext_seq in extensions:
+		for ext_tag, ext in der_children(der_read(ext_seq)[1]):
+			parts = list(der_children(ext))
+			if parts[0][1] == OID_SUBJECT_ALT_NAME:
+				for name_tag, name in der_children(der_read(parts[-1][1])[1]):
+					if name_tag == 0x82: # dNSName
+						info["alt_names"].append(name.decode("ascii", "replace"))
+
+	# Validity period, as YYYYMMDDHHMMSS in UTC.
+	(nb_tag, not_before), (na_tag, not_after) = list(der_children(validity[1]))
+	info["not_before"] = der_time(nb_tag, not_before)
+	info["not_after"] = der_time(na_tag, not_after)
+
+	# A certificate whose issuer is its subject is self-signed.
+	info["self_signed"] = (issuer[1] == subject[1])
+
+	# The public key. For RSA keys, the modulus, so we can check that it
+	# goes with a private key.
+	info["public_key_sha256"] = hashlib.sha256(rebuild_der(spki)).hexdigest()
+	info["modulus"] = None
+	(alg_tag, alg), (key_tag, key) = list(der_children(spki[1]))
+	if list(der_children(alg))[0][1] == OID_RSA_ENCRYPTION:
+		info["modulus"] = "%x" % int.from_bytes(list(der_children(der_read(key[1:])[1]))[0][1], "big")
+
+	# Hashes of the whole certificate, for TLSA records and for showing to
+	# the user to compare (like `openssl x509 -fingerprint`).
+	info["sha256"] = hashlib.sha256(der).hexdigest()
+	info["sha1_fingerprint"] = ":".join("%02X" % b for b in hashlib.sha1(der).digest())
+
+	return info
+
+def rebuild_der(element):
+	# Re-encode a (tag, content) pair that der_children returned.
+	tag, content = element
+	n = len(content)
+	if n < 0x80:
+		length = bytes([n])
+	else:
+		length = n.to_bytes((n.bit_length() + 7) // 8, "big")
+		length = bytes([0x80 | len(length)]) + length
+	return bytes([tag]) + length + content
+
+def pem_blocks(text, label):
+	# The base64-decoded blocks in a PEM file with the given label, e.g. CERTIFICATE.
+	return [base64.b64decode(m)
+		for m in re.findall(r"-----BEGIN %s-----(.*?)-----END %s-----" % (label, label), text, re.S)]
+
+def read_certificate_file(fn):
+	# A certificate file is PEM (with any intermediate certificates after
+	# the server's certificate) or a single DER certificate.
+	with open(fn, "rb") as f:
+		data = f.read()
+	if data[0:1] == b"\x30":
+		chain = [data]
+	else:
+		chain = pem_blocks(data.decode("ascii", "replace"), "CERTIFICATE")
+		if len(chain) == 0: raise ValueError("The certificate file is an invalid PEM certificate.")
+	info = parse_certificate(chain[0])
+	info["chain_length"] = len(chain)
+	return info
+
+def read_private_key_modulus(fn):
+	# The modulus of an unencrypted RSA private key in PKCS#1 or PKCS#8 PEM,
+	# or None if it isn't one of those.
+	with open(fn) as f:
+		text = f.read()
+	for der in pem_blocks(text, "RSA PRIVATE KEY"):
+		return "%x" % int.from_bytes(list(der_children(der_read(der)[1]))[1][1], "big")
+	for der in pem_blocks(text, "PRIVATE KEY"):
+		version, alg, key = list(der_children(der_read(der)[1]))[0:3]
+		if list(der_children(alg[1]))[0][1] != OID_RSA_ENCRYPTION: return None
+		return "%x" % int.from_bytes(list(der_children(der_read(key[1])[1]))[1][1], "big")
+	return None
+
+########################################################################
+
+# The cache.
+
+def load_cache():
+	global _cache
+	if _cache is None:
+		try:
+			with open(CERTIFICATE_CACHE_FILE) as f:
+				_cache = json.load(f)
+		except (OSError, ValueError):
+			_cache = { }
+	return _cache
+
+def save_cache():
+	try:
+		os.makedirs(os.path.dirname(CERTIFICATE_CACHE_FILE), exist_ok=True)
+		with open(CERTIFICATE_CACHE_FILE + ".tmp", "w") as f:
+			json.dump(_cache, f, indent=1, sort_keys=True)
+		os.rename(CERTIFICATE_CACHE_FILE + ".tmp", CERTIFICATE_CACHE_FILE)
+	except OSError:
+		pass # it's only a cache
+
+def cached(fn, key, compute):
+	# Return compute(fn), or what it returned last time if the file hasn't
+	# changed since. Also returns the file's cache entry.
+	st = os.stat(fn)
+	with _cache_lock:
+		cache = load_cache()
+		entry = cache.get(fn)
+		if entry is None or entry["mtime_ns"] != st.st_mtime_ns or entry["size"] != st.st_size:
+			entry = { "mtime_ns": st.st_mtime_ns, "size": st.st_size }
+			cache[fn] = entry
+		if key not in entry:
+			entry[key] = compute(fn)
+			save_cache()
+		return entry[key], entry
+
+def get_certificate_info(fn):
+	# Return a dict with what's in the certificate file:
+	#   common_names, alt_names: the names in the certificate
+	#   not_before, not_after: when it's valid, as YYYYMMDDHHMMSS in UTC
+	#   self_signed: whether its issuer is its subject
+	#   modulus: the RSA modulus of its public key, in hex
+	#   public_key_sha256: the hash of its SubjectPublicKeyInfo
+	#   sha256, sha1_fingerprint: hashes of the whole certificate
+	#   chain_length: the number of certificates in the file
+	return cached(fn, "certificate", read_certificate_file)[0]
+
+def get_private_key_modulus(fn):
+	return cached(fn, "private_key_modulus", read_private_key_modulus)[0]
+
+def get_certificate_names(fn):
+	info = get_certificate_info(fn)
+	return set(info["common_names"]) | set(info["alt_names"])
+
+########################################################################
+
+def check_certificate(domain, ssl_certificate, ssl_private_key):
+	# Check the status of a certificate. Returns "OK", "SELF-SIGNED" or
+	# a description of what's wrong.
+
+	try:
+		info = get_certificate_info(ssl_certificate)
+	except (ValueError, IndexError):
+		return "The certificate file is an invalid PEM certificate."
+
+	# First check that the certificate is for the right domain. The domain
+	# must be found in the Subject Common Name (CN) or be one of the
+	# Subject Alternative Names.
+	certificate_names = set(info["common_names"]) | set(info["alt_names"])
+	if domain is not None and domain not in certificate_names:
+		return "This certificate is for the wrong domain names. It is for %s." % \
+			", ".join(sorted(certificate_names))
+
+	# Second, check that the certificate matches the private key.
+	if ssl_private_key is not None:
+		private_key_modulus = get_private_key_modulus(ssl_private_key)
+		if private_key_modulus is not None:
+			key_matches = (private_key_modulus == info["modulus"])
+		else:
+			# Not an RSA key we can read. Have openssl give us its public key
+			# to compare with the certificate's.
+			public_key = shell('check_output', [
+				"openssl", "pkey",
+				"-pubout", "-outform", "DER",
+				"-in", ssl_private_key], return_bytes=True)
+			key_matches = (hashlib.sha256(public_key).hexdigest() == info["public_key_sha256"])
+		if not key_matches:
+			return "The certificate installed at %s does not correspond to the private key at %s." % (ssl_certificate, ssl_private_key)
+
+	if info["self_signed"]:
+		# Certificate is self-signed.
+		return "SELF-SIGNED"
+
+	now = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+	if now > info["not_after"]:
+		return "The certificate expired on %s." % format_time(info["not_after"])
+	if now < info["not_before"]:
+		return "The certificate is not valid until %s." % format_time(info["not_before"])
+
+	# Next validate that the certificate is valid. This checks that the chain
+	# of trust makes sense and that it is signed by a CA that Ubuntu has
+	# installed on this machine's list of CAs.
+	return verify_certificate(ssl_certificate)
+
+def verify_certificate(ssl_certificate):
+	# Run openssl verify on the certificate, or use its answer from the
+	# last day if the certificate hasn't changed since.
+	with _cache_lock:
+		result, entry = cached(ssl_certificate, "verify", lambda fn : None)
+		if result is not None and time.time() - result[1] < VERIFY_CACHE_TIME:
+			return result[0]
+
+	# In order to verify with openssl, we need to split out any
+	# intermediary certificates in the chain (if any) from our
+	# certificate (at the top). They need to be passed separately.
+	cert = open(ssl_certificate).read()
+	m = re.match(r'(-*BEGIN CERTIFICATE-*.*?-*END CERTIFICATE-*)(.*)', cert, re.S)
+	if m == None:
+		return "The certificate file is an invalid PEM certificate."
+	mycert, chaincerts = m.groups()
+
+	# This command returns a non-zero exit status in most cases, so trap errors.
+	retcode, verifyoutput = shell('check_output', [
+		"openssl",
+		"verify", "-verbose",
+		"-purpose", "sslserver", "-policy_check",]
+		+ ([] if chaincerts.strip() == "" else ["-untrusted", "/dev/stdin"])
+		+ [ssl_certificate],
+		input=chaincerts.encode('ascii'),
+		capture_stderr=True,
+		trap=True)
+
+	if "self signed" in verifyoutput:
+		# Certificate is self-signed.
+		status = "SELF-SIGNED"
+	elif retcode == 0:
+		# Certificate is OK.
+		status = "OK"
+	else:
+		status = verifyoutput.strip()
+
+	with _cache_lock:
+		entry["verify"] = [status, time.time()]
+		save_cache()
+	return status
+
+def format_time(t):
+	return datetime.datetime.strptime(t, "%Y%m%d%H%M%S").strftime("%Y-%m-%d %H:%M:%S UTC")
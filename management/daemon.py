@@ -1,17 +1,26 @@
 #!/usr/bin/python3
 
-import os, os.path, re
+import os, os.path, re, io, csv, json, contextlib
 
-from flask import Flask, request, render_template, abort
+from flask import Flask, request, render_template, abort, Response
 app = Flask(__name__)
 
 import auth, utils
-from mailconfig import get_mail_users, add_mail_user, set_mail_password, remove_mail_user, get_mail_aliases, get_mail_domains, add_mail_alias, remove_mail_alias
+from reconcile import Reconciler
+from mailconfig import add_mail_user, read_bulk_users, add_mail_users_bulk, set_mail_password, remove_mail_user, add_mail_alias, remove_mail_alias
+from mailconfig import get_change_counter, list_mail_users, list_mail_aliases, list_mail_domains
+from database import snapshot
+from mail_usage import get_mail_usage, set_quota
 
 env = utils.load_environment()
 
 auth_service = auth.KeyAuthService()
 
+# Changes to mail users and aliases are followed by a kick() in the
+# background. RECONCILE_DEBOUNCE in /etc/mailinabox.conf sets how many
+# seconds to wait for further changes before running it.
+reconciler = Reconciler(env, debounce=float(env.get("RECONCILE_DEBOUNCE", "2")))
+
 @app.before_request
 def require_auth_key():
 	if not auth_service.is_authenticated(request):
@@ -27,13 +36,109 @@ def index():
 
 # MAIL
 
+def queue_reconcile(result):
+	# A mail user or alias has been changed (and committed). Unless the change
+	# failed, queue up an update to the system aliases, DNS and web configuration
+	# and return right away. The X-Reconcile-Generation header says which
+	# generation to wait for (see /system/reconcile/status) for the change
+	# to be live.
+	if isinstance(result, tuple):
+		return result
+	generation = reconciler.request()
+	return Response(result + "\n", mimetype="text/plain", headers={ "X-Reconcile-Generation": str(generation) })
+
+def list_response(list_function, key, format_text, format_json, filters=("domain", "prefix")):
+	# Respond to a request to list users, aliases or domains.
+	#
+	# ?after=...&limit=N returns a page of the list starting after the given
+	# item, and ?domain=... and ?prefix=... filter the list. The response is
+	# one item per line, or with ?format=json an object with the items and,
+	# if there may be more, the `after` value for the next page. Either way
+	# it's streamed as it's read from the database.
+	#
+	# The ETag changes whenever the users or aliases change, so clients that
+	# poll these lists can send If-None-Match and get back a 304. It's read
+	# in the same read transaction as the items, so it's the version of the
+	# list that's sent. The transaction lasts until the response is finished
+	# or the client goes away.
+	kwargs = { }
+	for arg in ("after",) + filters:
+		if request.args.get(arg):
+			kwargs[arg] = request.args[arg]
+	limit = None
+	if request.args.get("limit"):
+		try:
+			limit = int(request.args["limit"])
+			if limit < 1: raise ValueError()
+		except ValueError:
+			return ("Invalid limit.\n", 400)
+
+	transaction = contextlib.ExitStack()
+	try:
+		transaction.enter_context(snapshot(env))
+		etag = "mail-%d" % get_change_counter(env)
+		if request.if_none_match.contains(etag):
+			transaction.close()
+			return Response(status=304, headers={ "ETag": '"%s"' % etag })
+		items = list_function(env, limit=limit, **kwargs)
+	except:
+		transaction.close()
+		raise
+
+	if request.args.get("format") == "json":
+		def format_items():
+			yield '{"items": ['
+			count = 0
+			last = None
+			for item in items:
+				if count > 0: yield ", "
+				yield json.dumps(format_json(item))
+				count += 1
+				last = item
+			yield '], "after": '
+			yield json.dumps(key(last) if limit is not None and count == limit else None)
+			yield '}\n'
+		mimetype = "application/json"
+	else:
+		def format_items():
+			for item in items:
+				yield format_text(item) + "\n"
+		mimetype = "text/plain"
+
+	def stream():
+		# Close the cursor and end the transaction when we're done or
+		# if the client disconnects part way through.
+		try:
+			yield from format_items()
+		finally:
+			items.close()
+			transaction.close()
+
+	response = Response(stream(), mimetype=mimetype, headers={ "ETag": '"%s"' % etag })
+	response.call_on_close(transaction.close) # in case stream() is never started
+	return response
+
 @app.route('/mail/users')
 def mail_users():
-    return "".join(x+"\n" for x in get_mail_users(env))
+	return list_response(list_mail_users,
+		lambda email : email,
+		lambda email : email,
+		lambda email : email)
 
 @app.route('/mail/users/add', methods=['POST'])
 def mail_users_add():
-	return add_mail_user(request.form.get('email', ''), request.form.get('password', ''), env)
+	return queue_reconcile(add_mail_user(request.form.get('email', ''), request.form.get('password', ''), env, do_kick=False))
+
+@app.route('/mail/users/bulk', methods=['POST'])
+def mail_users_bulk():
+	# The request body is the batch itself, either CSV (the default) or
+	# JSON if sent with a JSON content type. Read it as a stream.
+	format = "json" if request.mimetype == "application/json" else "csv"
+	batch = io.TextIOWrapper(request.stream, encoding="utf8", newline="")
+	try:
+		return queue_reconcile(add_mail_users_bulk(read_bulk_users(batch, format), env, do_kick=False))
+	except (ValueError, UnicodeDecodeError, csv.Error) as e:
+		return ("Invalid batch: %s\n" % e, 400)
 
 @app.route('/mail/users/password', methods=['POST'])
 def mail_users_password():
@@ -41,23 +146,71 @@ def mail_users_password():
 
 @app.route('/mail/users/remove', methods=['POST'])
 def mail_users_remove():
-	return remove_mail_user(request.form.get('email', ''), env)
+	return queue_reconcile(remove_mail_user(request.form.get('email', ''), env, do_kick=False))
+
+@app.route('/mail/users/usage')
+def mail_users_usage():
+	# How much space each user's mailbox takes up, as of the last scan (see
+	# mail_usage.py), largest first or with ?sort=email by address. One user
+	# per line as email, bytes, messages and quota (if any), separated by
+	# tabs, or a list of objects with ?format=json.
+	sort = request.args.get("sort", "size")
+	if sort not in ("size", "email"):
+		return ("Invalid sort.\n", 400)
+	limit = None
+	if request.args.get("limit"):
+		try:
+			limit = int(request.args["limit"])
+			if limit < 1: raise ValueError()
+		except ValueError:
+			return ("Invalid limit.\n", 400)
+	usage = get_mail_usage(env, sort=sort, limit=limit)
+
+	if request.args.get("format") == "json":
+		return Response(json.dumps([
+			{ "email": email, "bytes": bytes, "messages": messages, "quota": quota, "scanned": scanned }
+			for email, bytes, messages, quota, scanned in usage ], indent=2) + "\n",
+			mimetype="application/json")
+	return Response("".join(
+		"%s\t%d\t%d\t%s\n" % (email, bytes, messages, quota if quota is not None else "")
+		for email, bytes, messages, quota, scanned in usage ), mimetype="text/plain")
+
+@app.route('/mail/users/quota', methods=['POST'])
+def mail_users_quota():
+	# Set a user's quota in bytes, or remove it if quota is empty.
+	quota = request.form.get('quota', '').strip()
+	if quota == "":
+		quota = None
+	else:
+		try:
+			quota = int(quota)
+			if quota < 0: raise ValueError()
+		except ValueError:
+			return ("Invalid quota.\n", 400)
+	return set_quota(request.form.get('email', ''), quota, env)
 
 @app.route('/mail/aliases')
 def mail_aliases():
-    return "".join(x+"\t"+y+"\n" for x, y in get_mail_aliases(env))
+	return list_response(list_mail_aliases,
+		lambda alias : alias[0],
+		lambda alias : alias[0] + "\t" + alias[1],
+		lambda alias : { "source": alias[0], "destination": alias[1] })
 
 @app.route('/mail/aliases/add', methods=['POST'])
 def mail_aliases_add():
-	return add_mail_alias(request.form.get('source', ''), request.form.get('destination', ''), env)
+	return queue_reconcile(add_mail_alias(request.form.get('source', ''), request.form.get('destination', ''), env, do_kick=False))
 
 @app.route('/mail/aliases/remove', methods=['POST'])
 def mail_aliases_remove():
-	return remove_mail_alias(request.form.get('source', ''), env)
+	return queue_reconcile(remove_mail_alias(request.form.get('source', ''), env, do_kick=False))
 
 @app.route('/mail/domains')
 def mail_domains():
-    return "".join(x+"\n" for x in get_mail_domains(env))
+	return list_response(list_mail_domains,
+		lambda domain : domain,
+		lambda domain : domain,
+		lambda domain : domain,
+		filters=("prefix",))
 
 # DNS
 
@@ -65,7 +218,45 @@ def mail_domains():
 def dns_update():
 	from dns_update import do_dns_update
 	try:
-		return do_dns_update(env)
+		with reconciler.exclusive:
+			return do_dns_update(env)
+	except Exception as e:
+		return (str(e), 500)
+
+@app.route('/dns/custom')
+@app.route('/dns/custom/<qname>', methods=['GET', 'PUT', 'DELETE'])
+@app.route('/dns/custom/<qname>/<rtype>', methods=['GET', 'PUT', 'DELETE'])
+def dns_custom(qname=None, rtype=None):
+	# List, set or remove the user's custom DNS records. A PUT sets the
+	# record to the `value` form field (or the request body), replacing
+	# any other value of that type. The type defaults to A for a PUT and
+	# to all types for a GET or DELETE. A change rebuilds only the zone
+	# the name is in.
+	from dns_update import get_custom_dns_records, set_custom_dns_record, remove_custom_dns_record, do_dns_update
+	if rtype is not None:
+		rtype = rtype.upper()
+
+	if request.method == 'GET':
+		records = get_custom_dns_records(env, qname.lower() if qname else None, rtype)
+		if request.args.get("format") == "json":
+			return Response(json.dumps([{ "qname": r[0], "rtype": r[1], "value": r[2] } for r in records], indent=2) + "\n",
+				mimetype="application/json")
+		return Response("".join("%s\t%s\t%s\n" % r for r in records), mimetype="text/plain")
+
+	try:
+		with reconciler.exclusive:
+			if request.method == 'PUT':
+				body = request.get_data(parse_form_data=True, as_text=True)
+				zone = set_custom_dns_record(qname, rtype or "A", request.form.get("value", body).strip(), env)
+			else:
+				zone = remove_custom_dns_record(qname, rtype, env)
+			if isinstance(zone, tuple):
+				return zone # error
+			if zone is False:
+				return "No change.\n"
+			if zone is None:
+				return "OK\n" # the record wasn't in any of our zones
+			return do_dns_update(env, zones=[zone]) or "OK\n"
 	except Exception as e:
 		return (str(e), 500)
 
@@ -82,10 +273,29 @@ def dns_get_ds_records():
 @app.route('/web/update', methods=['POST'])
 def web_update():
 	from web_update import do_web_update
-	return do_web_update(env)
+	with reconciler.exclusive:
+		return do_web_update(env)
 
 # System
 
+@app.route('/system/reconcile/status')
+def reconcile_status():
+	# Returns the pending, running, last completed and failed generation of the
+	# background updates that follow changes to mail users and aliases, and
+	# how far along the running one is if it's in a long step (like making
+	# certificates for many new domains).
+	# With ?wait=N, first waits until generation N is complete or has
+	# failed (then "failed" is N or later, and "completed" is less than N)
+	# or, if sooner, ?timeout= seconds (default 60) have passed.
+	if request.args.get("wait"):
+		try:
+			generation = int(request.args["wait"])
+			timeout = float(request.args.get("timeout", "60"))
+		except ValueError:
+			return ("Invalid wait or timeout.\n", 400)
+		reconciler.wait(generation, timeout)
+	return Response(json.dumps(reconciler.status(), indent=2) + "\n", mimetype="application/json")
+
 @app.route('/system/updates')
 def show_updates():
 	utils.shell("check_call", ["/usr/bin/apt-get", "-qq", "update"])
@@ -120,5 +330,8 @@ if __name__ == '__main__':
 	# debug console and enter that as the username
 	app.logger.info('API key: ' + auth_service.key)
 
-	app.run(port=10222)
+	# Start applying changes in the background. Requests are handled in
+	# threads so that a client waiting on the status doesn't hold up others.
+	reconciler.start()
+	app.run(port=10222, threaded=True)
 
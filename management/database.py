@@ -0,0 +1,138 @@
+# Manages connections to the mail user database, STORAGE_ROOT/mail/users.sqlite.
+#
+# Postfix and Dovecot query this database on every message and every login,
+# so we run it in SQLite's write-ahead log (WAL) mode, in which readers are
+# never blocked by a writer and a writer is never blocked by readers. Open
+# connections are kept in a small pool that all threads share rather than
+# opening a new one for every query. A connection is taken from the pool for
+# the length of a transaction or query and put back afterwards, so threads
+# that come and go (one per request to the management daemon) don't each
+# hold one open. Writes from this process are serialized through a single
+# lock so that concurrent requests to the management daemon queue up here
+# rather than failing with "database is locked".
+########################################################################
+
+import os, sqlite3, threading, contextlib
+
+# How long to wait, in seconds, for another process's write lock (e.g. the
+# Roundcube password plugin) before giving up.
+BUSY_TIMEOUT = 15
+
+# How many idle connections to keep open. More connections than this can be
+# in use at once, but the extra ones are closed when they're put back.
+POOL_SIZE = 4
+
+_idle_connections = { } # database path => connections not in use
+_idle_connections_lock = threading.Lock()
+_held_connections = threading.local() # the connections in use by this thread
+_write_locks = { }
+_write_locks_lock = threading.Lock()
+
+def get_database_path(env):
+	return os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite")
+
+def open_connection(path):
+	# isolation_level=None turns off the sqlite3 module's implicit
+	# transactions. We begin and end transactions explicitly below.
+	# Connections move between threads through the pool (but are only
+	# used by one thread at a time), hence check_same_thread=False.
+	conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+	conn.execute("PRAGMA busy_timeout=%d" % (BUSY_TIMEOUT * 1000))
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL") # safe in WAL mode, and fewer fsyncs
+	return conn
+
+@contextlib.contextmanager
+def connection(env):
+	# A context manager that takes a connection to the database from the
+	# pool (or opens one) for the length of the block and puts it back
+	# afterwards. Blocks within the block in the same thread get the same
+	# connection, and so are a part of its transaction, if it has one.
+	path = get_database_path(env)
+	if not hasattr(_held_connections, "by_path"):
+		_held_connections.by_path = { }
+	held = _held_connections.by_path
+	if path in held:
+		yield held[path]
+		return
+
+	with _idle_connections_lock:
+		idle = _idle_connections.get(path)
+		conn = idle.pop() if idle else None
+	if conn is None:
+		conn = open_connection(path)
+
+	held[path] = conn
+	try:
+		yield conn
+	finally:
+		del held[path]
+		if conn.in_transaction:
+			conn.execute("ROLLBACK") # a transaction that wasn't ended, which shouldn't happen
+		with _idle_connections_lock:
+			idle = _idle_connections.setdefault(path, [])
+			if len(idle) < POOL_SIZE:
+				idle.append(conn)
+				conn = None
+		if conn is not None:
+			conn.close()
+
+def get_write_lock(env):
+	path = get_database_path(env)
+	with _write_locks_lock:
+		if path not in _write_locks:
+			_write_locks[path] = threading.RLock()
+		return _write_locks[path]
+
+@contextlib.contextmanager
+def transaction(env):
+	# A context manager for a write transaction. Yields a cursor. The
+	# transaction is committed if the block completes and rolled back if
+	# it raises an exception.
+	#
+	#   with transaction(env) as c:
+	#      c.execute("INSERT ...")
+	#
+	# BEGIN IMMEDIATE takes SQLite's write lock at the start so that we
+	# find out right away (after the busy timeout) if we can't write,
+	# rather than part way through. If this thread is already in a
+	# transaction, the block just becomes a part of it.
+	with get_write_lock(env), connection(env) as conn:
+		if conn.in_transaction:
+			yield conn.cursor()
+			return
+
+		c = conn.cursor()
+		c.execute("BEGIN IMMEDIATE")
+		try:
+			yield c
+		except:
+			conn.execute("ROLLBACK")
+			raise
+		else:
+			conn.execute("COMMIT")
+		finally:
+			c.close()
+
+@contextlib.contextmanager
+def snapshot(env):
+	# A context manager for a read transaction, so that several queries
+	# see the same state of the database even if another process writes
+	# in between them. Yields a cursor.
+	with connection(env) as conn:
+		if conn.in_transaction:
+			yield conn.cursor()
+			return
+
+		c = conn.cursor()
+		c.execute("BEGIN")
+		try:
+			yield c
+		finally:
+			c.close()
+			conn.execute("COMMIT")
+
+def query(env, sql, parameters=()):
+	# Run a single read-only query and return all of the rows.
+	with connection(env) as conn:
+		return conn.execute(sql, parameters).fetchall()
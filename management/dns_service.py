@@ -0,0 +1,82 @@
+# Controls the running nsd DNS server.
+#
+# nsd.conf holds only the server's own settings and a "pattern" that says
+# where a zone's signed zone file is. The zones themselves are added to and
+# removed from the running server with nsd-control (nsd remembers them in
+# its zone list file across restarts), and a changed zone is reloaded on
+# its own. So changing a zone doesn't interrupt queries for any other
+# zone, which a restart of nsd would.
+########################################################################
+
+import re, subprocess
+
+from utils import shell
+
+NSD_CONTROL = "/usr/sbin/nsd-control"
+NSD_CONF = "/etc/nsd/nsd.conf"
+NSD_RESTART = ["/usr/sbin/service", "nsd", "restart"]
+
+# The name of the pattern in nsd.conf that our zones use, and the zone file
+# it gives a zone, with the zone's name put in for %s as it is.
+ZONE_PATTERN = "mailinabox"
+ZONE_FILE_PATTERN = "%s.txt.signed"
+
+def nsd_control(*args):
+	return shell("check_output", [NSD_CONTROL, "-c", NSD_CONF] + list(args), capture_stderr=True)
+
+def is_nsd_unreachable(e):
+	# Whether nsd-control failed because it couldn't connect to nsd, as in
+	# "error: connect: Connection refused for 127.0.0.1", rather than
+	# because nsd refused the command.
+	output = e.output.decode("utf8", "replace") if isinstance(e.output, bytes) else (e.output or "")
+	return re.search(r"\bconnect: ", output) is not None
+
+def restart_nsd():
+	shell("check_call", NSD_RESTART)
+
+def get_nsd_zones():
+	# Return the set of zones the running nsd is serving.
+	zones = set()
+	for line in nsd_control("zonestatus").split("\n"):
+		m = re.match(r"zone:\s+(\S+)", line)
+		if m:
+			zones.add(m.group(1).rstrip("."))
+	return zones
+
+def update_nsd_zones(zones, changed_zones, restart=False):
+	# Make the running nsd serve exactly `zones`, and pick up the new zone
+	# files of `changed_zones`. With restart=True, which is needed when
+	# nsd.conf has changed, nsd is restarted first. Returns a list of what
+	# was done.
+	actions = []
+	if restart:
+		restart_nsd()
+		actions.append("restarted nsd")
+
+	try:
+		actions.extend(sync_nsd_zones(zones, changed_zones, reload=not restart))
+	except subprocess.CalledProcessError as e:
+		if restart or not is_nsd_unreachable(e): raise
+		# nsd-control couldn't reach nsd, probably because it isn't running.
+		# Start it and try again. Zones it already has are read when it
+		# starts, so there's nothing to reload.
+		restart_nsd()
+		actions.append("restarted nsd")
+		actions.extend(sync_nsd_zones(zones, changed_zones, reload=False))
+	return actions
+
+def sync_nsd_zones(zones, changed_zones, reload=True):
+	actions = []
+	current_zones = get_nsd_zones()
+	for zone in sorted(current_zones - set(zones)):
+		nsd_control("delzone", zone)
+		actions.append("removed " + zone)
+	for zone in sorted(set(zones) - current_zones):
+		nsd_control("addzone", zone, ZONE_PATTERN)
+		actions.append("added " + zone)
+	if reload:
+		for zone in changed_zones:
+			if zone in current_zones and zone in zones:
+				nsd_control("reload", zone)
+				actions.append("reloaded " + zone)
+	return actions
@@ -1,12 +1,17 @@
 # Creates DNS zone files for all of the domains of all of the mail users
-# and mail aliases and restarts nsd.
+# and mail aliases and has nsd serve them.
 ########################################################################
 
-import os, os.path, urllib.parse, datetime, re, hashlib
+import os, os.path, urllib.parse, datetime, re, hashlib, json, tempfile, fcntl, contextlib, ipaddress, concurrent.futures
 import rtyaml
 
 from mailconfig import get_mail_domains
-from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains
+from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains, DomainTrie, process_pool, submit_to_pool
+from dns_service import update_nsd_zones, ZONE_PATTERN, ZONE_FILE_PATTERN, NSD_CONF
+from service_reload import ServiceReloads
+from certificates import get_certificate_info
+from dnssec_schedule import SigningState, ResignScheduler
+import dnssec
 
 def get_dns_domains(env):
 	# Add all domain names in use by email users and mail aliases and ensure
@@ -21,101 +26,272 @@ def get_dns_zones(env):
 	# a domain & a subdomain of that domain.
 	domains = get_dns_domains(env)
 	
-	# Exclude domains that are subdomains of other domains we know. Proceed
-	# by looking at shorter domains first.
-	zone_domains = set()
-	for domain in sorted(domains, key=lambda d : len(d)):
-		for d in zone_domains:
-			if domain.endswith("." + d):
-				# We found a parent domain already in the list.
-				break
-		else:
-			# 'break' did not occur: there is no parent domain.
-			zone_domains.add(domain)
+	# Exclude domains that are subdomains of other domains we know.
+	zone_domains = DomainTrie(domains).tops()
 
-	# Make a nice and safe filename for each domain.
+	# Make a nice and safe filename for each domain. Sort the list so that
+	# the order is nice and stable.
 	zonefiles = []
-	for domain in zone_domains:
+	for domain in sort_domains(zone_domains, env):
 		zonefiles.append([domain, safe_domain_name(domain) + ".txt"])
 
-	# Sort the list so that the order is nice and so that nsd.conf has a
-	# stable order so we don't rewrite the file & restart the service
-	# meaninglessly.
-	zone_order = sort_domains([ zone[0] for zone in zonefiles ], env)
-	zonefiles.sort(key = lambda zone : zone_order.index(zone[0]) )
-
 	return zonefiles
 	
 
-def do_dns_update(env):
+# Where nsd's zone files and OpenDKIM's tables go.
+ZONES_DIR = "/etc/nsd/zones"
+OPENDKIM_DIR = "/etc/opendkim"
+
+# Where we keep, for each zone, a digest of everything the zone was built
+# from, so that zones that haven't changed can be skipped without building
+# or even reading them. When their DNSSEC signatures expire is kept by
+# dnssec_schedule.py.
+ZONE_STATE_FILE = "/var/lib/mailinabox/dns-zones.json"
+
+# How many zones to sign at once: in worker processes with dnssec.py, and
+# in threads that each wait on an ldns-signzone process. With no worker
+# processes, zones are signed one at a time in this process.
+SIGNING_PROCESSES = os.cpu_count() or 1
+SIGNING_THREADS = os.cpu_count() or 1
+
+# Bump this when build_zone or write_nsd_zone change what they output so
+# that every zone is rebuilt once.
+ZONE_FORMAT = 2
+
+def load_zone_state():
+	try:
+		with open(ZONE_STATE_FILE) as f:
+			return json.load(f)
+	except (FileNotFoundError, ValueError):
+		return { }
+
+def save_zone_state(state):
+	os.makedirs(os.path.dirname(ZONE_STATE_FILE), exist_ok=True)
+	with open(ZONE_STATE_FILE + ".tmp", "w") as f:
+		json.dump(state, f, indent=1, sort_keys=True)
+	os.rename(ZONE_STATE_FILE + ".tmp", ZONE_STATE_FILE)
+
+def read_file_or_none(fn):
+	if not os.path.exists(fn): return None
+	with open(fn, "rb") as f:
+		return f.read()
+
+def get_zone_inputs_common(env):
+	# The inputs that can affect any zone. These are read once per update
+	# rather than once per zone. The TLSA record is a hash of the SSL
+	# certificate, so here we use the certificate itself and only run
+	# openssl when the PRIMARY_HOSTNAME zone is actually rebuilt.
+	h = hashlib.sha256()
+	h.update(repr(ZONE_FORMAT).encode("utf8"))
+	for key in ("PRIMARY_HOSTNAME", "PUBLIC_IP", "PUBLIC_IPV6"):
+		h.update(("%s=%s\n" % (key, env.get(key, ""))).encode("utf8"))
+	for fn in ('mail/dkim/mail.txt', 'dns/dnssec/keys.conf'):
+		h.update(fn.encode("utf8") + b"=" + hashlib.sha256(read_file_or_none(os.path.join(env['STORAGE_ROOT'], fn)) or b"").digest())
+	return h.hexdigest()
+
+def get_zone_digest(domain, subdomains, custom_records, common_digest, tlsa_input):
+	# A digest of everything build_zone uses to build this zone.
+	h = hashlib.sha256()
+	h.update(json.dumps([
+		common_digest,
+		domain,
+		sorted(subdomains),
+		custom_records,
+		tlsa_input,
+		], sort_keys=True).encode("utf8"))
+	return h.hexdigest()
+
+def do_dns_update(env, force=False, reloads=None, zones=None):
+	# Services whose files change are reloaded by `reloads` (see
+	# service_reload.py) when its owner runs it, or here if none is given.
+	# If `zones` is given, only those zones are rebuilt, as when a custom
+	# record changes, and the others are left as they are.
+	run_reloads = reloads is None
+	if run_reloads:
+		reloads = ServiceReloads()
+
 	# What domains (and their zone filenames) should we build?
 	domains = get_dns_domains(env)
 	zonefiles = get_dns_zones(env)
 
 	# Custom records to add to zones.
-	try:
-		additional_records = rtyaml.load(open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')))
-	except:
-		additional_records = { }
+	additional_records = read_custom_dns_config(env)
 
-	# Write zone files.
-	os.makedirs('/etc/nsd/zones', exist_ok=True)
-	updated_domains = []
-	for i, (domain, zonefile) in enumerate(zonefiles):
-		# Build the records to put in the zone.
-		subdomains = [d for d in domains if d.endswith("." + domain)]
-		records = build_zone(domain, subdomains, additional_records, env)
-
-		# See if the zone has changed, and if so update the serial number
-		# and write the zone file.
-		if not write_nsd_zone(domain, "/etc/nsd/zones/" + zonefile, records, env):
-			# Zone was not updated. There were no changes.
-			continue
+	zone_order = { zone[0]: i for i, zone in enumerate(zonefiles) }
 
-		# If this is a .justtesting.email domain, then post the update.
-		try:
-			justtestingdotemail(domain, records)
-		except:
-			# Hmm. Might be a network issue. If we stop now, will we end
-			# up in an inconsistent state? Let's just continue.
-			pass
+	# Which domains and custom records go in which zone.
+	domain_trie = DomainTrie(domains)
+	zone_trie = DomainTrie(zone[0] for zone in zonefiles)
+	zone_custom_records = { }
+	for qname, value in additional_records.items():
+		zone = zone_trie.find_parent(qname)
+		if zone is not None:
+			zone_custom_records.setdefault(zone, { })[qname] = value
+
+	# What all of the zones are built from.
+	zone_state = load_zone_state()
+	common_digest = get_zone_inputs_common(env)
+	ssl_certificate = read_file_or_none(os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem"))
+	tlsa_input = hashlib.sha256(ssl_certificate or b"").hexdigest()
 
-		# Mark that we just updated this domain.
-		updated_domains.append(domain)
+	# When each zone's signatures expire, and which zones are due to be
+	# re-signed.
+	signing_state = SigningState()
+	due_zones = set(ResignScheduler(signing_state).pop_due())
 
-		# Sign the zone.
+	# Write zone files.
+	os.makedirs(ZONES_DIR, exist_ok=True)
+	updated_domains = []
+	zones_to_sign = []
+	signing_errors = []
+	new_zone_state = { }
+	try:
+		for i, (domain, zonefile) in enumerate(zonefiles):
+			if zones is not None and domain not in zones:
+				continue
+
+			subdomains = sorted(domain_trie.subtree(domain))
+			zone_digest = get_zone_digest(domain, subdomains, zone_custom_records.get(domain, { }),
+				common_digest, tlsa_input if domain == env["PRIMARY_HOSTNAME"] else None)
+
+			# If nothing that goes into the zone has changed and it isn't due
+			# to be re-signed, there's nothing to do.
+			state = zone_state.get(domain, { })
+			signing = get_zone_signing_state(signing_state, domain, state, os.path.join(ZONES_DIR, zonefile))
+			force_bump = signing is None or domain in due_zones
+			if state.get("digest") == zone_digest and not force_bump and not force \
+				and os.path.exists(os.path.join(ZONES_DIR, zonefile)):
+				new_zone_state[domain] = { "digest": zone_digest }
+				continue
+
+			# Build the records to put in the zone.
+			records = build_zone(domain, subdomains, zone_custom_records.get(domain, { }), env)
+
+			# See if the zone has changed, and if so update the serial number
+			# and write the zone file.
+			serial = write_nsd_zone(domain, os.path.join(ZONES_DIR, zonefile), records, env, force_bump)
+			if serial is None:
+				# Zone was not updated. There were no changes.
+				new_zone_state[domain] = { "digest": zone_digest }
+				continue
+
+			# If this is a .justtesting.email domain, then post the update.
+			try:
+				justtestingdotemail(domain, records)
+			except:
+				# Hmm. Might be a network issue. If we stop now, will we end
+				# up in an inconsistent state? Let's just continue.
+				pass
+
+			# Sign it below. If it's being re-signed because it's due, replace
+			# all of the signatures that would expire by then, not only the
+			# ones that are about to.
+			renew_before = None
+			if signing is not None and domain in due_zones:
+				renew_before = dnssec.parse_time(signing["expiration"]) + datetime.timedelta(seconds=1)
+			zones_to_sign.append((domain, zonefile, records, serial, zone_digest, renew_before))
+
+		# Sign the zones that changed.
 		#
 		# Every time we sign the zone we get a new result, which means
 		# we can't sign a zone without bumping the zone's serial number.
-		# Thus we only sign a zone if write_nsd_zone returned True
+		# Thus we only sign a zone if write_nsd_zone returned a serial number,
 		# indicating the zone changed, and thus it got a new serial number.
-		# write_nsd_zone is smart enough to check if a zone's signature
-		# is nearing experiation and if so it'll bump the serial number
-		# and return True so we get a chance to re-sign it.
-		sign_zone(domain, zonefile, env)
-
-	# Now that all zones are signed (some might not have changed and so didn't
-	# just get signed now, but were before) update the zone filename so nsd.conf
-	# uses the signed file.
-	for i in range(len(zonefiles)):
-		zonefiles[i][1] += ".signed"
-
-	# Write the main nsd.conf file.
-	if write_nsd_conf(zonefiles):
+		# We bump the serial number ourselves (force_bump) when the
+		# zone is due to be re-signed (see dnssec_schedule.py).
+		#
+		# We sign zones ourselves (see dnssec.py), which is CPU-bound, so
+		# the GIL would keep threads from helping: they're signed in a pool
+		# of worker processes, one per core (see utils.process_pool), which
+		# is only started if there's something to sign. Zones with records
+		# dnssec.py doesn't support are signed by ldns-signzone instead,
+		# which runs in a process of its own, so those just need a few
+		# threads to wait on them. A failure on one zone doesn't stop the
+		# others.
+		if len(zones_to_sign) > 0:
+			with contextlib.ExitStack() as stack:
+				processes = None
+				if SIGNING_PROCESSES > 0:
+					processes = stack.enter_context(process_pool(min(SIGNING_PROCESSES, len(zones_to_sign))))
+				threads = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=SIGNING_THREADS))
+				signers = { submit_signing(processes, domain, zonefile, list(records), serial, env, renew_before): (domain, zonefile, zone_digest)
+					for domain, zonefile, records, serial, zone_digest, renew_before in zones_to_sign }
+				pending = set(signers)
+				while len(pending) > 0:
+					done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+					for signer in done:
+						domain, zonefile, zone_digest = signers[signer]
+						try:
+							inception, expiration = signer.result()
+						except dnssec.UnsupportedRecord:
+							ldns_signer = threads.submit(sign_zone_ldns, domain, zonefile, env)
+							signers[ldns_signer] = signers[signer]
+							pending.add(ldns_signer)
+							continue
+						except Exception as e:
+							# Remove the unsigned zone so that it's written and signed
+							# again next time rather than looking unchanged. nsd keeps
+							# serving the previous signed zone.
+							os.unlink(os.path.join(ZONES_DIR, zonefile))
+							signing_errors.append("%s: %s" % (domain, e))
+							continue
+
+						# Mark that we just updated this domain.
+						updated_domains.append(domain)
+						new_zone_state[domain] = { "digest": zone_digest }
+						signing_state.set(domain, inception, expiration)
+	finally:
+		# Zones we didn't get to keep their old state.
+		for domain, state in zone_state.items():
+			if domain in zone_order:
+				new_zone_state.setdefault(domain, state)
+		save_zone_state(new_zone_state)
+		signing_state.remove_except(zone_order)
+		signing_state.close()
+
+	# Keep the output in the same order as the zones.
+	updated_domains.sort(key = lambda domain : zone_order[domain])
+
+	# Have nsd serve the zones we have now, and reload the ones that changed.
+	# Zones that were added or removed are added or removed on their own
+	# without restarting nsd. It's restarted only if nsd.conf changed.
+	#
+	# nsd finds a zone's signed file with the pattern in nsd.conf, which
+	# names it after the zone as it is, but our zone files are named with
+	# safe_domain_name. The two are the same for ordinary domain names. A
+	# zone whose names differ isn't given to nsd, since nsd would serve
+	# some other file or none, and is reported below.
+	zones = []
+	zone_errors = []
+	for domain, zonefile in zonefiles:
+		if ZONE_FILE_PATTERN % domain != zonefile + ".signed":
+			zone_errors.append("%s (nsd would look for %s, not %s)" % (domain, ZONE_FILE_PATTERN % domain, zonefile + ".signed"))
+			continue
+		zones.append(domain)
+	changed_zones = [domain for domain in updated_domains if domain in zones]
+	reloads.set_handler("nsd", lambda action : update_nsd_zones(zones, changed_zones, restart=(action == "restart")))
+
+	# Write the main nsd.conf file. It only has nsd's own settings, so
+	# if it changed nsd must be restarted to see it.
+	nsd_conf_changed = write_nsd_conf(reloads)
+	if nsd_conf_changed:
 		# Make sure updated_domains contains *something* if we wrote an updated
-		# nsd.conf so that we know to restart nsd.
+		# nsd.conf so that we show that something changed.
 		if len(updated_domains) == 0:
 			updated_domains.append("DNS configuration")
 
-	# Kick nsd if anything changed.
-	if len(updated_domains) > 0:
-		shell('check_call', ["/usr/sbin/service", "nsd", "restart"])
+	# Write the OpenDKIM configuration tables. OpenDKIM is reloaded if
+	# they changed.
+	write_opendkim_tables(zonefiles, env, reloads)
 
-	# Write the OpenDKIM configuration tables.
-	write_opendkim_tables(zonefiles, env)
+	if run_reloads:
+		reloads.run()
 
-	# Kick opendkim.
-	shell('check_call', ["/usr/sbin/service", "opendkim", "restart"])
+	# Now that nsd has whatever we could sign, report any zones we couldn't.
+	if len(signing_errors) > 0:
+		raise Exception("DNSSEC signing failed for " + "; ".join(signing_errors))
+	if len(zone_errors) > 0:
+		raise Exception("nsd can't serve the zone file of " + "; ".join(zone_errors))
 
 	if len(updated_domains) == 0:
 		# if nothing was updated (except maybe OpenDKIM's files), don't show any output
@@ -125,20 +301,199 @@ def do_dns_update(env):
 
 ########################################################################
 
-def build_zone(domain, subdomains, additional_records, env, with_ns=True):
+# The user's own DNS records are in STORAGE_ROOT/dns/custom.yaml, which maps
+# each name to an IPv4 address (its A record) or to a mapping from record
+# types to values, e.g.:
+#
+#   www.mydomain.com: 1.2.3.4
+#   mydomain.com:
+#     TXT: "google-site-verification=..."
+#     MX: "10 mx.otherhost.com."
+#
+# The daemon's /dns/custom API changes it a record at a time and rebuilds
+# just the zone the name is in. The file is locked while it's changed and
+# replaced all at once, so changes made at the same time (or by hand with
+# the lock taken) aren't lost.
+
+CUSTOM_RECORD_TYPES = ("A", "AAAA", "CNAME", "MX", "SRV", "TXT", "SSHFP", "CAA", "TLSA")
+
+HOSTNAME = r"(\*\.)?([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9])?\.)*[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9])?\.?"
+CUSTOM_RECORD_VALUES = {
+	"CNAME": HOSTNAME,
+	"MX": r"\d{1,5} " + HOSTNAME,
+	"SRV": r"\d{1,5} \d{1,5} \d{1,5} " + HOSTNAME,
+	"SSHFP": r"\d{1,3} \d{1,3} [0-9a-f]+",
+	"TLSA": r"\d \d \d [0-9a-f]+",
+	"CAA": r'\d{1,3} [a-z0-9]+ "[^"\\]*"',
+}
+
+def get_custom_dns_config_path(env):
+	return os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')
+
+@contextlib.contextmanager
+def lock_custom_dns_config(env):
+	with open(get_custom_dns_config_path(env) + ".lock", "w") as lockfile:
+		fcntl.flock(lockfile, fcntl.LOCK_EX)
+		yield
+
+def read_custom_dns_config(env):
+	try:
+		with open(get_custom_dns_config_path(env)) as f:
+			return rtyaml.load(f) or { }
+	except:
+		return { }
+
+def write_custom_dns_config(config, env):
+	fn = get_custom_dns_config_path(env)
+	with open(fn + ".tmp", "w") as f:
+		f.write(rtyaml.dump(config))
+	os.rename(fn + ".tmp", fn)
+
+def get_custom_dns_records(env, qname=None, rtype=None):
+	# Return the custom records as (qname, rtype, value) tuples, sorted.
 	records = []
+	for name, value in read_custom_dns_config(env).items():
+		if qname is not None and name != qname: continue
+		if isinstance(value, str): value = { "A": value }
+		for rtype2, value2 in value.items():
+			if rtype is not None and rtype2 != rtype: continue
+			records.append((name, rtype2, value2))
+	return sorted(records, key = lambda record : (sort_key_for_domain(record[0]), record[1]))
+
+def sort_key_for_domain(qname):
+	return list(reversed(qname.split(".")))
+
+def validate_custom_dns_record(qname, rtype, value):
+	# Returns a description of what's wrong with the record, or None.
+	if not re.fullmatch(HOSTNAME, qname, re.I) or qname.endswith("."):
+		return "Invalid name."
+	if rtype not in CUSTOM_RECORD_TYPES:
+		return "Unsupported record type. The types that can be set are %s." % ", ".join(CUSTOM_RECORD_TYPES)
+	if rtype == "A" or rtype == "AAAA":
+		try:
+			address = ipaddress.ip_address(value)
+		except ValueError:
+			return "Invalid IP address."
+		if address.version != (4 if rtype == "A" else 6):
+			return "An %s record needs an IPv%d address." % (rtype, 4 if rtype == "A" else 6)
+	elif rtype == "TXT":
+		# build_zone puts the value in quotes, so it must fit in one string.
+		if re.search(r'["\\\n]', value) or len(value.encode("utf8")) > 255:
+			return "A TXT record can be up to 255 characters and can't contain quotes, backslashes or new lines."
+	elif not re.fullmatch(CUSTOM_RECORD_VALUES[rtype], value, re.I):
+		return "Invalid %s record." % rtype
+	return None
+
+def get_zone_for_name(qname, env):
+	# The zone we serve that qname would be in, or None.
+	return DomainTrie(zone[0] for zone in get_dns_zones(env)).find_parent(qname)
+
+def set_custom_dns_record(qname, rtype, value, env):
+	# Set (replacing any other) the value of a custom record. Returns the
+	# zone the record is in if it changed, False if it didn't, or an error
+	# message and HTTP status code.
+	qname = qname.lower()
+	error = validate_custom_dns_record(qname, rtype, value)
+	if error: return (error + "\n", 400)
+	zone = get_zone_for_name(qname, env)
+	if zone is None:
+		return ("%s is not in a DNS zone this box serves.\n" % qname, 400)
+	if rtype == "CNAME" and qname == zone:
+		return ("A CNAME record can't be set on the domain itself.\n", 400)
+
+	with lock_custom_dns_config(env):
+		config = read_custom_dns_config(env)
+		records = config.get(qname, { })
+		if isinstance(records, str): records = { "A": records }
+
+		# A name with a CNAME record can't have any others.
+		if (rtype == "CNAME" and set(records) - { "CNAME" }) or (rtype != "CNAME" and "CNAME" in records):
+			return ("%s can't have both a CNAME record and other records.\n" % qname, 400)
+
+		if records.get(rtype) == value:
+			return False
+		records[rtype] = value
+
+		# A name with just an A record is written as just its address.
+		config[qname] = records["A"] if list(records) == ["A"] else records
+		write_custom_dns_config(config, env)
+
+	return zone
+
+def remove_custom_dns_record(qname, rtype, env):
+	# Remove a custom record, or all of a name's custom records if rtype is
+	# None. Returns the zone it was in (None if it's not in one of our zones)
+	# if anything was removed, or else False.
+	qname = qname.lower()
+	with lock_custom_dns_config(env):
+		config = read_custom_dns_config(env)
+		records = config.get(qname)
+		if records is None: return False
+		if isinstance(records, str): records = { "A": records }
+		if rtype is None:
+			records = { }
+		elif rtype in records:
+			del records[rtype]
+		else:
+			return False
+
+		if len(records) == 0:
+			del config[qname]
+		else:
+			config[qname] = records["A"] if list(records) == ["A"] else records
+		write_custom_dns_config(config, env)
+
+	return get_zone_for_name(qname, env)
+
+########################################################################
+
+class ZoneRecords:
+	# The records of a DNS zone, grouped into RRsets by name and type. Names
+	# are relative to the zone, and None is the zone itself. Iterating over
+	# it gives (qname, rtype, value) tuples in a canonical order: by name
+	# from the right-most label, with the zone itself first (which the zone
+	# file format requires, since its records have no name), then by type,
+	# and then in the order the values were added.
+
+	def __init__(self):
+		self.rrsets = { }
+
+	def add(self, qname, rtype, value):
+		self.rrsets.setdefault((qname, rtype), []).append(value)
+
+	def has(self, qname, rtype):
+		return (qname, rtype) in self.rrsets
+
+	def __iter__(self):
+		def canonical_order(key):
+			qname, rtype = key
+			return (list(reversed(qname.lower().split("."))) if qname is not None else [], rtype)
+		for qname, rtype in sorted(self.rrsets, key=canonical_order):
+			for value in self.rrsets[(qname, rtype)]:
+				yield (qname, rtype, value)
+
+	def render(self):
+		# The records as lines of a zone file for nsd.
+		return "".join(
+			(qname or "") + "\tIN\t" + rtype + "\t" + value + "\n"
+			for qname, rtype, value in self)
+
+def build_zone(domain, subdomains, additional_records, env, with_ns=True):
+	# Returns a ZoneRecords. additional_records are the user's custom
+	# records for names in this zone.
+	records = ZoneRecords()
 
 	# For top-level zones, define ourselves as the authoritative name server.
 	if with_ns:
-		records.append((None,  "NS",  "ns1.%s." % env["PRIMARY_HOSTNAME"]))
-		records.append((None,  "NS",  "ns2.%s." % env["PRIMARY_HOSTNAME"]))
+		records.add(None,  "NS",  "ns1.%s." % env["PRIMARY_HOSTNAME"])
+		records.add(None,  "NS",  "ns2.%s." % env["PRIMARY_HOSTNAME"])
 
 	# The MX record says where email for the domain should be delivered: Here!
-	records.append((None,  "MX",  "10 %s." % env["PRIMARY_HOSTNAME"]))
+	records.add(None,  "MX",  "10 %s." % env["PRIMARY_HOSTNAME"])
 
 	# SPF record: Permit the box ('mx', see above) to send mail on behalf of
 	# the domain, and no one else.
-	records.append((None,  "TXT", '"v=spf1 mx -all"'))
+	records.add(None,  "TXT", '"v=spf1 mx -all"')
 
 	# If we need to define DNS for any subdomains of this domain, include it
 	# in the zone.
@@ -149,60 +504,66 @@ def build_zone(domain, subdomains, additional_records, env, with_ns=True):
 				child_qname = subdomain_qname
 			else:
 				child_qname += "." + subdomain_qname
-			records.append((child_qname, child_rtype, child_value))
+			records.add(child_qname, child_rtype, child_value)
 
 	# In PRIMARY_HOSTNAME...
 	if domain == env["PRIMARY_HOSTNAME"]:
 		# Define ns1 and ns2.
-		records.append(("ns1", "A",   env["PUBLIC_IP"]))
-		records.append(("ns2", "A",   env["PUBLIC_IP"]))
+		records.add("ns1", "A",   env["PUBLIC_IP"])
+		records.add("ns2", "A",   env["PUBLIC_IP"])
 
 		# Add a DANE TLSA record for SMTP.
-		records.append(("_25._tcp", "TLSA", build_tlsa_record(env)))
+		records.add("_25._tcp", "TLSA", build_tlsa_record(env))
 
-	def has_rec(qname, rtype):
-		for rec in records:
-			if rec[0] == qname and rec[1] == rtype:
-				return True
-		return False
-
-	# The user may set other records that don't conflict with our settings.
+	# The user may set other records.
 	for qname, value in additional_records.items():
 		if qname != domain and not qname.endswith("." + domain): continue
 		if qname == domain:
 			qname = None
 		else:
 			qname = qname[0:len(qname)-len("." + domain)]
-		if has_rec(qname, value): continue
 		if isinstance(value, str):
-			records.append((qname, "A", value))
+			records.add(qname, "A", value)
 		elif isinstance(value, dict):
 			for rtype, value2 in value.items():
 				if rtype == "TXT": value2 = "\"" + value2 + "\""
-				records.append((qname, rtype, value2))
+				records.add(qname, rtype, value2)
 
 	# Add defaults if not overridden by the user's custom settings.
-	if not has_rec(None, "A"): records.append((None, "A", env["PUBLIC_IP"]))
-	if env.get('PUBLIC_IPV6') and not has_rec(None, "AAAA"): records.append((None, "AAAA", env["PUBLIC_IPV6"]))
-	if not has_rec("www", "A"): records.append(("www", "A", env["PUBLIC_IP"]))
-	if env.get('PUBLIC_IPV6') and not has_rec("www", "AAAA"): records.append(("www", "AAAA", env["PUBLIC_IPV6"]))
+	if not records.has(None, "A"): records.add(None, "A", env["PUBLIC_IP"])
+	if env.get('PUBLIC_IPV6') and not records.has(None, "AAAA"): records.add(None, "AAAA", env["PUBLIC_IPV6"])
+	if not records.has("www", "CNAME"):
+		if not records.has("www", "A"): records.add("www", "A", env["PUBLIC_IP"])
+		if env.get('PUBLIC_IPV6') and not records.has("www", "AAAA"): records.add("www", "AAAA", env["PUBLIC_IPV6"])
 
 	# If OpenDKIM is in use..
-	opendkim_record_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')
-	if os.path.exists(opendkim_record_file):
+	dkim_record = get_dkim_record(env)
+	if dkim_record is not None:
 		# Append the DKIM TXT record to the zone as generated by OpenDKIM, after string formatting above.
-		with open(opendkim_record_file) as orf:
-			m = re.match(r"(\S+)\s+IN\s+TXT\s+(\(.*\))\s*;", orf.read(), re.S)
-			records.append((m.group(1), "TXT", m.group(2)))
+		records.add(*dkim_record)
 
 		# Append a DMARC record.
-		records.append(("_dmarc", "TXT", '"v=DMARC1; p=quarantine"'))
-
-	# Sort the records. The None records *must* go first. Otherwise it doesn't matter.
-	records.sort(key = lambda rec : list(reversed(rec[0].split(".")) if rec[0] is not None else ""))
+		records.add("_dmarc", "TXT", '"v=DMARC1; p=quarantine"')
 
 	return records
 
+_dkim_record = (None, None)
+
+def get_dkim_record(env):
+	# The DKIM TXT record that OpenDKIM generated, as (qname, "TXT", value),
+	# or None if OpenDKIM isn't set up. Every zone has it, so it's only read
+	# from disk again when the file changes.
+	global _dkim_record
+	opendkim_record_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')
+	if not os.path.exists(opendkim_record_file):
+		return None
+	mtime = os.stat(opendkim_record_file).st_mtime_ns
+	if _dkim_record[0] != (opendkim_record_file, mtime):
+		with open(opendkim_record_file) as orf:
+			m = re.match(r"(\S+)\s+IN\s+TXT\s+(\(.*\))\s*;", orf.read(), re.S)
+			_dkim_record = ((opendkim_record_file, mtime), (m.group(1), "TXT", m.group(2)))
+	return _dkim_record[1]
+
 ########################################################################
 
 def build_tlsa_record(env):
@@ -213,14 +574,7 @@ def build_tlsa_record(env):
 	# for explaining all of this!
 
 	# Get the hex SHA256 of the DER-encoded server certificate:
-	certder = shell("check_output", [
-		"/usr/bin/openssl",
-		"x509",
-		"-in", os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem"),
-		"-outform", "DER"
-		],
-		return_bytes=True)
-	certhash = hashlib.sha256(certder).hexdigest()
+	certhash = get_certificate_info(os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem"))["sha256"]
 
 	# Specify the TLSA parameters:
 	# 3: This is the certificate that the client should trust. No CA is needed.
@@ -230,7 +584,10 @@ def build_tlsa_record(env):
 
 ########################################################################
 
-def write_nsd_zone(domain, zonefile, records, env):
+def write_nsd_zone(domain, zonefile, records, env, force_bump):
+	# Write the zone file if the zone changed (or force_bump is set) and
+	# return its new serial number, or return None if it didn't change.
+	#
 	# We set the administrative email address for every domain to domain_contact@[domain.com].
 	# You should probably create an alias to your email address.
 
@@ -238,6 +595,7 @@ def write_nsd_zone(domain, zonefile, records, env):
 	# what the $ORIGIN line does. Any further data after the domain confuses
 	# ldns-signzone, however. It used to say '; default zone domain'.
 
+	# The SOA must match build_soa.
 	zone = """
 $ORIGIN {domain}.
 $TTL 86400           ; default time to live
@@ -255,39 +613,7 @@ $TTL 86400           ; default time to live
 	zone = zone.format(domain=domain, primary_domain=env["PRIMARY_HOSTNAME"])
 
 	# Add records.
-	for subdomain, querytype, value in records:
-		if subdomain:
-			zone += subdomain
-		zone += "\tIN\t" + querytype + "\t"
-		zone += value + "\n"
-
-	# DNSSEC requires re-signing a zone periodically. That requires
-	# bumping the serial number even if no other records have changed.
-	# We don't see the DNSSEC records yet, so we have to figure out
-	# if a re-signing is necessary so we can prematurely bump the
-	# serial number.
-	force_bump = False
-	if not os.path.exists(zonefile + ".signed"):
-		# No signed file yet. Shouldn't normally happen unless a box
-		# is going from not using DNSSEC to using DNSSEC.
-		force_bump = True
-	else:
-		# We've signed the domain. Check if we are close to the expiration
-		# time of the signature. If so, we'll force a bump of the serial
-		# number so we can re-sign it.
-		with open(zonefile + ".signed") as f:
-			signed_zone = f.read()
-		expiration_times = re.findall(r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
-		if len(expiration_times) == 0:
-			# weird
-			force_bump = True
-		else:
-			# All of the times should be the same, but if not choose the soonest.
-			expiration_time = min(expiration_times)
-			expiration_time = datetime.datetime.strptime(expiration_time, "%Y%m%d%H%M%S")
-			if expiration_time - datetime.datetime.now() < datetime.timedelta(days=3):
-				# We're within three days of the expiration, so bump serial & resign.
-				force_bump = True
+	zone += records.render()
 
 	# Set the serial number.
 	serial = datetime.datetime.now().strftime("%Y%m%d00")
@@ -306,7 +632,7 @@ $TTL 86400           ; default time to live
 				# If the existing zone is the same as the new zone (modulo the serial number),
 				# there is no need to update the file. Unless we're forcing a bump.
 				if zone == existing_zone and not force_bump:
-					return False
+					return None
 
 				# If the existing serial is not less than a serial number
 				# based on the current date plus 00, increment it. Otherwise,
@@ -321,11 +647,30 @@ $TTL 86400           ; default time to live
 	with open(zonefile, "w") as f:
 		f.write(zone)
 
-	return True # file is updated
+	return serial # file is updated
+
+########################################################################
+
+def get_zone_signing_state(signing_state, domain, state, zonefile):
+	# Return when the zone's DNSSEC signatures start and expire and when
+	# it's to be re-signed, or None if the zone isn't signed or we don't
+	# know when it was, in which case it must be signed now.
+	if not os.path.exists(zonefile + ".signed"):
+		# No signed file yet. Shouldn't normally happen unless a box
+		# is going from not using DNSSEC to using DNSSEC.
+		return None
+	signing = signing_state.get(domain)
+	if signing is None and state.get("expires"):
+		# The zone was signed before we kept the signing state in its own
+		# database, when all we noted was when the signatures expire.
+		expiration = dnssec.parse_time(state["expires"])
+		signing_state.set(domain, dnssec.format_time(expiration - dnssec.SIGNATURE_VALIDITY), state["expires"])
+		signing = signing_state.get(domain)
+	return signing
 
 ########################################################################
 
-def write_nsd_conf(zonefiles):
+def write_nsd_conf(reloads):
 	# Basic header.
 	nsdconf = """
 server:
@@ -335,8 +680,8 @@ server:
   identity: ""
 
   # The directory for zonefile: files.
-  zonesdir: "/etc/nsd/zones"
-"""
+  zonesdir: "%s"
+""" % ZONES_DIR
 	
 	# Since we have bind9 listening on localhost for locally-generated
 	# DNS queries that require a recursive nameserver, we must have
@@ -347,92 +692,115 @@ server:
 	for ipaddr in shell("check_output", ["/bin/hostname", "-I"]).strip().split(" "):
 		nsdconf += "  ip-address: %s\n" % ipaddr
 
+	# Let dns_service.py add, remove and reload zones with nsd-control.
+	nsdconf += """
+remote-control:
+  control-enable: yes
+"""
 
-	# Append the zones.
-	for domain, zonefile in zonefiles:
-		nsdconf += """
-zone:
-	name: %s
-	zonefile: %s
-""" % (domain, zonefile)
-
-	# Check if the nsd.conf is changing. If it isn't changing,
-	# return False to flag that no change was made.
-	with open("/etc/nsd/nsd.conf") as f:
-		if f.read() == nsdconf:
-			return False
-
-	with open("/etc/nsd/nsd.conf", "w") as f:
-		f.write(nsdconf)
+	# The zones aren't listed here. They're added with nsd-control using
+	# this pattern, and each zone's signed file is named after the zone
+	# (see get_dns_zones, and do_dns_update for zones whose files aren't).
+	nsdconf += """
+pattern:
+  name: %s
+  zonefile: "%s"
+""" % (ZONE_PATTERN, ZONE_FILE_PATTERN)
 
-	return True
+	# Write nsd.conf if it's changing, and return whether it did. nsd has
+	# to be restarted to see a new nsd.conf.
+	return reloads.write_file("nsd", NSD_CONF, nsdconf, "restart")
 
 ########################################################################
 
-def sign_zone(domain, zonefile, env):
+def build_soa(domain, serial, env):
+	# The zone's SOA record, as write_nsd_zone writes it.
+	return (None, "SOA", "ns1.{primary_domain}. hostmaster.{primary_domain}. {serial} 28800 7200 864000 86400".format(
+		primary_domain=env["PRIMARY_HOSTNAME"], serial=serial))
+
+def submit_signing(processes, *args):
+	# Start signing a zone with sign_zone in the pool of worker processes,
+	# or sign it right here if there's no pool. Returns a future either way.
+	if processes is not None:
+		return submit_to_pool(processes, sign_zone, *args)
+	future = concurrent.futures.Future()
+	try:
+		future.set_result(sign_zone(*args))
+	except Exception as e:
+		future.set_exception(e)
+	return future
+
+def sign_zone(domain, zonefile, records, serial, env, renew_before=None):
+	# Sign a zone and write its DS record with dnssec.py, which only re-signs
+	# the RRsets that changed. Returns when the signatures start and expire
+	# (see dnssec.sign_zone). Raises dnssec.UnsupportedRecord if the zone has
+	# a record type dnssec.py doesn't know, and then sign_zone_ldns signs the
+	# zone file instead. This usually runs in a worker process, concurrently with
+	# other zones (see do_dns_update), so it must not use any files other
+	# than the zone's own.
+	return dnssec.sign_zone(domain, [build_soa(domain, serial, env)] + list(records), os.path.join(ZONES_DIR, zonefile), env, renew_before)
+
+def sign_zone_ldns(domain, zonefile, env):
+	# Sign a zone file with ldns-signzone and write its DS record with
+	# ldns-key2ds. Uses its own temporary directory for the keys.
 	dnssec_keys = load_env_vars_from_file(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/keys.conf'))
 
 	# In order to use the same keys for all domains, we have to generate
 	# a new .key file with a DNSSEC record for the specific domain. We
 	# can reuse the same key, but it won't validate without a DNSSEC
 	# record specifically for the domain.
-	# 
-	# Copy the .key and .private files to /tmp to patch them up.
 	#
-	# Use os.umask and open().write() to securely create a copy that only
-	# we (root) can read.
-	files_to_kill = []
-	for key in ("KSK", "ZSK"):
-		if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
-		oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
-		newkeyfn = '/tmp/' + dnssec_keys[key].replace("_domain_", domain)
-		dnssec_keys[key] = newkeyfn
-		for ext in (".private", ".key"):
-			if not os.path.exists(oldkeyfn + ext): raise Exception("DNSSEC is not properly set up.")
-			with open(oldkeyfn + ext, "r") as fr:
-				keydata = fr.read()
-			keydata = keydata.replace("_domain_", domain) # trick ldns-signkey into letting our generic key be used by this zone
-			fn = newkeyfn + ext
-			prev_umask = os.umask(0o77) # ensure written file is not world-readable
-			try:
-				with open(fn, "w") as fw:
+	# Copy the .key and .private files to a new temporary directory to
+	# patch them up. The directory is created so that only we (root) can
+	# read it and it's removed when we're done.
+	with tempfile.TemporaryDirectory(prefix="mailinabox-dnssec-") as keydir:
+		for key in ("KSK", "ZSK"):
+			if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
+			oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
+			newkeyfn = os.path.join(keydir, dnssec_keys[key].replace("_domain_", domain))
+			dnssec_keys[key] = newkeyfn
+			for ext in (".private", ".key"):
+				if not os.path.exists(oldkeyfn + ext): raise Exception("DNSSEC is not properly set up.")
+				with open(oldkeyfn + ext, "r") as fr:
+					keydata = fr.read()
+				keydata = keydata.replace("_domain_", domain) # trick ldns-signkey into letting our generic key be used by this zone
+				with open(os.open(newkeyfn + ext, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as fw:
 					fw.write(keydata)
-			finally:
-				os.umask(prev_umask) # other files we write should be world-readable
-			files_to_kill.append(fn)
-
-	# Do the signing.
-	expiry_date = (datetime.datetime.now() + datetime.timedelta(days=30)).strftime("%Y%m%d")
-	shell('check_call', ["/usr/bin/ldns-signzone",
-		# expire the zone after 30 days
-		"-e", expiry_date,
-
-		# use NSEC3
-		"-n",
-
-		# zonefile to sign
-		"/etc/nsd/zones/" + zonefile,
-
-		# keys to sign with (order doesn't matter -- it'll figure it out)
-		dnssec_keys["KSK"],
-		dnssec_keys["ZSK"],
-	])
-
-	# Create a DS record based on the patched-up key files. The DS record is specific to the
-	# zone being signed, so we can't use the .ds files generated when we created the keys.
-	# The DS record points to the KSK only. Write this next to the zone file so we can
-	# get it later to give to the user with instructions on what to do with it.
-	rr_ds = shell('check_output', ["/usr/bin/ldns-key2ds",
-		"-n", # output to stdout
-		"-2", # SHA256
-		dnssec_keys["KSK"] + ".key"
-	])
-	with open("/etc/nsd/zones/" + zonefile + ".ds", "w") as f:
-		f.write(rr_ds)
-
-	# Remove our temporary file.
-	for fn in files_to_kill:
-		os.unlink(fn)
+
+		# Do the signing. RRSIG times are in UTC, as is the date we pass
+		# to ldns-signzone.
+		inception = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+		expiry_date = (datetime.datetime.utcnow() + datetime.timedelta(days=30)).strftime("%Y%m%d")
+		shell('check_call', ["/usr/bin/ldns-signzone",
+			# expire the zone after 30 days
+			"-e", expiry_date,
+
+			# use NSEC3
+			"-n",
+
+			# zonefile to sign
+			os.path.join(ZONES_DIR, zonefile),
+
+			# keys to sign with (order doesn't matter -- it'll figure it out)
+			dnssec_keys["KSK"],
+			dnssec_keys["ZSK"],
+		])
+
+		# Create a DS record based on the patched-up key files. The DS record is specific to the
+		# zone being signed, so we can't use the .ds files generated when we created the keys.
+		# The DS record points to the KSK only. Write this next to the zone file so we can
+		# get it later to give to the user with instructions on what to do with it.
+		rr_ds = shell('check_output', ["/usr/bin/ldns-key2ds",
+			"-n", # output to stdout
+			"-2", # SHA256
+			dnssec_keys["KSK"] + ".key"
+		])
+		with open(os.path.join(ZONES_DIR, zonefile + ".ds"), "w") as f:
+			f.write(rr_ds)
+
+	# Return when the signatures start and expire, in the format of an
+	# RRSIG record. ldns-signzone starts them now.
+	return (inception, expiry_date + "000000")
 
 ########################################################################
 
@@ -440,7 +808,7 @@ def get_ds_records(env):
 	zonefiles = get_dns_zones(env)
 	ret = ""
 	for domain, zonefile in zonefiles:
-		fn = "/etc/nsd/zones/" + zonefile + ".ds"
+		fn = os.path.join(ZONES_DIR, zonefile + ".ds")
 		if os.path.exists(fn):
 			with open(fn, "r") as fr:
 				ret += fr.read().strip() + "\n"
@@ -449,7 +817,7 @@ def get_ds_records(env):
 	
 ########################################################################
 
-def write_opendkim_tables(zonefiles, env):
+def write_opendkim_tables(zonefiles, env, reloads):
 	# Append a record to OpenDKIM's KeyTable and SigningTable for each domain.
 	#
 	# The SigningTable maps email addresses to signing information. The KeyTable
@@ -465,16 +833,14 @@ def write_opendkim_tables(zonefiles, env):
 	opendkim_key_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.private')
 	if not os.path.exists(opendkim_key_file): return
 
-	with open("/etc/opendkim/KeyTable", "w") as f:
-		f.write("\n".join(
-			"{domain} {domain}:mail:{key_file}".format(domain=domain, key_file=opendkim_key_file)
-			for domain, zonefile in zonefiles
+	reloads.write_file("opendkim", os.path.join(OPENDKIM_DIR, "KeyTable"), "\n".join(
+		"{domain} {domain}:mail:{key_file}".format(domain=domain, key_file=opendkim_key_file)
+		for domain, zonefile in zonefiles
 		))
 
-	with open("/etc/opendkim/SigningTable", "w") as f:
-		f.write("\n".join(
-			"*@{domain} {domain}".format(domain=domain)
-			for domain, zonefile in zonefiles
+	reloads.write_file("opendkim", os.path.join(OPENDKIM_DIR, "SigningTable"), "\n".join(
+		"*@{domain} {domain}".format(domain=domain)
+		for domain, zonefile in zonefiles
 		))
 
 ########################################################################
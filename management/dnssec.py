@@ -0,0 +1,374 @@
+# Signs DNS zones for DNSSEC.
+#
+# This does what ldns-signzone and ldns-key2ds did for us, but from the
+# records build_zone makes rather than from a zone file, and without
+# starting any processes. The signing keys in STORAGE_ROOT/dns/dnssec are
+# read once. The signatures we make are saved next to the signed zone
+# file, and an RRset (the records of one type at one name) that hasn't
+# changed since keeps its signature until it gets close to expiring.
+# Changing one record in a zone thus takes a new signature for that
+# record and for the SOA (whose serial number changed), and the NSEC3
+# records if names were added or removed, rather than re-signing the
+# whole zone.
+#
+# The zone is signed with NSEC3 (RFC 5155) with no salt and no extra
+# iterations, as RFC 9276 recommends. Only the record types that we know
+# how to put into wire format are supported. sign_zone raises
+# UnsupportedRecord for anything else, and the caller falls back to ldns.
+########################################################################
+
+import os, os.path, re, base64, hashlib, json, socket, struct, threading, datetime
+
+from utils import load_env_vars_from_file
+
+# The TTL of every record we write. It's the $TTL of the zone files made
+# by write_nsd_zone and the SOA's minimum TTL, which NSEC3 records use.
+TTL = 86400
+
+# How long new signatures are good for, and how long a saved signature
+# must still be good for to be used again rather than replaced.
+SIGNATURE_VALIDITY = datetime.timedelta(days=30)
+SIGNATURE_REUSE_MARGIN = datetime.timedelta(days=7)
+
+# Start signatures a little in the past in case a resolver's clock is behind ours.
+SIGNATURE_INCEPTION_OFFSET = datetime.timedelta(hours=1)
+
+RRTYPES = {
+	"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15, "TXT": 16,
+	"AAAA": 28, "SRV": 33, "DS": 43, "SSHFP": 44, "RRSIG": 46, "DNSKEY": 48,
+	"NSEC3": 50, "NSEC3PARAM": 51, "TLSA": 52, "SPF": 99, "CAA": 257,
+}
+
+class UnsupportedRecord(Exception):
+	pass
+
+########################################################################
+
+# Keys.
+
+class SigningKey:
+	# One of the box's DNSSEC keys. ldns-keygen made them for the domain
+	# "_domain_", but the key itself doesn't depend on the domain, so the
+	# same key signs every zone.
+	def __init__(self, fn):
+		# ldns-keygen follows the record with a comment giving the key's
+		# tag and size, like ";{id = 8882 (ksk), size = 2048b}".
+		with open(fn + ".key") as f:
+			key = re.sub(r";.*", "", f.read())
+		m = re.match(r"\S+\s+(?:\d+\s+)?IN\s+DNSKEY\s+(\d+)\s+(\d+)\s+(\d+)\s+(.*)", key, re.S)
+		if not m: raise ValueError("Invalid DNSKEY in %s.key." % fn)
+		self.flags, self.protocol, self.algorithm = int(m.group(1)), int(m.group(2)), int(m.group(3))
+		self.public_key = base64.b64decode("".join(m.group(4).split()))
+		self.rdata = struct.pack("!HBB", self.flags, self.protocol, self.algorithm) + self.public_key
+		self.key_tag = get_key_tag(self.rdata)
+
+		if self.algorithm == 7 or self.algorithm == 5:
+			# RSASHA1-NSEC3-SHA1, RSASHA1
+			self.hash, self.digest_info = hashlib.sha1, bytes.fromhex("3021300906052b0e03021a05000414")
+		elif self.algorithm == 8:
+			# RSASHA256
+			self.hash, self.digest_info = hashlib.sha256, bytes.fromhex("3031300d060960864801650304020105000420")
+		else:
+			raise UnsupportedRecord("DNSSEC algorithm %d is not supported." % self.algorithm)
+
+		# The private key is in the BIND format, one base64 field per line.
+		private = { }
+		with open(fn + ".private") as f:
+			for line in f:
+				if ":" in line:
+					k, v = line.split(":", 1)
+					private[k.strip()] = v.strip()
+		def field(name):
+			return int.from_bytes(base64.b64decode(private[name]), "big")
+		self.modulus = field("Modulus")
+		self.p, self.q = field("Prime1"), field("Prime2")
+		self.dp, self.dq, self.qinv = field("Exponent1"), field("Exponent2"), field("Coefficient")
+		self.size = (self.modulus.bit_length() + 7) // 8
+
+		# The public exponent and modulus that resolvers check signatures
+		# with are in the DNSKEY (RFC 3110 section 2): the exponent's
+		# length in one byte, or in two bytes after a zero byte, the
+		# exponent, and then the modulus.
+		if self.public_key[0] == 0:
+			e_len, e_start = struct.unpack("!H", self.public_key[1:3])[0], 3
+		else:
+			e_len, e_start = self.public_key[0], 1
+		self.public_exponent = int.from_bytes(self.public_key[e_start:e_start + e_len], "big")
+		if int.from_bytes(self.public_key[e_start + e_len:], "big") != self.modulus:
+			raise ValueError("The DNSKEY in %s.key doesn't match the key in %s.private." % (fn, fn))
+
+	@property
+	def is_ksk(self):
+		return self.flags & 1 == 1 # Secure Entry Point flag
+
+	def sign(self, data):
+		# RSASSA-PKCS1-v1_5 (RFC 3447), using the Chinese remainder
+		# theorem which is about four times faster than pow(m, d, n).
+		t = self.digest_info + self.hash(data).digest()
+		em = b"\x00\x01" + b"\xff" * (self.size - len(t) - 3) + b"\x00" + t
+		m = int.from_bytes(em, "big")
+		s1 = pow(m, self.dp, self.p)
+		s2 = pow(m, self.dq, self.q)
+		s = s2 + self.q * ((self.qinv * (s1 - s2)) % self.p)
+
+		# A mistake in the CRT computation (a bad key file, or a fault in
+		# the hardware) would make a signature that not only doesn't
+		# validate but that reveals the private key. So check it with the
+		# public key before letting it out, which is cheap since the
+		# public exponent is small.
+		if pow(s, self.public_exponent, self.modulus) != m:
+			raise ValueError("A DNSSEC signature made with key %d didn't verify." % self.key_tag)
+		return s.to_bytes(self.size, "big")
+
+def get_key_tag(rdata):
+	# RFC 4034 Appendix B.
+	ac = 0
+	for i, b in enumerate(rdata):
+		ac += b if i & 1 else b << 8
+	ac += (ac >> 16) & 0xFFFF
+	return ac & 0xFFFF
+
+_keys = { }
+_keys_lock = threading.Lock()
+
+def get_signing_keys(env):
+	# Return the box's KSK and ZSK, reading them only when they've changed.
+	keys_conf = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/keys.conf')
+	dnssec_keys = load_env_vars_from_file(keys_conf)
+	ret = []
+	for key in ("KSK", "ZSK"):
+		if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
+		fn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
+		if not os.path.exists(fn + ".key") or not os.path.exists(fn + ".private"): raise Exception("DNSSEC is not properly set up.")
+		mtime = (os.stat(fn + ".key").st_mtime_ns, os.stat(fn + ".private").st_mtime_ns)
+		with _keys_lock:
+			if fn not in _keys or _keys[fn][0] != mtime:
+				_keys[fn] = (mtime, SigningKey(fn))
+			ret.append(_keys[fn][1])
+	return ret
+
+########################################################################
+
+# Names and records in DNS wire format.
+
+def name_to_wire(name):
+	# name is an absolute, lowercase name without the final dot.
+	wire = b""
+	for label in name.split(".") if name else []:
+		label = label.encode("ascii")
+		if len(label) == 0 or len(label) > 63: raise UnsupportedRecord("Invalid name %s." % name)
+		wire += bytes([len(label)]) + label
+	return wire + b"\x00"
+
+def absolute_name(name, origin):
+	# Turn a name in a zone file into an absolute, lowercase name without
+	# the final dot, as in name_to_wire.
+	if "\\" in name: raise UnsupportedRecord("Escaped names are not supported: %s" % name)
+	if name == "@": return origin
+	if name.endswith("."): return name[:-1].lower()
+	return (name + "." + origin).lower()
+
+def parse_character_strings(value):
+	# The <character-string>s of a TXT record, e.g. ( "v=DKIM1; k=rsa; " "p=..." ).
+	value = value.strip()
+	if value.startswith("(") and value.endswith(")"): value = value[1:-1]
+	strings = []
+	for quoted, unquoted in re.findall(r'"((?:[^"\\]|\\.)*)"|(\S+)', value, re.S):
+		s = quoted if quoted or not unquoted else unquoted
+		s = re.sub(r"\\(\d{3})", lambda m : chr(int(m.group(1))), s)
+		s = re.sub(r"\\(.)", r"\1", s).encode("utf8")
+		if len(s) > 255: raise UnsupportedRecord("TXT string is too long.")
+		strings.append(bytes([len(s)]) + s)
+	return b"".join(strings)
+
+def rdata_to_wire(rtype, value, origin):
+	# Convert a record's value as it appears in a zone file into its wire format.
+	f = value.split()
+	try:
+		if rtype == "A":
+			return socket.inet_pton(socket.AF_INET, value.strip())
+		elif rtype == "AAAA":
+			return socket.inet_pton(socket.AF_INET6, value.strip())
+		elif rtype in ("NS", "CNAME", "PTR"):
+			return name_to_wire(absolute_name(f[0], origin))
+		elif rtype == "MX":
+			return struct.pack("!H", int(f[0])) + name_to_wire(absolute_name(f[1], origin))
+		elif rtype == "SRV":
+			return struct.pack("!HHH", int(f[0]), int(f[1]), int(f[2])) + name_to_wire(absolute_name(f[3], origin))
+		elif rtype in ("TXT", "SPF"):
+			return parse_character_strings(value)
+		elif rtype == "SOA":
+			return name_to_wire(absolute_name(f[0], origin)) + name_to_wire(absolute_name(f[1], origin)) \
+				+ struct.pack("!IIIII", *[int(x) for x in f[2:7]])
+		elif rtype == "TLSA":
+			return struct.pack("!BBB", int(f[0]), int(f[1]), int(f[2])) + bytes.fromhex("".join(f[3:]))
+		elif rtype == "SSHFP":
+			return struct.pack("!BB", int(f[0]), int(f[1])) + bytes.fromhex("".join(f[2:]))
+		elif rtype == "DS":
+			return struct.pack("!HBB", int(f[0]), int(f[1]), int(f[2])) + bytes.fromhex("".join(f[3:]))
+		elif rtype == "CAA":
+			tag = f[1].encode("ascii")
+			return struct.pack("!BB", int(f[0]), len(tag)) + tag + parse_character_strings(value.split(None, 2)[2])[1:]
+	except (ValueError, IndexError, OSError, struct.error) as e:
+		raise UnsupportedRecord("Invalid %s record %s: %s" % (rtype, value, e))
+	raise UnsupportedRecord("%s records are not supported." % rtype)
+
+def get_rrtype_number(rtype):
+	if rtype not in RRTYPES: raise UnsupportedRecord("%s records are not supported." % rtype)
+	return RRTYPES[rtype]
+
+def type_bitmap(rtypes):
+	# The Type Bit Maps field of an NSEC3 record (RFC 5155 3.2.1).
+	windows = { }
+	for t in rtypes:
+		window = windows.setdefault(t >> 8, bytearray(32))
+		window[(t & 0xFF) >> 3] |= 0x80 >> (t & 7)
+	wire = b""
+	for window, bits in sorted(windows.items()):
+		bits = bytes(bits).rstrip(b"\x00")
+		wire += bytes([window, len(bits)]) + bits
+	return wire
+
+BASE32HEX = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", "0123456789abcdefghijklmnopqrstuv")
+
+def nsec3_hash(name, salt=b"", iterations=0):
+	h = hashlib.sha1(name_to_wire(name) + salt).digest()
+	for i in range(iterations):
+		h = hashlib.sha1(h + salt).digest()
+	return h
+
+########################################################################
+
+def sign_zone(domain, records, zonefile, env, renew_before=None):
+	# Sign a zone and write the signed zone to zonefile + ".signed" and
+	# its DS record to zonefile + ".ds". records are the records of the
+	# zone, as (qname, rtype, value) tuples like build_zone returns, plus
+	# the SOA. Saved signatures that expire before renew_before (a UTC
+	# datetime) are replaced even if they aren't about to expire. Returns
+	# when the soonest-expiring signature starts and expires, as a tuple
+	# of YYYYMMDDHHMMSS times. Raises UnsupportedRecord if there's a record
+	# we can't sign, before anything is written.
+	ksk, zsk = get_signing_keys(env)
+	origin = domain.lower()
+	now = datetime.datetime.utcnow().replace(microsecond=0)
+
+	# Group the records into RRsets by name and type, in wire format.
+	rrsets = { }
+	for qname, rtype, value in records:
+		owner = origin if qname is None else absolute_name(qname, origin)
+		if owner != origin and not owner.endswith("." + origin):
+			raise UnsupportedRecord("%s is not in the zone %s." % (owner, origin))
+		if rtype == "NS" and owner != origin:
+			raise UnsupportedRecord("Delegations are not supported.")
+		rrsets.setdefault((owner, rtype), []).append((rdata_to_wire(rtype, value, origin), value))
+	if (origin, "SOA") not in rrsets: raise ValueError("The zone has no SOA record.")
+
+	# Add the keys.
+	for key in (ksk, zsk):
+		rrsets.setdefault((origin, "DNSKEY"), []).append((key.rdata,
+			"%d %d %d %s" % (key.flags, key.protocol, key.algorithm, base64.b64encode(key.public_key).decode("ascii"))))
+
+	# Make the NSEC3 chain. Every name in the zone, including "empty
+	# non-terminals" (names with no records of their own but with names
+	# below them), gets an NSEC3 record at the hash of the name that
+	# lists the types at the name and points to the next hash in order.
+	rrsets[(origin, "NSEC3PARAM")] = [(struct.pack("!BBHB", 1, 0, 0, 0), "1 0 0 -")]
+	names = { }
+	for owner, rtype in rrsets:
+		names.setdefault(owner, set()).add(get_rrtype_number(rtype))
+		name = owner
+		while name != origin:
+			name = name.split(".", 1)[1]
+			names.setdefault(name, set())
+	hashes = sorted((nsec3_hash(name), name) for name in names)
+	for i, (h, name) in enumerate(hashes):
+		rtypes = names[name]
+		if rtypes: rtypes = rtypes | { RRTYPES["RRSIG"] }
+		next_hash = hashes[(i + 1) % len(hashes)][0]
+		rdata = struct.pack("!BBHB", 1, 0, 0, 0) + bytes([len(next_hash)]) + next_hash + type_bitmap(rtypes)
+		value = "1 0 0 - %s %s" % (
+			base64.b32encode(next_hash).decode("ascii").translate(BASE32HEX),
+			" ".join(t for t in sorted(RRTYPES, key = lambda t : RRTYPES[t]) if RRTYPES[t] in rtypes))
+		owner = base64.b32encode(h).decode("ascii").translate(BASE32HEX) + "." + origin
+		rrsets[(owner, "NSEC3")] = [(rdata, value)]
+
+	# Sign each RRset, with the KSK for the DNSKEYs (and the ZSK too, like
+	# ldns-signzone) and with the ZSK for everything else. Use a saved
+	# signature if the RRset hasn't changed and it won't expire soon.
+	sigcache_fn = zonefile + ".rrsigs"
+	try:
+		with open(sigcache_fn) as f:
+			old_sigs = json.load(f)
+	except (FileNotFoundError, ValueError):
+		old_sigs = { }
+	new_sigs = { }
+
+	inception = now - SIGNATURE_INCEPTION_OFFSET
+	expiration = now + SIGNATURE_VALIDITY
+	reuse_until = now + SIGNATURE_REUSE_MARGIN
+	if renew_before is not None and renew_before > reuse_until:
+		reuse_until = renew_before
+	signer_wire = name_to_wire(origin)
+	soonest_expiration = None
+	signed = []
+	for (owner, rtype), rrs in sorted(rrsets.items()):
+		type_number = get_rrtype_number(rtype)
+		owner_wire = name_to_wire(owner)
+		ttl = TTL
+		labels = len(owner.split(".")) - (1 if owner.startswith("*.") else 0)
+
+		# The RRset in canonical form (RFC 4034 6.3): sorted by RDATA, without duplicates.
+		rrs = sorted(dict(rrs).items())
+		rrset_wire = b"".join(
+			owner_wire + struct.pack("!HHIH", type_number, 1, ttl, len(rdata)) + rdata
+			for rdata, value in rrs)
+		rrset_digest = hashlib.sha256(rrset_wire).hexdigest()
+
+		rrsigs = []
+		for key in ((ksk, zsk) if rtype == "DNSKEY" else (zsk,)):
+			cache_key = "%s %s %d %d %s" % (owner, rtype, key.algorithm, key.key_tag, rrset_digest)
+			sig = old_sigs.get(cache_key)
+			if sig is None or parse_time(sig[1]) < reuse_until:
+				rrsig_rdata = struct.pack("!HBBIIIH", type_number, key.algorithm, labels, ttl,
+					to_timestamp(expiration), to_timestamp(inception), key.key_tag) + signer_wire
+				sig = [format_time(inception), format_time(expiration),
+					base64.b64encode(key.sign(rrsig_rdata + rrset_wire)).decode("ascii")]
+			new_sigs[cache_key] = sig
+			rrsigs.append("%s %d %d %d %s %s %d %s. %s" % (rtype, key.algorithm, labels, ttl, sig[1], sig[0], key.key_tag, origin, sig[2]))
+			if soonest_expiration is None or sig[1] < soonest_expiration[1]:
+				soonest_expiration = (sig[0], sig[1])
+
+		signed.append((owner, ttl, rtype, [value for rdata, value in rrs], rrsigs))
+
+	# Write the signed zone. Names in record values that aren't absolute
+	# are relative to the zone, as in the unsigned zone file.
+	zone = "$ORIGIN %s.\n$TTL %d\n" % (origin, TTL)
+	for owner, ttl, rtype, values, rrsigs in sorted(signed, key = lambda rrset : rrset[2] != "SOA"):
+		for value in values:
+			zone += "%s.\t%d\tIN\t%s\t%s\n" % (owner, ttl, rtype, value)
+		for rrsig in rrsigs:
+			zone += "%s.\t%d\tIN\tRRSIG\t%s\n" % (owner, ttl, rrsig)
+	write_file(zonefile + ".signed", zone)
+	write_file(sigcache_fn, json.dumps(new_sigs, indent=0, sort_keys=True))
+
+	# Write the DS record, which the user gives to their registrar so that
+	# resolvers can trust the KSK. Use SHA256 (digest type 2).
+	ds = hashlib.sha256(signer_wire + ksk.rdata).hexdigest().upper()
+	write_file(zonefile + ".ds", "%s.\t3600\tIN\tDS\t%d %d 2 %s\n" % (origin, ksk.key_tag, ksk.algorithm, ds))
+
+	return soonest_expiration
+
+def write_file(fn, content):
+	# Replace the file all at once so nsd never sees half of it.
+	with open(fn + ".tmp", "w") as f:
+		f.write(content)
+	os.rename(fn + ".tmp", fn)
+
+def format_time(dt):
+	return dt.strftime("%Y%m%d%H%M%S")
+
+def parse_time(s):
+	return datetime.datetime.strptime(s, "%Y%m%d%H%M%S")
+
+def to_timestamp(dt):
+	return int((dt - datetime.datetime(1970, 1, 1)).total_seconds())
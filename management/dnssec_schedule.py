@@ -0,0 +1,117 @@
+# Decides when DNS zones need to be signed again.
+#
+# DNSSEC signatures expire, so every zone has to be re-signed before its
+# signatures do even if nothing in it changes. When a zone is signed, we
+# note in a small database when its signatures start and expire and pick
+# a time to re-sign it. That time is somewhere between RESIGN_WINDOW and
+# RESIGN_MARGIN before the signatures expire, chosen at random. Zones
+# that were all signed at once (a new box, a key change) would otherwise
+# all come due on the same day every month. With the random choice, how
+# long each zone goes between signings differs, so after a few rounds the
+# zones are re-signed on different days across the month.
+#
+# The database is at /var/lib/mailinabox/dnssec-signing.sqlite. The zone
+# files themselves aren't read to find out when they expire.
+##########################################################################
+
+import os, os.path, sqlite3, datetime, random, heapq
+
+SIGNING_STATE_DB = "/var/lib/mailinabox/dnssec-signing.sqlite"
+
+# Zones are re-signed at a random time between RESIGN_WINDOW and
+# RESIGN_MARGIN before their signatures expire. Signing happens when the
+# DNS is updated, which is at least daily (see setup/dns.sh), so the
+# margin leaves a few chances to re-sign before the signatures expire.
+RESIGN_MARGIN = datetime.timedelta(days=3)
+RESIGN_WINDOW = datetime.timedelta(days=15)
+
+TIME_FORMAT = "%Y%m%d%H%M%S"
+
+def format_time(dt):
+	return dt.strftime(TIME_FORMAT)
+
+def parse_time(s):
+	return datetime.datetime.strptime(s, TIME_FORMAT)
+
+def choose_resign_time(inception, expiration):
+	# Pick a random time to re-sign a zone whose signatures are good from
+	# inception to expiration (datetimes in UTC), within RESIGN_WINDOW and
+	# RESIGN_MARGIN of the expiration but not in the first half of the
+	# signatures' validity period.
+	latest = expiration - RESIGN_MARGIN
+	earliest = max(expiration - RESIGN_WINDOW, inception + (expiration - inception) / 2)
+	if earliest >= latest:
+		return latest
+	return earliest + (latest - earliest) * random.random()
+
+class SigningState:
+	# When each zone's signatures start and expire and when the zone is
+	# to be re-signed, as YYYYMMDDHHMMSS times in UTC like in RRSIG records.
+
+	def __init__(self, fn=None):
+		fn = fn or SIGNING_STATE_DB
+		os.makedirs(os.path.dirname(fn), exist_ok=True)
+		self.conn = sqlite3.connect(fn, timeout=30, isolation_level=None)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.executescript("""
+			CREATE TABLE IF NOT EXISTS zones (
+				zone TEXT NOT NULL PRIMARY KEY,
+				inception TEXT NOT NULL,
+				expiration TEXT NOT NULL,
+				resign_at TEXT NOT NULL,
+				signed_at TEXT NOT NULL);
+			""")
+
+	def close(self):
+		self.conn.close()
+
+	def get(self, zone):
+		# Returns a dict with inception, expiration, resign_at and signed_at,
+		# or None if we don't know when the zone was signed.
+		c = self.conn.execute("SELECT inception, expiration, resign_at, signed_at FROM zones WHERE zone=?", (zone,))
+		row = c.fetchone()
+		if row is None: return None
+		return dict(zip(("inception", "expiration", "resign_at", "signed_at"), row))
+
+	def get_all(self):
+		c = self.conn.execute("SELECT zone, expiration, resign_at FROM zones")
+		return { zone: { "expiration": expiration, "resign_at": resign_at } for zone, expiration, resign_at in c.fetchall() }
+
+	def set(self, zone, inception, expiration, now=None):
+		# Note that a zone was just signed, with the soonest-expiring of its
+		# signatures good from inception to expiration. If that's when they
+		# expired before (the RRsets that changed got new signatures but the
+		# others were kept), the zone stays scheduled for when it was,
+		# unless that time has passed.
+		now = now or datetime.datetime.utcnow()
+		old = self.get(zone)
+		if old is not None and old["expiration"] == expiration and old["resign_at"] > format_time(now):
+			resign_at = old["resign_at"]
+		else:
+			resign_at = format_time(choose_resign_time(parse_time(inception), parse_time(expiration)))
+		self.conn.execute("INSERT OR REPLACE INTO zones (zone, inception, expiration, resign_at, signed_at) VALUES (?, ?, ?, ?, ?)",
+			(zone, inception, expiration, resign_at, format_time(now)))
+
+	def remove_except(self, zones):
+		# Forget zones that we no longer serve.
+		for zone in set(self.get_all()) - set(zones):
+			self.conn.execute("DELETE FROM zones WHERE zone=?", (zone,))
+
+class ResignScheduler:
+	# The zones in order of when they're to be re-signed, soonest first.
+
+	def __init__(self, signing_state):
+		self.heap = [(state["resign_at"], zone) for zone, state in signing_state.get_all().items()]
+		heapq.heapify(self.heap)
+
+	def pop_due(self, now=None):
+		# Remove and return the zones that are due to be re-signed.
+		now = format_time(now or datetime.datetime.utcnow())
+		due = []
+		while self.heap and self.heap[0][0] <= now:
+			due.append(heapq.heappop(self.heap)[1])
+		return due
+
+	def next_due(self):
+		# Return (resign_at, zone) for the zone due next, or None.
+		return self.heap[0] if self.heap else None
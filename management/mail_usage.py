@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+
+# Measures how much disk space each mail user's mailbox takes up.
+#
+# Mailboxes are Maildirs at STORAGE_ROOT/mail/mailboxes/domain/user (see
+# setup/mail-dovecot.sh). A Maildir never changes a message file once it
+# is written: new mail is a new file, and flag changes and moves are
+# renames. Each of those changes the modification time of the directory
+# holding the file. So if a directory's mtime is the same as when we last
+# looked at it, the files directly in it are the same, and we can use the
+# totals we saved then rather than listing it again. We still look at each
+# of its subdirectories, because a change further down doesn't touch the
+# parent's mtime, but that's just a stat() per folder.
+#
+# That isn't true of the files Dovecot keeps next to cur and new in each
+# folder (its index, cache and log files, dovecot-uidlist) or of messages
+# being written in tmp: they grow in place, which doesn't change the
+# directory's mtime. So outside of cur and new we save only the names of
+# the files and stat() them on every scan.
+#
+# The totals for each directory are saved in STORAGE_ROOT/mail/mailbox-usage.sqlite
+# as we go, so an interrupted first scan picks up where it left off the next
+# time it runs. Domains are scanned in parallel.
+#
+# Usage:
+#   mail_usage.py scan       update the usage of all mailboxes
+#   mail_usage.py            print the usage of all mailboxes, largest first
+##########################################################################
+
+import os, os.path, re, stat, sqlite3, time, concurrent.futures
+
+from mailconfig import get_mail_users
+from utils import shell
+
+# How many domains to scan at once.
+SCAN_THREADS = 4
+
+# Directories modified less than this many seconds before we list them may
+# still be changing within the resolution of the clock, so we list them
+# again next time rather than trust their mtime.
+MTIME_SLACK = 2
+
+# Save our progress at least this often (seconds) during a long scan.
+COMMIT_INTERVAL = 5
+
+def get_database_path(env):
+	return os.path.join(env["STORAGE_ROOT"], "mail/mailbox-usage.sqlite")
+
+def get_mailbox_path(env, email):
+	localpart, domain = email.split("@", 1)
+	return os.path.join(env["STORAGE_ROOT"], "mail/mailboxes", domain, localpart)
+
+def open_database(env):
+	# Each scanning thread opens its own connection. In WAL mode their
+	# writes queue up behind each other rather than failing.
+	conn = sqlite3.connect(get_database_path(env), timeout=30, isolation_level=None)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL")
+	conn.executescript("""
+		CREATE TABLE IF NOT EXISTS directories (
+			path TEXT NOT NULL PRIMARY KEY,
+			email TEXT NOT NULL,
+			mtime_ns INTEGER NOT NULL,
+			bytes INTEGER NOT NULL,
+			files INTEGER NOT NULL,
+			messages INTEGER NOT NULL,
+			subdirs TEXT NOT NULL,
+			growing TEXT NOT NULL);
+		CREATE INDEX IF NOT EXISTS directories_email ON directories (email);
+		CREATE TABLE IF NOT EXISTS usage (
+			email TEXT NOT NULL PRIMARY KEY,
+			bytes INTEGER NOT NULL,
+			messages INTEGER NOT NULL,
+			scanned INTEGER NOT NULL,
+			over_quota INTEGER NOT NULL DEFAULT 0);
+		CREATE INDEX IF NOT EXISTS usage_bytes ON usage (bytes);
+		CREATE TABLE IF NOT EXISTS quotas (
+			email TEXT NOT NULL PRIMARY KEY,
+			bytes INTEGER NOT NULL);
+		""")
+	return conn
+
+# Dovecot puts the size of a message in its file name, as in
+# 1404230815.M39186P16425.box,S=4212,W=4300:2,S, which saves a stat().
+MESSAGE_SIZE = re.compile(r",S=(\d+)")
+
+class DirectoryCache:
+	# The totals we saved for each directory in one mailbox, and the
+	# directories we've listed since, which are written out in batches.
+	def __init__(self, conn, email):
+		self.conn = conn
+		self.email = email
+		self.rows = { row[0]: row[1:] for row in conn.execute(
+			"SELECT path, mtime_ns, bytes, files, messages, subdirs, growing FROM directories WHERE email = ?",
+			(email,)) }
+		self.pending = []
+		self.last_commit = time.time()
+		self.listed = 0
+		self.cached = 0
+
+	def get(self, path, mtime_ns):
+		# Return (bytes, files, messages, subdirs, growing) for the files
+		# directly in path if the directory hasn't changed since we saved it,
+		# else None. bytes doesn't include the files in growing.
+		row = self.rows.get(path)
+		if row is None or row[0] != mtime_ns:
+			return None
+		self.cached += 1
+		return row[1], row[2], row[3], (row[4].split("/") if row[4] else []), (row[5].split("/") if row[5] else [])
+
+	def save(self, path, mtime_ns, bytes, files, messages, subdirs, growing):
+		# If a subdirectory went away, so did everything below it.
+		row = self.rows.get(path)
+		if row is not None and row[4]:
+			for name in set(row[4].split("/")) - set(subdirs):
+				self.pending.append(("delete", os.path.join(path, name)))
+		self.pending.append(("save", path, mtime_ns, bytes, files, messages, "/".join(subdirs), "/".join(growing)))
+		self.listed += 1
+
+		# A mailbox with a huge number of folders is saved in pieces so
+		# that we don't lose our work on it if the scan is interrupted.
+		if time.time() - self.last_commit > COMMIT_INTERVAL:
+			c = self.conn.cursor()
+			c.execute("BEGIN IMMEDIATE")
+			self.flush(c)
+			c.execute("COMMIT")
+
+	def flush(self, c):
+		for update in self.pending:
+			if update[0] == "delete":
+				# The directory and everything under it. ("0" is the character after "/".)
+				c.execute("DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)",
+					(update[1], update[1] + "/", update[1] + "0"))
+			else:
+				c.execute("INSERT OR REPLACE INTO directories (path, email, mtime_ns, bytes, files, messages, subdirs, growing) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+					(update[1], self.email) + update[2:])
+		self.pending = []
+		self.last_commit = time.time()
+
+def scan_directory(path, cache):
+	# Return the total bytes, files and messages in path and all of its
+	# subdirectories.
+	try:
+		st = os.stat(path)
+	except FileNotFoundError:
+		return (0, 0, 0)
+
+	saved = cache.get(path, st.st_mtime_ns)
+	if saved is not None:
+		bytes, files, messages, subdirs, growing = saved
+		for name in growing:
+			try:
+				bytes += os.lstat(os.path.join(path, name)).st_size
+			except FileNotFoundError:
+				pass # deleted since we listed the directory
+	else:
+		bytes, files, messages, subdirs, growing = 0, 0, 0, [], []
+		growing_bytes = 0
+		is_message_dir = os.path.basename(path) in ("cur", "new")
+		for name in os.listdir(path):
+			m = MESSAGE_SIZE.search(name)
+			if is_message_dir and m:
+				# Dovecot doesn't make directories in cur and new, so
+				# this doesn't need a stat() to tell.
+				bytes += int(m.group(1))
+				files += 1
+				messages += 1
+				continue
+			try:
+				entry = os.lstat(os.path.join(path, name))
+			except FileNotFoundError:
+				continue # deleted while we were looking
+			if stat.S_ISDIR(entry.st_mode):
+				subdirs.append(name)
+				continue
+			files += 1
+			if is_message_dir:
+				bytes += entry.st_size
+				messages += 1
+			else:
+				growing_bytes += entry.st_size
+				growing.append(name)
+		subdirs.sort()
+		growing.sort()
+
+		mtime_ns = st.st_mtime_ns
+		if time.time() - st.st_mtime < MTIME_SLACK:
+			mtime_ns = 0 # list it again next time
+		cache.save(path, mtime_ns, bytes, files, messages, subdirs, growing)
+		bytes += growing_bytes
+
+	for name in subdirs:
+		b, f, m = scan_directory(os.path.join(path, name), cache)
+		bytes += b
+		files += f
+		messages += m
+	return (bytes, files, messages)
+
+def scan_domain(env, emails):
+	# Scan the mailboxes of the users in one domain.
+	conn = open_database(env)
+	stats = { "listed": 0, "cached": 0 }
+	try:
+		for email in emails:
+			cache = DirectoryCache(conn, email)
+			bytes, files, messages = scan_directory(get_mailbox_path(env, email), cache)
+
+			c = conn.cursor()
+			c.execute("BEGIN IMMEDIATE")
+			cache.flush(c)
+			c.execute("INSERT OR REPLACE INTO usage (email, bytes, messages, scanned, over_quota) VALUES (?, ?, ?, ?, COALESCE((SELECT over_quota FROM usage WHERE email = ?), 0))",
+				(email, bytes, messages, int(time.time()), email))
+			c.execute("COMMIT")
+
+			stats["listed"] += cache.listed
+			stats["cached"] += cache.cached
+	finally:
+		conn.close()
+	return stats
+
+def scan(env):
+	# Update the usage of every mailbox. Returns counts of the directories
+	# we listed and the ones whose saved totals we reused.
+	users = get_mail_users(env)
+	domains = { }
+	for email in users:
+		domains.setdefault(email.split("@", 1)[1], []).append(email)
+
+	stats = { "listed": 0, "cached": 0 }
+	with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+		for s in pool.map(lambda emails : scan_domain(env, emails), domains.values()):
+			for k in stats:
+				stats[k] += s[k]
+
+	# Forget users that have been removed.
+	conn = open_database(env)
+	try:
+		c = conn.cursor()
+		c.execute("BEGIN IMMEDIATE")
+		c.execute("CREATE TEMP TABLE current_users (email TEXT PRIMARY KEY)")
+		c.executemany("INSERT OR IGNORE INTO current_users VALUES (?)", ((email,) for email in users))
+		c.execute("DELETE FROM directories WHERE email NOT IN (SELECT email FROM current_users)")
+		c.execute("DELETE FROM usage WHERE email NOT IN (SELECT email FROM current_users)")
+		c.execute("DROP TABLE current_users")
+		c.execute("COMMIT")
+	finally:
+		conn.close()
+
+	check_quotas(env)
+	return stats
+
+# Quotas.
+#
+# A quota is not enforced by the mail server. After each scan, each user
+# that has gone over their quota, or come back under it, is passed to each
+# function in quota_hooks as hook(env, email, over_quota, bytes, quota), and,
+# if QUOTA_HOOK is set in /etc/mailinabox.conf, to that program as
+#   $QUOTA_HOOK email over|under bytes quota
+
+quota_hooks = []
+
+def run_quota_hook_program(env, email, over_quota, bytes, quota):
+	if env.get("QUOTA_HOOK"):
+		shell("check_call", [env["QUOTA_HOOK"], email, "over" if over_quota else "under", str(bytes), str(quota)])
+
+quota_hooks.append(run_quota_hook_program)
+
+def check_quotas(env):
+	conn = open_database(env)
+	try:
+		changes = conn.execute("""
+			SELECT usage.email, usage.bytes, quotas.bytes, usage.bytes > quotas.bytes
+			FROM usage LEFT JOIN quotas ON usage.email = quotas.email
+			WHERE over_quota != COALESCE(usage.bytes > quotas.bytes, 0)""").fetchall()
+		for email, bytes, quota, over_quota in changes:
+			over_quota = bool(over_quota)
+			for hook in quota_hooks:
+				try:
+					hook(env, email, over_quota, bytes, quota)
+				except Exception as e:
+					print("quota hook failed for %s: %s" % (email, e))
+			with conn:
+				conn.execute("UPDATE usage SET over_quota = ? WHERE email = ?", (int(over_quota), email))
+	finally:
+		conn.close()
+	return changes
+
+def set_quota(email, quota, env):
+	# Set a user's quota in bytes, or with quota None, remove it. The hooks
+	# run the next time the mailboxes are scanned.
+	if email not in get_mail_users(env):
+		return ("That's not a user (%s).\n" % email, 400)
+	conn = open_database(env)
+	try:
+		with conn:
+			if quota is None:
+				conn.execute("DELETE FROM quotas WHERE email = ?", (email,))
+			else:
+				conn.execute("INSERT OR REPLACE INTO quotas (email, bytes) VALUES (?, ?)", (email, quota))
+	finally:
+		conn.close()
+	return "OK"
+
+def get_mail_usage(env, sort="size", limit=None):
+	# Returns a list of (email, bytes, messages, quota, scanned) for users whose
+	# mailboxes have been scanned, largest first or, with sort="email", by address.
+	order = { "size": "usage.bytes DESC, usage.email", "email": "usage.email" }[sort]
+	conn = open_database(env)
+	try:
+		return conn.execute(
+			"SELECT usage.email, usage.bytes, usage.messages, quotas.bytes, usage.scanned FROM usage LEFT JOIN quotas ON usage.email = quotas.email ORDER BY "
+			+ order + " LIMIT ?", (limit if limit is not None else -1,)).fetchall()
+	finally:
+		conn.close()
+
+if __name__ == "__main__":
+	import sys
+	from utils import load_environment, exclusive_process
+	env = load_environment()
+	if len(sys.argv) > 1 and sys.argv[1] == "scan":
+		exclusive_process("mail-usage")
+		start = time.time()
+		stats = scan(env)
+		if "-v" in sys.argv:
+			print("listed %d directories, reused %d, in %.1f seconds" % (stats["listed"], stats["cached"], time.time() - start))
+	else:
+		for email, bytes, messages, quota, scanned in get_mail_usage(env):
+			print("%s\t%d\t%d\t%s" % (email, bytes, messages, quota if quota is not None else ""))
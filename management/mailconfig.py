@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 
-import subprocess, shutil, os, sqlite3, re
+import subprocess, shutil, os, os.path, sqlite3, re, csv, json, hashlib
 import utils
+from database import transaction, query, connection
+from password_hash import hash_password, hash_passwords
 
 def validate_email(email, strict):
 	# There are a lot of characters permitted in email addresses, but
@@ -26,85 +28,222 @@ def validate_email(email, strict):
 
 	return re.match(ADDR_SPEC, email)
 
-def open_database(env, with_connection=False):
-	conn = sqlite3.connect(env["STORAGE_ROOT"] + "/mail/users.sqlite")
-	if not with_connection:
-		return conn.cursor()
-	else:
-		return conn, conn.cursor()
-
 def get_mail_users(env):
-	c = open_database(env)
-	c.execute('SELECT email FROM users')
-	return [row[0] for row in c.fetchall()]
+	return [row[0] for row in query(env, 'SELECT email FROM users')]
 
 def get_mail_aliases(env):
-	c = open_database(env)
-	c.execute('SELECT source, destination FROM aliases')
-	return [(row[0], row[1]) for row in c.fetchall()]
-
-def get_mail_domains(env, filter_aliases=lambda alias : True):
-	def get_domain(emailaddr):
-		return emailaddr.split('@', 1)[1]
-	return set(
-		   [get_domain(addr) for addr in get_mail_users(env)]
-		 + [get_domain(source) for source, target in get_mail_aliases(env) if filter_aliases((source, target)) ]
-		 )
-
-def add_mail_user(email, pw, env):
+	return [(row[0], row[1]) for row in query(env, 'SELECT source, destination FROM aliases')]
+
+def get_change_counter(env):
+	# A number that goes up whenever the lists of users or aliases change
+	# (but not when passwords change). It's maintained by triggers.
+	return query(env, 'SELECT value FROM change_counter')[0][0]
+
+def list_rows(env, table, key, columns, after=None, limit=None, domain=None, prefix=None):
+	# Query a page of rows from one of our tables in order by the `key` column,
+	# starting just after the `after` key, limited to keys on `domain` and/or
+	# starting with `prefix`. Each of these uses an index, so a page costs the
+	# same however big the table is. Returns a generator that yields the rows
+	# as they're read so that large lists don't have to be held in memory. It
+	# holds a connection from the pool until it's finished or closed.
+	where = []
+	params = []
+	if domain:
+		where.append("domain = ?")
+		params.append(domain)
+	if prefix:
+		# A range on the key rather than LIKE so that the index is used. The
+		# upper bound is the prefix with its last character incremented.
+		where.append("%s >= ? AND %s < ?" % (key, key))
+		params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+	if after:
+		where.append("%s > ?" % key)
+		params.append(after)
+
+	sql = "SELECT %s FROM %s" % (", ".join(columns), table)
+	if len(where) > 0:
+		sql += " WHERE " + " AND ".join(where)
+	sql += " ORDER BY " + key
+	if limit is not None:
+		sql += " LIMIT ?"
+		params.append(limit)
+
+	with connection(env) as conn:
+		c = conn.execute(sql, params)
+		try:
+			for row in c:
+				yield row
+		finally:
+			c.close()
+
+def list_mail_users(env, **kwargs):
+	return (row[0] for row in list_rows(env, "users", "email", ["email"], **kwargs))
+
+def list_mail_aliases(env, **kwargs):
+	return list_rows(env, "aliases", "source", ["source", "destination"], **kwargs)
+
+def list_mail_domains(env, after=None, limit=None, prefix=None):
+	return (row[0] for row in list_rows(env, "domains", "domain", ["domain"], after=after, limit=limit, prefix=prefix))
+
+def get_mail_domains(env):
+	# The domains table is kept up to date by triggers on the users and
+	# aliases tables, so this doesn't have to look at every address.
+	return set(row[0] for row in query(env, 'SELECT domain FROM domains'))
+
+def add_mail_user(email, pw, env, do_kick=True):
 	if not validate_email(email, True):
 		return ("Invalid email address.", 400)
 
-	# get the database
-	conn, c = open_database(env, with_connection=True)
-
 	# hash the password
-	pw = utils.shell('check_output', ["/usr/bin/doveadm", "pw", "-s", "SHA512-CRYPT", "-p", pw]).strip()
+	pw = hash_password(pw)
 
-	# add the user to the database
+	# add the user to the database, and write it before the next step
 	try:
-		c.execute("INSERT INTO users (email, password) VALUES (?, ?)", (email, pw))
+		with transaction(env) as c:
+			c.execute("INSERT INTO users (email, password) VALUES (?, ?)", (email, pw))
 	except sqlite3.IntegrityError:
 		return ("User already exists.", 400)
-		
-	# write databasebefore next step
-	conn.commit()
 
 	# Create the user's INBOX and Spam folders and subscribe them.
-
-	# Check if the mailboxes exist before creating them. When creating a user that had previously
-	# been deleted, the mailboxes will still exist because they are still on disk.
 	try:
-		existing_mboxes = utils.shell('check_output', ["doveadm", "mailbox", "list", "-u", email, "-8"], capture_stderr=True).split("\n")
+		init_user_mailboxes(email)
 	except subprocess.CalledProcessError as e:
-		c.execute("DELETE FROM users WHERE email=?", (email,))
-		conn.commit()
+		with transaction(env) as c:
+			c.execute("DELETE FROM users WHERE email=?", (email,))
 		return ("Failed to initialize the user: " + e.output.decode("utf8"), 400)
 
+	if not do_kick:
+		return "mail user added"
+
+	# Update things in case any new domains are added.
+	return kick(env, "mail user added")
+
+def init_user_mailboxes(email):
+	# Check if the mailboxes exist before creating them. When creating a user that had previously
+	# been deleted, the mailboxes will still exist because they are still on disk.
+	existing_mboxes = utils.shell('check_output', ["doveadm", "mailbox", "list", "-u", email, "-8"], capture_stderr=True).split("\n")
+
 	if "INBOX" not in existing_mboxes: utils.shell('check_call', ["doveadm", "mailbox", "create", "-u", email, "-s", "INBOX"])
 	if "Spam" not in existing_mboxes: utils.shell('check_call', ["doveadm", "mailbox", "create", "-u", email, "-s", "Spam"])
 
+def read_bulk_users(f, format):
+	# Read (row number, email, password) tuples from a CSV or JSON batch. `f` is a text
+	# stream. CSV batches have one "email,password" row per line (an optional
+	# header row naming those two columns is skipped) and are read lazily so
+	# that large uploads aren't held in memory twice. JSON batches are a list
+	# of {"email": ..., "password": ...} objects. Raises ValueError (or
+	# csv.Error) if the batch can't be read at all.
+	if format == "json":
+		batch = json.load(f)
+		if not isinstance(batch, list):
+			raise ValueError("A JSON batch must be a list of objects.")
+		for i, row in enumerate(batch, start=1):
+			if not isinstance(row, dict):
+				yield (i, None, None)
+			else:
+				yield (i, row.get("email"), row.get("password"))
+
+	elif format == "csv":
+		for i, row in enumerate(csv.reader(f), start=1):
+			if len(row) == 0: continue # blank line
+			if i == 1 and [r.strip().lower() for r in row] == ["email", "password"]: continue # header
+			if len(row) != 2:
+				yield (i, None, None)
+			else:
+				yield (i, row[0].strip(), row[1])
+
+	else:
+		raise ValueError("Unknown batch format: %s" % format)
+
+def add_mail_users_bulk(rows, env, do_kick=True):
+	# Add many mail users at once. `rows` is an iterable of (row number, email,
+	# password) tuples, e.g. from read_bulk_users. Every row is validated before anything
+	# is written, all of the valid rows are inserted in a single transaction,
+	# and DNS/web are updated once at the end rather than once per user.
+	# Rows that can't be added are reported by row number but don't prevent
+	# the other rows from being added.
+
+	failures = []
+	def fail(i, email, message):
+		failures.append((i, "row %d%s: %s\n" % (i, (" (%s)" % email) if email else "", message)))
+
+	# Validate everything up front.
+	users = []
+	seen = set()
+	for i, email, pw in rows:
+		if not isinstance(email, str) or not isinstance(pw, str):
+			fail(i, email, "Row must have an email address and a password.")
+		elif not validate_email(email, True):
+			fail(i, email, "Invalid email address.")
+		elif pw.strip() == "":
+			fail(i, email, "No password provided.")
+		elif email in seen:
+			fail(i, email, "User appears more than once in the batch.")
+		else:
+			seen.add(email)
+			users.append((i, email, pw))
+
+	# Hash the passwords, in parallel.
+	pw_hashes = hash_passwords(pw for i, email, pw in users)
+	users = [(i, email, pw_hash) for (i, email, pw), pw_hash in zip(users, pw_hashes)]
+
+	# Insert all of the users in one transaction. Users that already exist
+	# are skipped and reported.
+	added = []
+	with transaction(env) as c:
+		for i, email, pw in users:
+			try:
+				c.execute("INSERT INTO users (email, password) VALUES (?, ?)", (email, pw))
+			except sqlite3.IntegrityError:
+				fail(i, email, "User already exists.")
+				continue
+			added.append((i, email))
+
+	# Create each new user's INBOX and Spam folders. If that fails, back
+	# out just that user.
+	not_initialized = []
+	for i, email in added:
+		try:
+			init_user_mailboxes(email)
+		except subprocess.CalledProcessError as e:
+			fail(i, email, "Failed to initialize the user: " + e.output.decode("utf8").strip())
+			not_initialized.append(email)
+	if len(not_initialized) > 0:
+		with transaction(env) as c:
+			c.executemany("DELETE FROM users WHERE email=?", [(email,) for email in not_initialized])
+
+	result = "".join(message for i, message in sorted(failures))
+	result += "%d mail users added, %d failed" % (len(added) - len(not_initialized), len(failures))
+
+	if len(added) == len(not_initialized):
+		# Nothing was added, so there is nothing to update.
+		return (result + "\n", 400)
+
+	if not do_kick:
+		return result
+
 	# Update things in case any new domains are added.
-	return kick(env, "mail user added")
+	return kick(env, result)
 
 def set_mail_password(email, pw, env):
 	# hash the password
-	pw = utils.shell('check_output', ["/usr/bin/doveadm", "pw", "-s", "SHA512-CRYPT", "-p", pw]).strip()
+	pw = hash_password(pw)
 
 	# update the database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with transaction(env) as c:
+		c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 	return "OK"
 
-def remove_mail_user(email, env):
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM users WHERE email=?", (email,))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+def remove_mail_user(email, env, do_kick=True):
+	with transaction(env) as c:
+		c.execute("DELETE FROM users WHERE email=?", (email,))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
+
+	if not do_kick:
+		return "mail user removed"
 
 	# Update things in case any domains are removed.
 	return kick(env, "mail user removed")
@@ -113,29 +252,237 @@ def add_mail_alias(source, destination, env, do_kick=True):
 	if not validate_email(source, False):
 		return ("Invalid email address.", 400)
 
-	conn, c = open_database(env, with_connection=True)
 	try:
-		c.execute("INSERT INTO aliases (source, destination) VALUES (?, ?)", (source, destination))
+		with transaction(env) as c:
+			c.execute("INSERT INTO aliases (source, destination) VALUES (?, ?)", (source, destination))
+			update_alias_expansions(c, [source], strict=True)
 	except sqlite3.IntegrityError:
 		return ("Alias already exists (%s)." % source, 400)
-	conn.commit()
+	except ValueError as e:
+		return (str(e), 400)
 
-	if do_kick:
-		# Update things in case any new domains are added.
-		return kick(env, "alias added")
+	if not do_kick:
+		return "alias added"
+
+	# Update things in case any new domains are added.
+	return kick(env, "alias added")
 
 def remove_mail_alias(source, env, do_kick=True):
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM aliases WHERE source=?", (source,))
-	if c.rowcount != 1:
-		return ("That's not an alias (%s)." % source, 400)
-	conn.commit()
+	with transaction(env) as c:
+		c.execute("DELETE FROM aliases WHERE source=?", (source,))
+		if c.rowcount != 1:
+			return ("That's not an alias (%s)." % source, 400)
+		update_alias_expansions(c, [source])
+
+	if not do_kick:
+		return "alias removed"
+
+	# Update things in case any domains are removed.
+	return kick(env, "alias removed")
+
+# Postfix resolves an alias whose destination is another alias one lookup at
+# a time. To save it the trouble, the alias_expansions table holds, for each
+# alias, the addresses it ultimately delivers to, and Postfix looks aliases
+# up there instead (see setup/mail-users.sh). We also refuse to create aliases
+# that would form a forwarding loop or expand to too many addresses.
+ALIAS_MAX_DEPTH = 100 # aliases of aliases of aliases...
+ALIAS_MAX_EXPANSION = 1000 # same as Postfix's virtual_alias_expansion_limit
+
+def parse_alias_destinations(destination):
+	# The destination of an alias is a comma-separated list of addresses.
+	return [d.strip() for d in destination.split(",") if d.strip() != ""]
+
+def expand_alias(aliases, source, memo, path=()):
+	# Return the set of final addresses that an alias delivers to, given a dict
+	# of all aliases mapping sources to lists of destinations. Raises ValueError
+	# if the alias is part of a loop or expands to too many addresses. `memo`
+	# is a dict of expansions already computed.
+	if source in memo:
+		return memo[source]
+	if source in path:
+		raise ValueError("Aliases would form a forwarding loop: %s." % " => ".join(path[path.index(source):] + (source,)))
+	if len(path) >= ALIAS_MAX_DEPTH:
+		raise ValueError("Aliases are nested more than %d deep at %s." % (ALIAS_MAX_DEPTH, source))
+
+	expansion = set()
+	for d in aliases[source]:
+		if d == source or d not in aliases:
+			# Not an alias, or, like Postfix, an alias that includes itself
+			# delivers to the address itself rather than looping.
+			expansion.add(d)
+		else:
+			expansion |= expand_alias(aliases, d, memo, path + (source,))
+		if len(expansion) > ALIAS_MAX_EXPANSION:
+			raise ValueError("%s would forward to more than %d addresses." % (source, ALIAS_MAX_EXPANSION))
+
+	memo[source] = expansion
+	return expansion
+
+def update_alias_expansions(c, changed_sources, strict=False):
+	# Update the alias_expansions table after the aliases in changed_sources
+	# were added, changed or removed, using the cursor `c` of the transaction
+	# that changed them. Only those aliases and the aliases that lead to them
+	# are re-expanded. If `strict` is set, a loop or an expansion that is too
+	# large raises ValueError (and the caller should roll back). Otherwise
+	# those aliases are stored unexpanded and Postfix deals with them the old
+	# way, one hop at a time.
+	#
+	# The alias_destinations table has a row for each address in each alias's
+	# destination, indexed by the address, so the aliases that lead to an
+	# alias are found without reading the whole aliases table. Bring it up to
+	# date for the changed aliases first.
+	changed_sources = set(changed_sources)
+	c.executemany("DELETE FROM alias_destinations WHERE source=?", [(source,) for source in changed_sources])
+	for source, destination in select_in(c, "SELECT source, destination FROM aliases WHERE source IN (%s)", changed_sources):
+		c.executemany("INSERT OR IGNORE INTO alias_destinations (source, destination) VALUES (?, ?)",
+			[(source, d) for d in parse_alias_destinations(destination)])
+
+	# Find the aliases that lead to the changed ones, a level at a time.
+	affected = set(changed_sources)
+	todo = changed_sources
+	while len(todo) > 0:
+		referrers = set(row[0] for row in select_in(c, "SELECT source FROM alias_destinations WHERE destination IN (%s)", todo))
+		todo = referrers - affected
+		affected |= todo
+
+	# Load those aliases and the aliases they lead to, which is all that
+	# expand_alias needs to see.
+	aliases = { }
+	looked_up = set()
+	todo = affected
+	while len(todo) > 0:
+		looked_up |= todo
+		for source, destination in select_in(c, "SELECT source, destination FROM aliases WHERE source IN (%s)", todo):
+			aliases[source] = parse_alias_destinations(destination)
+		todo = set(d for source in todo if source in aliases for d in aliases[source]) - looked_up
+
+	# Expand them.
+	memo = { }
+	rows = []
+	for source in sorted(affected):
+		if source not in aliases: continue # removed
+		try:
+			expansion = expand_alias(aliases, source, memo)
+		except ValueError:
+			if strict: raise
+			expansion = aliases[source]
+		rows.extend((source, d) for d in sorted(set(expansion)))
+
+	c.executemany("DELETE FROM alias_expansions WHERE source=?", [(source,) for source in affected])
+	c.executemany("INSERT INTO alias_expansions (source, destination) VALUES (?, ?)", rows)
+
+def select_in(c, sql, values):
+	# Run a query with an "IN (%s)" for the values, in batches so as not to
+	# go over SQLite's limit on the number of parameters, and return all of
+	# the rows.
+	values = sorted(values)
+	rows = []
+	for i in range(0, len(values), 500):
+		batch = values[i:i + 500]
+		c.execute(sql % ", ".join("?" for v in batch), batch)
+		rows.extend(c.fetchall())
+	return rows
+
+def reconcile_system_aliases(env):
+	# Create hostmaster@ for the primary domain and postmaster@ and admin@
+	# for every domain we serve mail on, if they don't already exist, and
+	# remove the postmaster@ and admin@ aliases we created on domains we
+	# no longer have any other email addresses for. The new aliases go to
+	# administrator@, which the user is responsible for setting and keeping
+	# up to date. postmaster@ is assumed to exist by our Postfix configuration.
+	# admin@ isn't anything, but it might save the user some trouble e.g. when
+	# buying an SSL certificate.
+	#
+	# Rather than checking each alias one at a time, this compares the set of
+	# system aliases there should be with the set there are and makes all of
+	# the changes in one transaction. Returns a dict with lists of the
+	# (source, target) aliases "added" and "removed".
 
-	if do_kick:
-		# Update things in case any domains are removed.
-		return kick(env, "alias removed")
+	administrator = "administrator@" + env['PRIMARY_HOSTNAME']
+	hostmaster = "hostmaster@" + env['PRIMARY_HOSTNAME']
+
+	with transaction(env) as c:
+		# Get the existing aliases that might be system aliases. The ranges
+		# select sources starting with "postmaster@" or "admin@" using the
+		# index on source. ("A" is the character after "@".)
+		c.execute("SELECT source, destination FROM aliases WHERE source = ? OR (source >= 'postmaster@' AND source < 'postmasterA') OR (source >= 'admin@' AND source < 'adminA')", (hostmaster,))
+		existing = dict(c.fetchall())
+
+		# Which domains do we serve mail on? Every domain that has a user or
+		# an alias, except ones for which the only email on that domain is
+		# a postmaster/admin alias to the administrator. hostmaster@ always
+		# exists (or is about to), so PRIMARY_HOSTNAME is always one of them.
+		auto_alias_count = { }
+		for source, target in existing.items():
+			user, domain = source.split("@", 1)
+			if user in ("postmaster", "admin") and target == administrator:
+				auto_alias_count[domain.lower()] = auto_alias_count.get(domain.lower(), 0) + 1
+		c.execute("SELECT domain, users, aliases FROM domains")
+		real_mail_domains = set(domain for domain, users, aliases in c.fetchall()
+			if users > 0 or aliases > auto_alias_count.get(domain.lower(), 0))
+		real_mail_domains.add(env['PRIMARY_HOSTNAME'])
+
+		# The aliases that should exist.
+		required = set([hostmaster])
+		for domain in real_mail_domains:
+			required.add("postmaster@" + domain)
+			required.add("admin@" + domain)
+
+		# Diff. Domain names are case-insensitive.
+		existing_lower = set(source.lower() for source in existing)
+		real_mail_domains_lower = set(domain.lower() for domain in real_mail_domains)
+		added = [(source, administrator) for source in sorted(required) if source.lower() not in existing_lower]
+		removed = [(source, target) for source, target in sorted(existing.items())
+			if source.split("@", 1)[0] in ("postmaster", "admin")
+			and source.split("@", 1)[1].lower() not in real_mail_domains_lower
+			and target == administrator]
+
+		c.executemany("INSERT INTO aliases (source, destination) VALUES (?, ?)", added)
+		c.executemany("DELETE FROM aliases WHERE source=?", [(source,) for source, target in removed])
+		update_alias_expansions(c, [source for source, target in added + removed])
+
+	return { "added": added, "removed": removed }
+
+# Where kick() saves the fingerprint of what the DNS and web configuration
+# were last generated from.
+KICK_FINGERPRINT_FILE = "/var/lib/mailinabox/kick-fingerprint"
+
+def get_generation_fingerprint(env):
+	# Make a hash of everything that the DNS zones and nginx configuration
+	# are generated from: the domains we serve mail for, the box's settings,
+	# the user's custom DNS and web settings, the SSL certificates (by file
+	# modification time, since they are only ever replaced whole) and the
+	# DKIM key. If this doesn't change, neither would the generated files.
+	h = hashlib.sha256()
+	def add(name, value):
+		h.update(("%s=%s\n" % (name, value)).encode("utf8"))
+
+	for domain in sorted(get_mail_domains(env)):
+		add("domain", domain)
+	for key in ("PRIMARY_HOSTNAME", "PUBLIC_IP", "PUBLIC_IPV6", "CSR_COUNTRY"):
+		add(key, env.get(key, ""))
+
+	for fn in ("dns/custom.yaml", "www/custom.yaml", "mail/dkim/mail.txt", "mail/dkim/mail.private"):
+		fn = os.path.join(env["STORAGE_ROOT"], fn)
+		if os.path.exists(fn):
+			with open(fn, "rb") as f:
+				add(fn, hashlib.sha256(f.read()).hexdigest())
+
+	for path, dirs, files in os.walk(os.path.join(env["STORAGE_ROOT"], "ssl")):
+		dirs.sort()
+		for fn in sorted(files):
+			st = os.stat(os.path.join(path, fn))
+			add(os.path.join(path, fn), "%d %d" % (st.st_mtime_ns, st.st_size))
+
+	return h.hexdigest()
+
+def kick(env, mail_result=None, force=False, progress=None):
+	# Create any missing system aliases and update the DNS and web
+	# configuration in case any domains are added/removed. Unless `force`
+	# is set, the DNS and web updates are skipped when nothing they are
+	# generated from has changed, which is the case for most changes to
+	# mail users (e.g. a second mailbox on a domain we already have).
 
-def kick(env, mail_result=None):
 	results = []
 
 	# Inclde the current operation's result in output.
@@ -143,60 +490,46 @@ def kick(env, mail_result=None):
 	if mail_result is not None:
 		results.append(mail_result + "\n")
 
-	# Create hostmaster@ for the primary domain if it does not already exist.
-	# Default the target to administrator@ which the user is responsible for
-	# setting and keeping up to date.
-
-	existing_aliases = get_mail_aliases(env)
-
-	administrator = "administrator@" + env['PRIMARY_HOSTNAME']
-
-	def ensure_admin_alias_exists(source):
-		# Does this alias exists?
-		for s, t in existing_aliases:
-			if s == source:
-				return
-
-		# Doesn't exist.
-		add_mail_alias(source, administrator, env, do_kick=False)
-		results.append("added alias %s (=> %s)\n" % (source, administrator))
-
-	ensure_admin_alias_exists("hostmaster@" + env['PRIMARY_HOSTNAME'])
-
-	# Get a list of domains we serve mail for, except ones for which the only
-	# email on that domain is a postmaster/admin alias to the administrator.
-
-	real_mail_domains = get_mail_domains(env,
-		filter_aliases = lambda alias : \
-			(not alias[0].startswith("postmaster@") \
-			 and not alias[0].startswith("admin@")) \
-			or alias[1] != administrator \
-			)
-
-	# Create postmaster@ and admin@ for all domains we serve mail on.
-	# postmaster@ is assumed to exist by our Postfix configuration. admin@
-	# isn't anything, but it might save the user some trouble e.g. when
-	# buying an SSL certificate.
-	for domain in real_mail_domains:
-		ensure_admin_alias_exists("postmaster@" + domain)
-		ensure_admin_alias_exists("admin@" + domain)
-
-	# Remove auto-generated hostmaster/postmaster/admin on domains we no
-	# longer have any other email addresses for.
-	for source, target in existing_aliases:
-		user, domain = source.split("@")
-		if user in ("postmaster", "admin") and domain not in real_mail_domains \
-			and target == administrator:
-			remove_mail_alias(source, env, do_kick=False)
-			results.append("removed alias %s (was to %s; domain no longer used for email)\n" % (source, target))
+	# Create or remove the hostmaster@, postmaster@ and admin@ aliases.
+	changes = reconcile_system_aliases(env)
+	for source, target in changes["added"]:
+		results.append("added alias %s (=> %s)\n" % (source, target))
+	for source, target in changes["removed"]:
+		results.append("removed alias %s (was to %s; domain no longer used for email)\n" % (source, target))
 
 	# Update DNS and nginx in case any domains are added/removed.
 
-	from dns_update import do_dns_update
-	results.append( do_dns_update(env) )
-
-	from web_update import do_web_update
-	results.append( do_web_update(env) )
+	domains = get_mail_domains(env)
+	fingerprint = get_generation_fingerprint(env)
+	if not force and os.path.exists(KICK_FINGERPRINT_FILE):
+		with open(KICK_FINGERPRINT_FILE) as f:
+			if f.read().strip() == fingerprint:
+				return "".join(s for s in results if s != "")
+
+	# The DNS and web updates write the files of nsd, OpenDKIM and nginx,
+	# and then the services whose files changed are reloaded, all at once.
+	# If an update fails, what the other wrote is still loaded.
+	from service_reload import ServiceReloads
+	reloads = ServiceReloads()
+	try:
+		from dns_update import do_dns_update
+		results.append( do_dns_update(env, force=force, reloads=reloads) )
+
+		from web_update import do_web_update
+		results.append( do_web_update(env, reloads=reloads, progress=progress) )
+	finally:
+		reloads.run()
+
+	# Save the fingerprint only after both updates succeeded. The web update
+	# may have made certificates, which are among the inputs, so take it
+	# again now or else the next kick would never match. Mail users can be
+	# changed while the updates run, though, so if the domains changed keep
+	# the fingerprint from before, and the next kick will regenerate.
+	if get_mail_domains(env) == domains:
+		fingerprint = get_generation_fingerprint(env)
+	os.makedirs(os.path.dirname(KICK_FINGERPRINT_FILE), exist_ok=True)
+	with open(KICK_FINGERPRINT_FILE, "w") as f:
+		f.write(fingerprint + "\n")
 
 	return "".join(s for s in results if s != "")
 
@@ -210,6 +543,9 @@ if __name__ == "__main__":
 			sys.exit(1)
 
 	if len(sys.argv) > 1 and sys.argv[1] == "update":
+		# Pass --force to regenerate the DNS and web configuration even if
+		# nothing seems to have changed.
 		from utils import load_environment
-		print(kick(load_environment()))
+		print(kick(load_environment(), force="--force" in sys.argv,
+			progress=lambda message : print(message + "...", file=sys.stderr)))
 
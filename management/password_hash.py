@@ -0,0 +1,73 @@
+# Hashes mail user passwords in the {SHA512-CRYPT} format that Dovecot's
+# passdb expects (see setup/mail-users.sh). This is the same glibc crypt(3)
+# scheme that `doveadm pw -s SHA512-CRYPT` produces, but computed here in
+# the management daemon rather than by starting a doveadm process for
+# every password.
+########################################################################
+
+import os, threading, warnings
+
+from utils import shell, process_pool
+
+# The crypt module is deprecated in Python 3.11 and gone in 3.13. Without
+# it, passwords are hashed by doveadm.
+try:
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore", DeprecationWarning)
+		import crypt
+except ImportError:
+	crypt = None
+
+SCHEME = "SHA512-CRYPT"
+
+def hash_password(pw):
+	# crypt(3) supports SHA512 ($6$) hashes on every glibc we run on, but
+	# if for some reason it doesn't, or we can't call it, let doveadm do it.
+	if crypt is None or crypt.METHOD_SHA512 not in crypt.methods:
+		return hash_password_doveadm(pw)
+	return "{" + SCHEME + "}" + crypt.crypt(pw, crypt.mksalt(crypt.METHOD_SHA512))
+
+def hash_password_doveadm(pw):
+	# The old way.
+	return shell('check_output', ["/usr/bin/doveadm", "pw", "-s", SCHEME, "-p", pw]).strip()
+
+def verify_password_doveadm(pw_hash, pw):
+	# Ask Dovecot whether it accepts a hash for a password. Returns True
+	# if it does.
+	code, output = shell('check_output', ["/usr/bin/doveadm", "pw", "-t", pw_hash, "-p", pw], capture_stderr=True, trap=True)
+	return code == 0
+
+# Hashing is CPU-bound and the GIL keeps threads from helping, so batches
+# of passwords (e.g. bulk imports and mass resets) are spread over a pool
+# of worker processes, one per core (see utils.process_pool). The pool is
+# started the first time it's needed and then kept around.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = process_pool(os.cpu_count() or 1)
+		return _pool
+
+def hash_passwords(pws):
+	# Hash a list of passwords, returning the hashes in the same order.
+	pws = list(pws)
+	if len(pws) < 2:
+		# Not worth the round trip to the pool.
+		return [hash_password(pw) for pw in pws]
+
+	# Send the passwords to the workers in chunks, a few per worker, rather
+	# than one at a time.
+	workers = os.cpu_count() or 1
+	return get_pool().map(hash_password, pws, chunksize=max(1, len(pws) // (workers * 4)))
+
+if __name__ == "__main__":
+	# Hash a password given on the command line, like `doveadm pw`.
+	import sys
+	if len(sys.argv) != 2:
+		print("Usage: python3 management/password_hash.py password")
+		sys.exit(1)
+	print(hash_password(sys.argv[1]))
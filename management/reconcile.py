@@ -0,0 +1,117 @@
+# Runs kick() -- which creates the system aliases and regenerates the DNS
+# and web configuration after mail users and aliases change -- in a
+# background thread of the management daemon, rather than in the request
+# that made the change.
+#
+# Each change bumps a generation number. The background thread waits until
+# no further changes have come in for a short time (the debounce window) and
+# then runs kick() once for all of the changes that came in before it started,
+# so fifty API calls in a row cause one regeneration rather than fifty.
+# Clients that need to know when their change is live can ask for the status
+# and wait until the completed generation reaches theirs. If kick() fails, the
+# generation it was run for is reported as failed rather than completed, and
+# it's tried again with the next change.
+########################################################################
+
+import threading, time, traceback
+
+class Reconciler:
+	def __init__(self, env, debounce=2.0, max_delay=30.0):
+		self.env = env
+		self.debounce = debounce # seconds to wait for more changes
+		self.max_delay = max_delay # but don't put off a change longer than this
+
+		# Held while kick() or anything else that regenerates the system
+		# configuration is running, so that they don't step on each other.
+		self.exclusive = threading.Lock()
+
+		self.condition = threading.Condition()
+		self.requested = 0 # the latest generation asked for
+		self.running = None # the generation being worked on now, if any
+		self.attempted = 0 # the latest generation kick() was run for, whether or not it worked
+		self.completed = 0 # the latest generation that has been applied
+		self.first_request_time = None # of the requests not yet started
+		self.last_request_time = None
+		self.last_result = None
+		self.last_error = None
+		self.progress = None # how far along the running generation is, if it says
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name="reconciler", daemon=True)
+		self.thread.start()
+
+	def request(self):
+		# Note that a change has been made. Returns the generation number
+		# that the change will be live at.
+		with self.condition:
+			now = time.time()
+			self.requested += 1
+			if self.first_request_time is None:
+				self.first_request_time = now
+			self.last_request_time = now
+			self.condition.notify_all()
+			return self.requested
+
+	def run(self):
+		while True:
+			with self.condition:
+				# Wait for a change.
+				while self.requested == self.attempted:
+					self.condition.wait()
+
+				# Wait until the changes stop coming in.
+				while True:
+					delay = min(self.last_request_time + self.debounce, self.first_request_time + self.max_delay) - time.time()
+					if delay <= 0: break
+					self.condition.wait(delay)
+
+				generation = self.requested
+				self.running = generation
+				self.first_request_time = None
+
+			result, error = None, None
+			try:
+				from mailconfig import kick
+				with self.exclusive:
+					result = kick(self.env, progress=self.set_progress)
+			except Exception as e:
+				traceback.print_exc()
+				error = str(e)
+
+			with self.condition:
+				self.running = None
+				self.progress = None
+				self.attempted = generation
+				if error is None:
+					self.completed = generation
+				self.last_result = result
+				self.last_error = error
+				self.condition.notify_all()
+
+	def set_progress(self, message):
+		with self.condition:
+			self.progress = message
+
+	def status(self):
+		with self.condition:
+			return {
+				# The latest generation not yet started, if there is one.
+				"pending": self.requested if self.requested != self.attempted and self.requested != self.running else None,
+				"running": self.running,
+				"progress": self.progress,
+				"completed": self.completed,
+				# The latest generation that kick() failed on, if it failed
+				# after the last one that was applied.
+				"failed": self.attempted if self.attempted != self.completed else None,
+				"last_result": self.last_result,
+				"last_error": self.last_error,
+			}
+
+	def wait(self, generation, timeout=None):
+		# Wait until kick() has been run for the given generation, or the
+		# timeout (in seconds) passes. Returns whether it was applied, which
+		# it isn't if kick() failed.
+		with self.condition:
+			self.condition.wait_for(lambda : self.attempted >= generation, timeout)
+			return self.completed >= generation
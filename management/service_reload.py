@@ -0,0 +1,143 @@
+# Reloads the services whose configuration files we changed, once each.
+#
+# dns_update.py and web_update.py write configuration files for nsd,
+# OpenDKIM and nginx. Rather than each restarting its service whenever it
+# runs, they write the files through a ServiceReloads, which only replaces
+# a file if its contents changed and notes what the service then needs:
+# a reload (the service re-reads its files without dropping connections
+# or queries) or a restart. kick() and the update functions then call
+# run(), which does the least each changed service needs. Services are
+# independent of each other, so they're reloaded at the same time. A
+# service none of whose files changed isn't touched.
+#
+# A service with a "test" command (nginx) has its new configuration
+# checked first. If the check fails, the files are put back the way they
+# were and the service is left running as it was.
+########################################################################
+
+import os, os.path, concurrent.futures
+
+from utils import shell
+
+# How to reload or restart each service.
+SERVICE_COMMANDS = {
+	"nginx": {
+		# On a reload, nginx starts new workers with the new configuration
+		# and lets the old ones finish their connections (like long-polling
+		# ActiveSync requests) before they exit.
+		"test": ["/usr/sbin/nginx", "-t"],
+		"reload": ["/usr/sbin/nginx", "-s", "reload"],
+		"restart": ["/usr/sbin/service", "nginx", "restart"],
+	},
+	"opendkim": {
+		# OpenDKIM re-reads its configuration, including the KeyTable and
+		# SigningTable, on a reload (SIGUSR1).
+		"reload": ["/usr/sbin/service", "opendkim", "reload"],
+		"restart": ["/usr/sbin/service", "opendkim", "restart"],
+	},
+	"nsd": {
+		"restart": ["/usr/sbin/service", "nsd", "restart"],
+	},
+}
+
+ACTION_ORDER = ["reload", "restart"]
+
+class ServiceReloads:
+	def __init__(self):
+		self.actions = { } # service => "reload" or "restart"
+		self.changed_files = { } # service => { filename: previous contents or None }
+		self.handlers = { } # service => function
+
+	def write_file(self, service, fn, content, action="reload"):
+		# Replace fn with content if it's different and note that service
+		# needs `action` to see it. Returns whether the file changed.
+		previous = read_file_or_none(fn)
+		if previous == content:
+			return False
+		replace_file(fn, content)
+		self.changed_files.setdefault(service, { }).setdefault(fn, previous)
+		self.need(service, action)
+		return True
+
+	def remove_file(self, service, fn, action="reload"):
+		# Remove fn if it exists and note that service needs `action` to see
+		# that it's gone. Returns whether there was a file.
+		previous = read_file_or_none(fn)
+		if previous is None:
+			return False
+		os.unlink(fn)
+		self.changed_files.setdefault(service, { }).setdefault(fn, previous)
+		self.need(service, action)
+		return True
+
+	def restore_files(self, service):
+		# Put back the files of service that we changed.
+		for fn, previous in self.changed_files.get(service, { }).items():
+			if previous is None:
+				if os.path.exists(fn): os.unlink(fn)
+			else:
+				replace_file(fn, previous)
+
+	def need(self, service, action):
+		# Note that service needs at least `action`. A restart covers a reload.
+		current = self.actions.get(service)
+		if current is None or ACTION_ORDER.index(action) > ACTION_ORDER.index(current):
+			self.actions[service] = action
+
+	def set_handler(self, service, handler):
+		# Have run() call handler(action) to bring service up to date instead
+		# of running its command. action is None if none of its files changed.
+		# The handler is called either way and returns a list of what it did.
+		self.handlers[service] = handler
+
+	def run_service(self, service):
+		action = self.actions.get(service)
+		if service in self.handlers:
+			return self.handlers[service](action)
+		commands = SERVICE_COMMANDS[service]
+		if "test" in commands:
+			code, output = shell('check_output', commands["test"], capture_stderr=True, trap=True)
+			if code != 0:
+				self.restore_files(service)
+				raise Exception("the new configuration was put back because it has errors: " + output.strip())
+		shell('check_call', commands[action])
+		return ["%sed %s" % (action, service)]
+
+	def run(self):
+		# Reload or restart the services that need it, all at once. Returns a
+		# list of what was done. If any of them fail, the others are still
+		# done and then an exception is raised.
+		services = sorted(set(self.actions) | set(self.handlers))
+		done = []
+		errors = []
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(services), 1)) as pool:
+			futures = [(service, pool.submit(self.run_service, service)) for service in services]
+			for service, future in futures:
+				try:
+					done.extend(future.result())
+				except Exception as e:
+					errors.append("%s: %s" % (service, e))
+		self.actions.clear()
+		self.handlers.clear()
+		self.changed_files.clear()
+		if len(errors) > 0:
+			raise Exception("Reloading services failed for " + "; ".join(errors))
+		return done
+
+def read_file_or_none(fn):
+	if not os.path.exists(fn):
+		return None
+	with open(fn) as f:
+		return f.read()
+
+def replace_file(fn, content):
+	# Write the new file next to the old one and rename it into place so
+	# the service never reads half of it. Keep the old file's owner and
+	# permissions.
+	with open(fn + ".new", "w") as f:
+		f.write(content)
+	if os.path.exists(fn):
+		st = os.stat(fn)
+		os.chown(fn + ".new", st.st_uid, st.st_gid)
+		os.chmod(fn + ".new", st.st_mode & 0o7777)
+	os.rename(fn + ".new", fn)
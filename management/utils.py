@@ -23,33 +23,115 @@ def safe_domain_name(name):
     import urllib.parse
     return urllib.parse.quote(name, safe='')
 
-def sort_domains(domain_names, env):
-    # Put domain names in a nice sorted order. For web_update, PRIMARY_HOSTNAME
-    # must appear first so it becomes the nginx default server.
-    
-    # First group PRIMARY_HOSTNAME and its subdomains, then parent domains of PRIMARY_HOSTNAME, then other domains.
-    groups = ( [], [], [] )
-    for d in domain_names:
-        if d == env['PRIMARY_HOSTNAME'] or d.endswith("." + env['PRIMARY_HOSTNAME']):
-            groups[0].append(d)
-        elif env['PRIMARY_HOSTNAME'].endswith("." + d):
-            groups[1].append(d)
-        else:
-            groups[2].append(d)
+class DomainTrie:
+    # A set of domain names kept in a tree by their labels from right to
+    # left (com -> example -> www), so that finding the domains above or
+    # below a name takes time in proportion to the number of labels in it
+    # rather than to the number of domains in the set.
 
-    # Within each group, sort parent domains before subdomains and after that sort lexicographically.
-    def sort_group(group):
-        # Find the top-most domains.
-        top_domains = sorted(d for d in group if len([s for s in group if d.endswith("." + s)]) == 0)
+    class Node:
+        __slots__ = ('children', 'name')
+        def __init__(self):
+            self.children = { }
+            self.name = None # set if this node's domain is in the set
+
+    def __init__(self, domain_names=()):
+        self.root = DomainTrie.Node()
+        for d in domain_names:
+            self.add(d)
+
+    def add(self, domain):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.children.setdefault(label, DomainTrie.Node())
+        node.name = domain
+
+    def __contains__(self, domain):
+        node = self.find_node(domain)
+        return node is not None and node.name is not None
+
+    def find_node(self, domain):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.children.get(label)
+            if node is None: return None
+        return node
+
+    def ancestors(self, name):
+        # Return the domains in the set that are name or are above it,
+        # the topmost first.
+        ret = []
+        node = self.root
+        for label in reversed(name.split(".")):
+            node = node.children.get(label)
+            if node is None: break
+            if node.name is not None: ret.append(node.name)
+        return ret
+
+    def find_parent(self, name, topmost=False):
+        # Return the closest domain in the set that is name or is above it
+        # (or with topmost=True, the farthest), or None if there isn't one.
+        # E.g. the DNS zone that a domain is in.
+        ancestors = self.ancestors(name)
+        if len(ancestors) == 0: return None
+        return ancestors[0] if topmost else ancestors[-1]
+
+    def subtree(self, domain):
+        # Return the domains in the set that are below domain (not including it).
+        node = self.find_node(domain)
+        if node is None: return []
+        ret = []
+        stack = list(node.children.values())
+        while stack:
+            node = stack.pop()
+            if node.name is not None: ret.append(node.name)
+            stack.extend(node.children.values())
+        return ret
+
+    def tops(self):
+        # Return the domains in the set that have no other domain in the set
+        # above them.
+        return [node.name for node in self.top_nodes(self.root)]
+
+    def top_nodes(self, node, within=None):
+        # Return the nodes of the domains beneath node that have no domain
+        # above them (and beneath node). If within is given, only domains in
+        # that set count and the others are passed over.
         ret = []
-        for d in top_domains:
-            ret.append(d)
-            ret.extend( sort_group([s for s in group if s.endswith("." + d)]) )
+        stack = list(node.children.values())
+        while stack:
+            node = stack.pop()
+            if node.name is not None and (within is None or node.name in within):
+                ret.append(node)
+            else:
+                stack.extend(node.children.values())
         return ret
-        
-    groups = [sort_group(g) for g in groups]
 
-    return groups[0] + groups[1] + groups[2]
+    def sorted(self, within=None, node=None):
+        # List the domains in the set (or just those in within) with each
+        # domain followed by the domains below it, parent domains before
+        # their subdomains and otherwise alphabetically.
+        ret = []
+        for top in sorted(self.top_nodes(node or self.root, within), key = lambda n : n.name):
+            ret.append(top.name)
+            ret.extend(self.sorted(within, top))
+        return ret
+
+def sort_domains(domain_names, env):
+    # Put domain names in a nice sorted order, with PRIMARY_HOSTNAME first.
+
+    # First group PRIMARY_HOSTNAME and its subdomains, then parent domains of PRIMARY_HOSTNAME, then other domains.
+    trie = DomainTrie(domain_names)
+    groups = ( set(), set(), set() )
+    primary = trie.find_node(env['PRIMARY_HOSTNAME'])
+    if primary is not None:
+        if primary.name is not None: groups[0].add(primary.name)
+        groups[0].update(trie.subtree(env['PRIMARY_HOSTNAME']))
+    groups[1].update(d for d in trie.ancestors(env['PRIMARY_HOSTNAME']) if d != env['PRIMARY_HOSTNAME'])
+    groups[2].update(d for d in domain_names if d not in groups[0] and d not in groups[1])
+
+    # Within each group, sort parent domains before subdomains and after that sort lexicographically.
+    return trie.sorted(groups[0]) + trie.sorted(groups[1]) + trie.sorted(groups[2])
 
 def exclusive_process(name):
     # Ensure that a process named `name` does not execute multiple
@@ -149,6 +231,24 @@ def shell(method, cmd_args, env={}, capture_stderr=False, return_bytes=False, tr
     else:
         return code, ret
 
+def process_pool(processes):
+    # A pool of worker processes for CPU-bound work. The management daemon
+    # runs threads, and a worker forked from it could start out with a
+    # copy of a lock that another thread was holding at the time, which
+    # nothing would ever release. So the workers are forked from a fork
+    # server instead, which has no threads. (ProcessPoolExecutor can be
+    # told to do that only in Python 3.7 and later.)
+    import multiprocessing
+    return multiprocessing.get_context("forkserver").Pool(processes)
+
+def submit_to_pool(pool, func, *args):
+    # Like Executor.submit, for a pool made by process_pool, so that the
+    # result can be waited on with concurrent.futures.wait.
+    import concurrent.futures
+    future = concurrent.futures.Future()
+    pool.apply_async(func, args, callback=future.set_result, error_callback=future.set_exception)
+    return future
+
 def create_syslog_handler():
     import logging.handlers
     handler = logging.handlers.SysLogHandler(address='/dev/log')
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+# Precompresses the static files of the websites we serve.
+#
+# nginx serves a file's .gz sibling, if there is one, to clients that
+# accept gzip (gzip_static in conf/nginx.conf) instead of compressing the
+# file again for every request. So for each text-like file in the web
+# roots under STORAGE_ROOT/www we make a .gz file next to it, and a .br
+# (Brotli) file too if the brotli module is installed.
+#
+# Which files we compressed, and their sizes and modification times when
+# we did, are kept in STORAGE_ROOT/www/.precompress-manifest.json, so a
+# file is only compressed again when it changes. Compressed files whose
+# original has gone away are removed. A .gz or .br file that we didn't
+# make (that isn't in the manifest) is left alone, unless it's older than
+# its original.
+#
+# Our compressed files get the modification time of their original. So
+# whatever the manifest says, a compressed file older than its original
+# is out of date, and is removed as soon as we see it, so that nginx
+# serves the original until the new compressed file is ready.
+#
+# This runs hourly from cron, since the files of a site can change without
+# the web configuration changing, and is started in the background when
+# the web configuration changes so that new sites don't wait for cron.
+# Only one runs at a time.
+#
+# Usage:
+#   web_precompress.py       compress new and changed files of all sites
+##########################################################################
+
+import os, os.path, io, json, gzip, fcntl, contextlib, concurrent.futures
+
+try:
+	import brotli
+except ImportError:
+	brotli = None # no .br files
+
+# How many files to compress at once.
+PRECOMPRESS_THREADS = 4
+
+# The kinds of files worth compressing. Images, WOFF fonts and archives
+# are compressed already.
+COMPRESSIBLE_EXTENSIONS = {
+	".html", ".htm", ".css", ".js", ".mjs", ".json", ".map", ".svg",
+	".xml", ".rss", ".atom", ".txt", ".md", ".csv", ".ico", ".wasm",
+	".ttf", ".otf", ".eot",
+}
+
+# Smaller files aren't worth it: the compressed file might not be smaller,
+# and either way it fits in a packet or two.
+MIN_SIZE = 1024
+
+def get_manifest_path(env):
+	return os.path.join(env["STORAGE_ROOT"], "www/.precompress-manifest.json")
+
+@contextlib.contextmanager
+def lock_precompress(env):
+	with open(get_manifest_path(env) + ".lock", "w") as lockfile:
+		fcntl.flock(lockfile, fcntl.LOCK_EX)
+		yield
+
+def gzip_compress(data):
+	# gzip.compress only takes mtime in Python 3.8 and later. A zero mtime
+	# in the header makes the output the same whenever it's compressed.
+	buf = io.BytesIO()
+	with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0) as f:
+		f.write(data)
+	return buf.getvalue()
+
+def get_encoders():
+	# The compressed files to make, by extension.
+	encoders = { ".gz": gzip_compress }
+	if brotli is not None:
+		encoders[".br"] = lambda data : brotli.compress(data, quality=11)
+	return encoders
+
+def is_compressible(fn):
+	return os.path.splitext(fn)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+def remove_stale_outputs(path, st, previous_outputs, exts):
+	# Remove the compressed files of path, whose os.stat is st, that are out
+	# of date: ours if they don't have the original's mtime, and anyone's if
+	# they're older than the original. Returns whether any were removed
+	# and the extensions of the ones that are left that we didn't make.
+	removed = False
+	not_ours = []
+	for ext in exts:
+		try:
+			out_mtime_ns = os.stat(path + ext).st_mtime_ns
+		except FileNotFoundError:
+			continue
+		if ext in previous_outputs:
+			stale = out_mtime_ns != st.st_mtime_ns
+		else:
+			stale = out_mtime_ns < st.st_mtime_ns
+		if stale:
+			try:
+				os.unlink(path + ext)
+			except FileNotFoundError:
+				pass
+			removed = True
+		elif ext not in previous_outputs:
+			not_ours.append(ext)
+	return removed, not_ours
+
+def compress_file(path, st, not_ours, previous_outputs, encoders):
+	# Make the compressed files of path, whose os.stat is st, except the
+	# ones in not_ours, which someone else made. Returns the extensions of
+	# the compressed files we made. previous_outputs are the ones we made
+	# last time.
+	with open(path, "rb") as f:
+		data = f.read()
+
+	outputs = []
+	for ext, encoder in sorted(encoders.items()):
+		out = path + ext
+		if ext in not_ours:
+			continue
+
+		compressed = encoder(data)
+		if len(compressed) >= len(data):
+			continue # no point, and the old one is removed below
+
+		# Write it next to the original and rename it into place so nginx
+		# never serves half of it. Give it the original's owner and times
+		# so it's served with the same Last-Modified.
+		with open(out + ".tmp", "wb") as f:
+			f.write(compressed)
+		os.chown(out + ".tmp", st.st_uid, st.st_gid)
+		os.chmod(out + ".tmp", st.st_mode & 0o777)
+		os.utime(out + ".tmp", ns=(st.st_atime_ns, st.st_mtime_ns))
+		os.rename(out + ".tmp", out)
+		outputs.append(ext)
+
+	# Remove compressed files we made before but not this time.
+	for ext in previous_outputs:
+		if ext not in outputs and ext not in not_ours and os.path.exists(path + ext):
+			os.unlink(path + ext)
+
+	return outputs
+
+def precompress_site(root, manifest, pool, encoders):
+	# Compress the new and changed files in the web root. manifest has what
+	# we compressed in it last time, and is replaced with what's in it now.
+	# Returns how many files were compressed.
+	files = { }
+	jobs = { }
+	for dirpath, dirnames, filenames in os.walk(root):
+		dirnames.sort()
+		for fn in sorted(filenames):
+			if not is_compressible(fn): continue
+			path = os.path.join(dirpath, fn)
+			rel = os.path.relpath(path, root)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue # removed since we listed the directory
+
+			# Out-of-date compressed files go first, before anything else,
+			# so nginx stops serving them.
+			entry = manifest.get(rel)
+			previous_outputs = entry["outputs"] if entry is not None else []
+			removed, not_ours = remove_stale_outputs(path, st, previous_outputs, set(encoders) | set(previous_outputs))
+			if st.st_size < MIN_SIZE: continue
+
+			# If it hasn't changed since we compressed it (with the same
+			# encoders) and the compressed files are still there, there's
+			# nothing to do.
+			if not removed and entry is not None and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size \
+				and entry["encoders"] == sorted(encoders) \
+				and all(os.path.exists(path + ext) for ext in entry["outputs"]):
+				files[rel] = entry
+				continue
+
+			jobs[pool.submit(compress_file, path, st, not_ours, previous_outputs, encoders)] = (rel, st)
+
+	for job in concurrent.futures.as_completed(jobs):
+		rel, st = jobs[job]
+		try:
+			outputs = job.result()
+		except OSError:
+			# Try it again next time. Keep the old entry so that its
+			# compressed files are still ours.
+			if rel in manifest: files[rel] = manifest[rel]
+			continue
+		files[rel] = { "mtime_ns": st.st_mtime_ns, "size": st.st_size, "encoders": sorted(encoders), "outputs": outputs }
+
+	# Remove the compressed files of files that are gone (or too small now).
+	for rel, entry in manifest.items():
+		if rel in files: continue
+		for ext in entry["outputs"]:
+			try:
+				os.unlink(os.path.join(root, rel) + ext)
+			except FileNotFoundError:
+				pass
+
+	manifest.clear()
+	manifest.update(files)
+	return len(jobs)
+
+def precompress_sites(roots, env):
+	# Compress the new and changed files in each of the web roots. Returns
+	# how many files were compressed.
+	manifest_fn = get_manifest_path(env)
+	if not os.path.isdir(os.path.dirname(manifest_fn)):
+		return 0 # no websites
+	# The cron job and a web update could otherwise both be writing the
+	# same compressed files and the manifest.
+	with lock_precompress(env):
+		try:
+			with open(manifest_fn) as f:
+				manifest = json.load(f)
+		except (OSError, ValueError):
+			manifest = { }
+
+		# Sites we don't serve anymore keep their entries, so that if they're
+		# served again their compressed files are still known to be ours.
+		encoders = get_encoders()
+		count = 0
+		new_manifest = dict(manifest)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=PRECOMPRESS_THREADS) as pool:
+			for root in sorted(set(roots)):
+				if not os.path.isdir(root): continue
+				key = os.path.relpath(root, os.path.dirname(manifest_fn))
+				site_manifest = manifest.get(key, { })
+				count += precompress_site(root, site_manifest, pool, encoders)
+				new_manifest[key] = site_manifest
+
+		with open(manifest_fn + ".tmp", "w") as f:
+			json.dump(new_manifest, f, indent=1, sort_keys=True)
+		os.rename(manifest_fn + ".tmp", manifest_fn)
+		return count
+
+if __name__ == "__main__":
+	from utils import load_environment, exclusive_process
+	from web_update import get_web_domains, get_web_root
+	exclusive_process("web-precompress")
+	env = load_environment()
+	precompress_sites([get_web_root(domain, env) for domain in get_web_domains(env)], env)
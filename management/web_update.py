@@ -1,11 +1,36 @@
-# Creates an nginx configuration file so we serve HTTP/HTTPS on all
+# Creates nginx configuration files so we serve HTTP/HTTPS on all
 # domains for which a mail account has been set up.
+#
+# Each domain gets its own file in /etc/nginx/conf.d/local/, which
+# /etc/nginx/conf.d/local.conf includes. Only the files of domains whose
+# configuration changed are rewritten, and then nginx is reloaded (not
+# restarted), so a change to one domain doesn't drop anyone's connections.
 ########################################################################
 
-import os, os.path, re, rtyaml
+import os, os.path, re, glob, subprocess, concurrent.futures, rtyaml
 
 from mailconfig import get_mail_domains
 from utils import shell, safe_domain_name, sort_domains
+from service_reload import ServiceReloads
+
+NGINX_CONF = "/etc/nginx/conf.d/local.conf"
+NGINX_DOMAINS_DIR = "/etc/nginx/conf.d/local"
+NGINX_CACHE_DIR = "/var/cache/nginx"
+
+# How nginx picks a server for each request in an upstream with more than
+# one, by the `balance` option in www/custom.yaml.
+UPSTREAM_BALANCE = {
+	"round_robin": None, # nginx's default
+	"least_conn": "least_conn",
+	"ip_hash": "ip_hash",
+}
+
+# How many self-signed certificates to make at once.
+CERTIFICATE_THREADS = os.cpu_count() or 1
+
+# How many idle connections to each upstream nginx keeps open (per worker)
+# unless the upstream says otherwise.
+UPSTREAM_KEEPALIVE = 16
 
 def get_web_domains(env):
 	# What domains should we serve HTTP/HTTPS for?
@@ -17,50 +42,184 @@ def get_web_domains(env):
 	# Ensure the PRIMARY_HOSTNAME is in the list.
 	domains.add(env['PRIMARY_HOSTNAME'])
 
-	# Sort the list. Put PRIMARY_HOSTNAME first so it becomes the
-	# default server (nginx's default_server).
+	# Sort the list, with PRIMARY_HOSTNAME first.
 	domains = sort_domains(domains, env)
 
 	return domains
 	
 
-def do_web_update(env):
-	# Build an nginx configuration file.
-	nginx_conf = ""
+def start_precompress():
+	# Start web_precompress.py without waiting for it to finish. If it's
+	# already running, the new one exits (see utils.exclusive_process).
+	subprocess.Popen([os.path.join(os.path.dirname(os.path.abspath(__file__)), "web_precompress.py")],
+		stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def do_web_update(env, reloads=None, progress=None):
+	# nginx is reloaded if its configuration changes, by `reloads` (see
+	# service_reload.py) when its owner runs it, or here if none is given.
+	# progress, if given, is called with a message about how far along a
+	# long step is.
+	run_reloads = reloads is None
+	if run_reloads:
+		reloads = ServiceReloads()
+
+	# The domains to serve and the user's customizations, if any.
+	domains = get_web_domains(env)
+	custom = get_web_custom_config(env)
+
+	# Make self-signed certificates for new domains first, all at once. A
+	# domain we couldn't make one for is left out of the configuration
+	# (nginx wouldn't start with it) until it can be made.
+	certificate_errors = provision_ssl_certificates(domains, env, progress)
+	domains = [domain for domain in domains if domain not in certificate_errors]
+
+	# The main file has the upstreams that domains can proxy to and includes
+	# the domains' files.
+	nginx_conf = make_upstreams_config(custom)
+	nginx_conf += "include %s/*.conf;\n" % NGINX_DOMAINS_DIR
+	changed = reloads.write_file("nginx", NGINX_CONF, nginx_conf, "reload")
+
+	# Write each domain's file, if it changed. A reload is enough for nginx
+	# to see the new files (and certificates) and doesn't drop connections.
+	os.makedirs(NGINX_DOMAINS_DIR, exist_ok=True)
 	template = open(os.path.join(os.path.dirname(__file__), "../conf/nginx.conf")).read()
-	for domain in get_web_domains(env):
-		nginx_conf += make_domain_config(domain, template, env)
-
-	# Did the file change? If not, don't bother writing & restarting nginx.
-	nginx_conf_fn = "/etc/nginx/conf.d/local.conf"
-	if os.path.exists(nginx_conf_fn):
-		with open(nginx_conf_fn) as f:
-			if f.read() == nginx_conf:
-				return ""
+	filenames = set()
+	for domain in domains:
+		fn = safe_domain_name(domain) + ".conf"
+		filenames.add(fn)
+		if reloads.write_file("nginx", os.path.join(NGINX_DOMAINS_DIR, fn), make_domain_config(domain, template, custom, env), "reload"):
+			changed = True
+
+	# Remove the files of domains we no longer serve (or can't yet).
+	for fn in os.listdir(NGINX_DOMAINS_DIR):
+		if fn.endswith(".conf") and fn not in filenames:
+			reloads.remove_file("nginx", os.path.join(NGINX_DOMAINS_DIR, fn), "reload")
+			changed = True
+
+	# Compress the static files of new sites (see web_precompress.py). That
+	# can take a while, so it's done in the background rather than keeping
+	# the caller waiting, and it doesn't need nginx to be reloaded. Files
+	# that change later are compressed by the hourly cron job.
+	if changed:
+		start_precompress()
+
+	if changed and run_reloads:
+		reloads.run()
+
+	# Now that the other domains are served, report the ones that aren't.
+	if len(certificate_errors) > 0:
+		raise Exception("Making a self-signed certificate failed for " + "; ".join(
+			"%s: %s" % (domain, error) for domain, error in sorted(certificate_errors.items())))
+
+	# If nothing changed, nginx wasn't reloaded.
+	if not changed:
+		return ""
 
-	# Save the file.
-	with open(nginx_conf_fn, "w") as f:
-		f.write(nginx_conf)
+	return "web updated\n"
 
-	# Kick nginx.
-	shell('check_call', ["/usr/sbin/service", "nginx", "restart"])
+def get_web_custom_config(env):
+	# Read the user's customizations in STORAGE_ROOT/www/custom.yaml, e.g.:
+	#
+	#   upstreams:
+	#     myapp:
+	#       servers: [127.0.0.1:8000, 127.0.0.1:8001]
+	#       balance: least_conn   # or round_robin (the default) or ip_hash
+	#       keepalive: 32         # idle connections to keep open, 0 for none
+	#       cache: 10m            # or { ttl: 10m, max_size: 1g }
+	#   mydomain.com:
+	#     proxy: myapp            # an upstream above, or a URL
+	#
+	# Proxying to an upstream reuses connections to it instead of opening
+	# a new one for each request.
+	fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
+	if not os.path.exists(fn):
+		return { }
+	with open(fn) as f:
+		return rtyaml.load(f) or { }
+
+def get_upstreams(custom):
+	upstreams = custom.get("upstreams") or { }
+	for name in upstreams:
+		if not re.match(r"^[A-Za-z0-9_-]+$", name):
+			raise ValueError("Invalid upstream name in www/custom.yaml: %s" % name)
+	return upstreams
+
+def get_upstream_cache(upstream):
+	# Returns the TTL and maximum size of an upstream's cache, or None if
+	# responses from it aren't cached.
+	cache = upstream.get("cache")
+	if not cache:
+		return None
+	if not isinstance(cache, dict):
+		cache = { "ttl": cache }
+	ttl, max_size = str(cache.get("ttl", "10m")), str(cache.get("max_size", "1g"))
+	if not re.match(r"^\d+[smhd]?$", ttl) or not re.match(r"^\d+[kmg]?$", max_size, re.I):
+		raise ValueError("Invalid cache setting in www/custom.yaml: %s" % cache)
+	return ttl, max_size
+
+def make_upstreams_config(custom):
+	nginx_conf = ""
+	for name, upstream in sorted(get_upstreams(custom).items()):
+		servers = upstream.get("servers") or []
+		if isinstance(servers, str): servers = [servers]
+		if len(servers) == 0:
+			raise ValueError("Upstream %s in www/custom.yaml has no servers." % name)
+		balance = upstream.get("balance", "round_robin")
+		if balance not in UPSTREAM_BALANCE:
+			raise ValueError("Invalid balance for upstream %s in www/custom.yaml: %s" % (name, balance))
+		keepalive = int(upstream.get("keepalive", UPSTREAM_KEEPALIVE))
+
+		nginx_conf += "upstream %s {\n" % name
+		if UPSTREAM_BALANCE[balance]:
+			nginx_conf += "\t%s;\n" % UPSTREAM_BALANCE[balance]
+		for server in servers:
+			nginx_conf += "\tserver %s;\n" % server
+		if keepalive > 0:
+			nginx_conf += "\tkeepalive %d;\n" % keepalive
+		nginx_conf += "}\n"
+
+		# nginx makes the cache directory itself (as the user its workers run
+		# as), but not its parent.
+		cache = get_upstream_cache(upstream)
+		if cache:
+			os.makedirs(NGINX_CACHE_DIR, exist_ok=True)
+			nginx_conf += "proxy_cache_path %s/mailinabox-%s levels=1:2 keys_zone=mailinabox_%s:10m max_size=%s inactive=%s;\n" \
+				% (NGINX_CACHE_DIR, name, name, cache[1], cache[0])
+	return nginx_conf
 
-	return "web updated\n"
+def make_proxy_config(proxy, custom):
+	# The location block that proxies a domain to an upstream or a URL.
+	upstream = get_upstreams(custom).get(proxy)
+	if upstream is None:
+		return "\tlocation / {\n\t\tproxy_pass %s;\n\t}\n" % proxy
+
+	# To keep connections to the upstream open between requests, nginx has
+	# to use HTTP/1.1 and not pass on the client's Connection header.
+	nginx_conf = "\tlocation / {\n"
+	nginx_conf += "\t\tproxy_pass http://%s;\n" % proxy
+	nginx_conf += "\t\tproxy_http_version 1.1;\n"
+	nginx_conf += "\t\tproxy_set_header Connection \"\";\n"
+	nginx_conf += "\t\tproxy_set_header Host $host;\n"
+	nginx_conf += "\t\tproxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n"
+	nginx_conf += "\t\tproxy_set_header X-Forwarded-Proto $scheme;\n"
+	cache = get_upstream_cache(upstream)
+	if cache:
+		nginx_conf += "\t\tproxy_cache mailinabox_%s;\n" % proxy
+		nginx_conf += "\t\tproxy_cache_valid 200 301 302 %s;\n" % cache[0]
+	nginx_conf += "\t}\n"
+	return nginx_conf
 
-def make_domain_config(domain, template, env):
+def make_domain_config(domain, template, custom, env):
 	# How will we configure this domain.
 
 	# Where will its root directory be for static files?
 
 	root = get_web_root(domain, env)
 
-	# What private key and SSL certificate will we use for this domain?
+	# What private key and SSL certificate will we use for this domain? (It
+	# exists: see provision_ssl_certificates.)
 	ssl_key, ssl_certificate, csr_path = get_domain_ssl_files(domain, env)
 
-	# For hostnames created after the initial setup, ensure we have an SSL certificate
-	# available. Make a self-signed one now if one doesn't exist.
-	ensure_ssl_certificate_exists(domain, ssl_key, ssl_certificate, csr_path, env)
-
 	# Replace substitution strings in the template & return.
 	nginx_conf = template
 	nginx_conf = nginx_conf.replace("$HOSTNAME", domain)
@@ -68,21 +227,29 @@ def make_domain_config(domain, template, env):
 	nginx_conf = nginx_conf.replace("$SSL_KEY", ssl_key)
 	nginx_conf = nginx_conf.replace("$SSL_CERTIFICATE", ssl_certificate)
 
+	# PRIMARY_HOSTNAME is the default server, which answers requests for
+	# names we don't serve.
+	nginx_conf = nginx_conf.replace("$DEFAULT_SERVER", " default_server" if domain == env['PRIMARY_HOSTNAME'] else "")
+
 	# Add in any user customizations.
 	nginx_conf_parts = re.split("(# ADDITIONAL DIRECTIVES HERE\n)", nginx_conf)
-	nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
-	if os.path.exists(nginx_conf_custom_fn):
-		yaml = rtyaml.load(open(nginx_conf_custom_fn))
-		if domain in yaml:
-			yaml = yaml[domain]
-			if "proxy" in yaml:
-				nginx_conf_parts[1] += "\tlocation / {\n\t\tproxy_pass %s;\n\t}\n" % yaml["proxy"]
+	if has_brotli_static():
+		# Serve the precompressed .br files too.
+		nginx_conf_parts[1] += "\tbrotli_static on;\n"
+	if domain in custom:
+		yaml = custom[domain]
+		if "proxy" in yaml:
+			nginx_conf_parts[1] += make_proxy_config(yaml["proxy"], custom)
 
 	# Put it all together.	
 	nginx_conf = "".join(nginx_conf_parts)
 
 	return nginx_conf
 
+def has_brotli_static():
+	# Stock nginx can't serve .br files. It needs the ngx_brotli module.
+	return len(glob.glob("/etc/nginx/modules-enabled/*brotli*")) > 0
+
 def get_web_root(domain, env):
 	# Try STORAGE_ROOT/web/domain_name if it exists, but fall back to STORAGE_ROOT/web/default.
 	for test_domain in (domain, 'default'):
@@ -115,7 +282,7 @@ def get_domain_ssl_files(domain, env):
 		# a Subject Alternative Name matching this domain. Don't do this if
 		# the user has uploaded a different private key for this domain.
 		if not ssl_key_is_alt:
-			from whats_next import check_certificate
+			from certificates import check_certificate
 			if check_certificate(domain, ssl_certificate_primary, None) == "OK":
 				ssl_certificate = ssl_certificate_primary
 
@@ -128,37 +295,72 @@ def get_domain_ssl_files(domain, env):
 
 	return ssl_key, ssl_certificate, csr_path
 
-def ensure_ssl_certificate_exists(domain, ssl_key, ssl_certificate, csr_path, env):
-	# For domains besides PRIMARY_HOSTNAME, generate a self-signed certificate if
+def provision_ssl_certificates(domains, env, progress=None):
+	# For hostnames created after the initial setup, ensure we have an SSL
+	# certificate available. Make self-signed ones for the domains that
+	# don't have one yet. Each takes two runs of openssl, so when many new
+	# domains come at once they're made several at a time. Returns the
+	# domains we couldn't make one for, with the error.
+	missing = []
+	for domain in domains:
+		ssl_key, ssl_certificate, csr_path = get_domain_ssl_files(domain, env)
+		if needs_ssl_certificate(domain, ssl_certificate, env):
+			missing.append((domain, ssl_key, ssl_certificate, csr_path))
+
+	errors = { }
+	if len(missing) == 0:
+		return errors
+	with concurrent.futures.ThreadPoolExecutor(max_workers=CERTIFICATE_THREADS) as pool:
+		futures = { pool.submit(make_self_signed_certificate, domain, ssl_key, ssl_certificate, csr_path, env): domain
+			for domain, ssl_key, ssl_certificate, csr_path in missing }
+		for i, future in enumerate(concurrent.futures.as_completed(futures)):
+			domain = futures[future]
+			try:
+				future.result()
+			except Exception as e:
+				errors[domain] = str(e).strip()
+			if progress:
+				progress("made self-signed certificates for %d of %d new domains" % (i + 1, len(missing)))
+	return errors
+
+def needs_ssl_certificate(domain, ssl_certificate, env):
+	# For domains besides PRIMARY_HOSTNAME, we generate a self-signed certificate if
 	# a certificate doesn't already exist. See setup/mail.sh for documentation.
 
 	if domain == env['PRIMARY_HOSTNAME']:
-		return
+		return False
 
 	# Sanity check. Shouldn't happen. A non-primary domain might use this
 	# certificate (see above), but then the certificate should exist anyway.
 	if ssl_certificate == os.path.join(env["STORAGE_ROOT"], 'ssl/ssl_certificate.pem'):
-		return
+		return False
 
-	if os.path.exists(ssl_certificate):
-		return
+	return not os.path.exists(ssl_certificate)
 
+def make_self_signed_certificate(domain, ssl_key, ssl_certificate, csr_path, env):
 	os.makedirs(os.path.dirname(ssl_certificate), exist_ok=True)
 
 	# Generate a new self-signed certificate using the same private key that we already have.
 
 	# Start with a CSR.
-	shell("check_call", [
+	run_openssl([
 		"openssl", "req", "-new",
 		"-key", ssl_key,
 		"-out",  csr_path,
 		"-subj", "/C=%s/ST=/L=/O=/CN=%s" % (env["CSR_COUNTRY"], domain)])
 
-	# And then make the certificate.
-	shell("check_call", [
+	# And then make the certificate. Write it next to where it goes and then
+	# move it there, so that if openssl fails we don't leave behind a partial
+	# certificate that looks like it exists.
+	run_openssl([
 		"openssl", "x509", "-req",
 		"-days", "365",
 		"-in", csr_path,
 		"-signkey", ssl_key,
-		"-out", ssl_certificate])
+		"-out", ssl_certificate + ".tmp"])
+	os.rename(ssl_certificate + ".tmp", ssl_certificate)
 
+def run_openssl(cmd_args):
+	code, output = shell("check_output", cmd_args, capture_stderr=True, trap=True)
+	if code != 0:
+		raise ValueError(output)
@@ -13,6 +13,7 @@ import dns.reversename, dns.resolver
 from dns_update import get_dns_zones
 from web_update import get_web_domains, get_domain_ssl_files
 from mailconfig import get_mail_domains, get_mail_aliases
+from certificates import check_certificate, get_certificate_info
 
 from utils import shell, sort_domains
 
@@ -227,14 +228,7 @@ def check_ssl_cert(domain, env):
 	cert_status = check_certificate(domain, ssl_certificate, ssl_key)
 
 	if cert_status == "SELF-SIGNED":
-		fingerprint = shell('check_output', [
-			"openssl",
-			"x509",
-			"-in", ssl_certificate,
-			"-noout",
-			"-fingerprint"
-			])
-		fingerprint = re.sub(".*Fingerprint=", "", fingerprint).strip()
+		fingerprint = get_certificate_info(ssl_certificate)["sha1_fingerprint"]
 
 		if domain == env['PRIMARY_HOSTNAME']:
 			print_error("""The SSL certificate for this domain is currently self-signed. You will get a security
@@ -266,95 +260,6 @@ def check_ssl_cert(domain, env):
 		print(cert_status)
 		print("")
 
-def check_certificate(domain, ssl_certificate, ssl_private_key):
-	# Use openssl verify to check the status of a certificate.
-
-	# First check that the certificate is for the right domain. The domain
-	# must be found in the Subject Common Name (CN) or be one of the
-	# Subject Alternative Names.
-	cert_dump = shell('check_output', [
-		"openssl", "x509",
-		"-in", ssl_certificate,
-		"-noout", "-text", "-nameopt", "rfc2253",
-		])
-	cert_dump = cert_dump.split("\n")
-	certificate_names = set()
-	while len(cert_dump) > 0:
-		line = cert_dump.pop(0)
-
-		# Grab from the Subject Common Name. We include the indentation
-		# at the start of the line in case maybe the cert includes the
-		# common name of some other referenced entity (which would be
-		# indented, I hope).
-		m = re.match("        Subject: CN=([^,]+)", line)
-		if m:
-			certificate_names.add(m.group(1))
-	
-		# Grab from the Subject Alternative Name, which is a comma-delim
-		# list of names, like DNS:mydomain.com, DNS:otherdomain.com.
-		m = re.match("            X509v3 Subject Alternative Name:", line)
-		if m:
-			names = re.split(",\s*", cert_dump.pop(0).strip())
-			for n in names:
-				m = re.match("DNS:(.*)", n)
-				if m:
-					certificate_names.add(m.group(1))
-
-	if domain is not None and domain not in certificate_names:
-		return "This certificate is for the wrong domain names. It is for %s." % \
-			", ".join(sorted(certificate_names))
-
-	# Second, check that the certificate matches the private key. Get the modulus of the
-	# private key and of the public key in the certificate. They should match. The output
-	# of each command looks like "Modulus=XXXXX".
-	if ssl_private_key is not None:
-		private_key_modulus = shell('check_output', [
-			"openssl", "rsa",
-			"-inform", "PEM",
-			"-noout", "-modulus",
-			"-in", ssl_private_key])
-		cert_key_modulus = shell('check_output', [
-			"openssl", "x509",
-			"-in", ssl_certificate,
-			"-noout", "-modulus"])
-		if private_key_modulus != cert_key_modulus:
-			return "The certificate installed at %s does not correspond to the private key at %s." % (ssl_certificate, ssl_private_key)
-
-	# Next validate that the certificate is valid. This checks whether the certificate
-	# is self-signed, that the chain of trust makes sense, that it is signed by a CA
-	# that Ubuntu has installed on this machine's list of CAs, and I think that it hasn't
-	# expired.
-
-	# In order to verify with openssl, we need to split out any
-	# intermediary certificates in the chain (if any) from our
-	# certificate (at the top). They need to be passed separately.
-
-	cert = open(ssl_certificate).read()
-	m = re.match(r'(-*BEGIN CERTIFICATE-*.*?-*END CERTIFICATE-*)(.*)', cert, re.S)
-	if m == None:
-		return "The certificate file is an invalid PEM certificate."
-	mycert, chaincerts = m.groups()
-
-	# This command returns a non-zero exit status in most cases, so trap errors.
-
-	retcode, verifyoutput = shell('check_output', [
-		"openssl",
-		"verify", "-verbose",
-		"-purpose", "sslserver", "-policy_check",]
-		+ ([] if chaincerts.strip() == "" else ["-untrusted", "/dev/stdin"])
-		+ [ssl_certificate],
-		input=chaincerts.encode('ascii'),
-		trap=True)
-
-	if "self signed" in verifyoutput:
-		# Certificate is self-signed.
-		return "SELF-SIGNED"
-	elif retcode == 0:
-		# Certificate is OK.
-		return "OK"
-	else:
-		return verifyoutput.strip()
-
 def print_ok(message):
 	print_block(message, first_line="✓  ")
 
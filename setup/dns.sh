@@ -28,6 +28,13 @@ apt_install nsd ldnsutils
 
 sudo mkdir -p /var/run/nsd
 
+# The management daemon adds, removes and reloads zones through nsd's
+# control interface (see management/dns_service.py) rather than by
+# restarting nsd. Create the keys that nsd-control uses to connect.
+if [ ! -f /etc/nsd/nsd_control.key ]; then
+	nsd-control-setup
+fi
+
 # Create DNSSEC signing keys.
 
 mkdir -p "$STORAGE_ROOT/dns/dnssec";
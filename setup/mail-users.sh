@@ -17,9 +17,115 @@ db_path=$STORAGE_ROOT/mail/users.sqlite
 # Create an empty database if it doesn't yet exist.
 if [ ! -f $db_path ]; then
 	echo Creating new user database: $db_path;
-	echo "CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, extra);" | sqlite3 $db_path;
-	echo "CREATE TABLE aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL);" | sqlite3 $db_path;
+	echo "CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, extra, domain TEXT COLLATE NOCASE);" | sqlite3 $db_path;
+	echo "CREATE TABLE aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, domain TEXT COLLATE NOCASE);" | sqlite3 $db_path;
+
+	# The domains table has a row for each domain that we have any users or
+	# aliases on, with a count of each, so that Postfix can check whether we
+	# handle mail for a domain with a single lookup. Triggers keep it in sync
+	# with the users and aliases tables. (Existing databases get this table
+	# in setup/migrate.py.) Domain names are case-insensitive.
+	sqlite3 $db_path << EOF;
+CREATE TABLE domains (domain TEXT NOT NULL PRIMARY KEY COLLATE NOCASE, users INTEGER NOT NULL DEFAULT 0, aliases INTEGER NOT NULL DEFAULT 0);
+CREATE TRIGGER domains_users_insert AFTER INSERT ON users BEGIN
+	INSERT OR IGNORE INTO domains (domain) VALUES (substr(NEW.email, instr(NEW.email, '@') + 1));
+	UPDATE domains SET users = users + 1 WHERE domain = substr(NEW.email, instr(NEW.email, '@') + 1);
+END;
+CREATE TRIGGER domains_users_delete AFTER DELETE ON users BEGIN
+	UPDATE domains SET users = users - 1 WHERE domain = substr(OLD.email, instr(OLD.email, '@') + 1);
+	DELETE FROM domains WHERE domain = substr(OLD.email, instr(OLD.email, '@') + 1) AND users = 0 AND aliases = 0;
+END;
+CREATE TRIGGER domains_users_update AFTER UPDATE OF email ON users BEGIN
+	UPDATE domains SET users = users - 1 WHERE domain = substr(OLD.email, instr(OLD.email, '@') + 1);
+	DELETE FROM domains WHERE domain = substr(OLD.email, instr(OLD.email, '@') + 1) AND users = 0 AND aliases = 0;
+	INSERT OR IGNORE INTO domains (domain) VALUES (substr(NEW.email, instr(NEW.email, '@') + 1));
+	UPDATE domains SET users = users + 1 WHERE domain = substr(NEW.email, instr(NEW.email, '@') + 1);
+END;
+CREATE TRIGGER domains_aliases_insert AFTER INSERT ON aliases BEGIN
+	INSERT OR IGNORE INTO domains (domain) VALUES (substr(NEW.source, instr(NEW.source, '@') + 1));
+	UPDATE domains SET aliases = aliases + 1 WHERE domain = substr(NEW.source, instr(NEW.source, '@') + 1);
+END;
+CREATE TRIGGER domains_aliases_delete AFTER DELETE ON aliases BEGIN
+	UPDATE domains SET aliases = aliases - 1 WHERE domain = substr(OLD.source, instr(OLD.source, '@') + 1);
+	DELETE FROM domains WHERE domain = substr(OLD.source, instr(OLD.source, '@') + 1) AND users = 0 AND aliases = 0;
+END;
+CREATE TRIGGER domains_aliases_update AFTER UPDATE OF source ON aliases BEGIN
+	UPDATE domains SET aliases = aliases - 1 WHERE domain = substr(OLD.source, instr(OLD.source, '@') + 1);
+	DELETE FROM domains WHERE domain = substr(OLD.source, instr(OLD.source, '@') + 1) AND users = 0 AND aliases = 0;
+	INSERT OR IGNORE INTO domains (domain) VALUES (substr(NEW.source, instr(NEW.source, '@') + 1));
+	UPDATE domains SET aliases = aliases + 1 WHERE domain = substr(NEW.source, instr(NEW.source, '@') + 1);
+END;
+EOF
+
+	# The domain columns of the users and aliases tables are filled in by
+	# triggers and indexed along with the address so that the management
+	# daemon can list the addresses on a domain a page at a time. The
+	# change_counter table is bumped whenever the lists of users or aliases
+	# change so that clients polling those lists can tell when they haven't.
+	sqlite3 $db_path << EOF;
+CREATE INDEX users_domain_email ON users (domain, email);
+CREATE INDEX aliases_domain_source ON aliases (domain, source);
+CREATE TRIGGER users_set_domain AFTER INSERT ON users BEGIN
+	UPDATE users SET domain = substr(NEW.email, instr(NEW.email, '@') + 1) WHERE id = NEW.id;
+END;
+CREATE TRIGGER users_update_domain AFTER UPDATE OF email ON users BEGIN
+	UPDATE users SET domain = substr(NEW.email, instr(NEW.email, '@') + 1) WHERE id = NEW.id;
+END;
+CREATE TRIGGER aliases_set_domain AFTER INSERT ON aliases BEGIN
+	UPDATE aliases SET domain = substr(NEW.source, instr(NEW.source, '@') + 1) WHERE id = NEW.id;
+END;
+CREATE TRIGGER aliases_update_domain AFTER UPDATE OF source ON aliases BEGIN
+	UPDATE aliases SET domain = substr(NEW.source, instr(NEW.source, '@') + 1) WHERE id = NEW.id;
+END;
+CREATE TABLE change_counter (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL);
+INSERT INTO change_counter (id, value) VALUES (1, 0);
+CREATE TRIGGER change_counter_users_insert AFTER INSERT ON users BEGIN UPDATE change_counter SET value = value + 1; END;
+CREATE TRIGGER change_counter_users_delete AFTER DELETE ON users BEGIN UPDATE change_counter SET value = value + 1; END;
+CREATE TRIGGER change_counter_users_update AFTER UPDATE OF email ON users BEGIN UPDATE change_counter SET value = value + 1; END;
+CREATE TRIGGER change_counter_aliases_insert AFTER INSERT ON aliases BEGIN UPDATE change_counter SET value = value + 1; END;
+CREATE TRIGGER change_counter_aliases_delete AFTER DELETE ON aliases BEGIN UPDATE change_counter SET value = value + 1; END;
+CREATE TRIGGER change_counter_aliases_update AFTER UPDATE OF source, destination ON aliases BEGIN UPDATE change_counter SET value = value + 1; END;
+EOF
+
+	# The alias_expansions table holds the final addresses each alias
+	# delivers to, following aliases of aliases, and alias_destinations
+	# holds each address in each alias's destination, indexed by address,
+	# to find the aliases that lead to an alias. The management daemon
+	# keeps them up to date (see mailconfig.update_alias_expansions).
+	echo "CREATE TABLE alias_expansions (source TEXT NOT NULL, destination TEXT NOT NULL, PRIMARY KEY (source, destination));" | sqlite3 $db_path;
+	echo "CREATE TABLE alias_destinations (source TEXT NOT NULL, destination TEXT NOT NULL, PRIMARY KEY (source, destination));" | sqlite3 $db_path;
+	echo "CREATE INDEX alias_destinations_destination ON alias_destinations (destination);" | sqlite3 $db_path;
+fi
+
+# Use SQLite's write-ahead log (WAL) journal so that the management daemon's
+# writes don't block Postfix's and Dovecot's lookups (the setting is stored
+# in the database file). Every process that reads a WAL database must be able
+# to write to its -shm file, which SQLite creates with the same owner and
+# permissions as the database file itself, and the first reader to open the
+# database creates it, so they must be able to write to its directory too.
+# Rather than put Postfix in the www-data group (which would give it all of
+# www-data's files), the database, its directory, and its -wal and -shm files
+# belong to a group of their own that Postfix, Dovecot and PHP (for the
+# Roundcube password plugin, see webmail.sh) are members of. The directory is
+# setgid so that the -wal and -shm files get that group whoever creates them.
+echo "PRAGMA journal_mode=WAL;" | sqlite3 $db_path > /dev/null;
+if ! getent group userdb > /dev/null; then
+	groupadd --system userdb
+fi
+usermod -a -G userdb postfix
+usermod -a -G userdb dovecot
+usermod -a -G userdb www-data
+if id -nG postfix | grep -qw www-data; then
+	gpasswd -d postfix www-data > /dev/null # from earlier versions of this script
 fi
+chown root:userdb $STORAGE_ROOT/mail
+chmod 2775 $STORAGE_ROOT/mail
+for f in $db_path $db_path-wal $db_path-shm; do
+	if [ -f $f ]; then
+		chown root:userdb $f
+		chmod 664 $f
+	fi
+done
 
 # User Authentication
 #####################
@@ -80,9 +186,10 @@ tools/editconf.py /etc/postfix/main.cf \
 	local_recipient_maps=\$virtual_mailbox_maps
 
 # SQL statement to check if we handle mail for a domain, either for users or aliases.
+# The domains table is kept up to date by triggers on the users and aliases tables.
 cat > /etc/postfix/virtual-mailbox-domains.cf << EOF;
 dbpath=$db_path
-query = SELECT 1 FROM users WHERE email LIKE '%%@%s' UNION SELECT 1 FROM aliases WHERE source LIKE '%%@%s'
+query = SELECT 1 FROM domains WHERE domain='%s'
 EOF
 
 # SQL statement to check if we handle mail for a user.
@@ -91,10 +198,12 @@ dbpath=$db_path
 query = SELECT 1 FROM users WHERE email='%s'
 EOF
 
-# SQL statement to rewrite an email address if an alias is present.
+# SQL statement to rewrite an email address if an alias is present. The
+# alias_expansions table gives the final addresses in one lookup even when
+# an alias points to other aliases. Postfix joins multiple rows with commas.
 cat > /etc/postfix/virtual-alias-maps.cf << EOF;
 dbpath=$db_path
-query = SELECT destination FROM aliases WHERE source='%s'
+query = SELECT destination FROM alias_expansions WHERE source='%s'
 EOF
 
 # Restart Services
@@ -30,5 +30,25 @@ $(pwd)/management/backup.py
 EOF
 chmod +x /etc/cron.daily/mailinabox-backup
 
+# Keep track of how much disk space each mailbox uses. Only the first
+# scan is slow: after that only the mail folders that changed are read.
+cat > /etc/cron.hourly/mailinabox-mail-usage << EOF;
+#!/bin/bash
+# Mail-in-a-Box --- Do not edit / will be overwritten on update.
+# Measure mailbox disk usage.
+$(pwd)/management/mail_usage.py scan
+EOF
+chmod +x /etc/cron.hourly/mailinabox-mail-usage
+
+# Compress the static files of websites so nginx doesn't have to each
+# time they're requested. Only new and changed files are compressed.
+cat > /etc/cron.hourly/mailinabox-web-precompress << EOF;
+#!/bin/bash
+# Mail-in-a-Box --- Do not edit / will be overwritten on update.
+# Precompress static website files.
+$(pwd)/management/web_precompress.py
+EOF
+chmod +x /etc/cron.hourly/mailinabox-web-precompress
+
 # Start it.
 service mailinabox restart
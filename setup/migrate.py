@@ -45,6 +45,139 @@ def migration_2(env):
 	for fn in glob.glob(os.path.join(env["STORAGE_ROOT"], 'mail/mailboxes/*/*/.dovecot.svbin')):
 		os.unlink(fn)
 
+def migration_3(env):
+	# Add a table of the domains we have users and aliases on, with a count
+	# of each, kept in sync by triggers. Postfix and the management daemon
+	# use it to look up domains without scanning every user and alias. This
+	# is the same as what setup/mail-users.sh creates for new databases.
+	import sqlite3
+	db = sqlite3.connect(os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite"))
+
+	db.execute("CREATE TABLE IF NOT EXISTS domains (domain TEXT NOT NULL PRIMARY KEY COLLATE NOCASE, users INTEGER NOT NULL DEFAULT 0, aliases INTEGER NOT NULL DEFAULT 0)")
+
+	for table, column in (("users", "email"), ("aliases", "source")):
+		def domain_of(row):
+			return "substr({row}.{column}, instr({row}.{column}, '@') + 1)".format(row=row, column=column)
+		increment = """
+			INSERT OR IGNORE INTO domains (domain) VALUES ({domain});
+			UPDATE domains SET {count} = {count} + 1 WHERE domain = {domain};
+			""".format(domain=domain_of("NEW"), count=table)
+		decrement = """
+			UPDATE domains SET {count} = {count} - 1 WHERE domain = {domain};
+			DELETE FROM domains WHERE domain = {domain} AND users = 0 AND aliases = 0;
+			""".format(domain=domain_of("OLD"), count=table)
+		db.execute("CREATE TRIGGER IF NOT EXISTS domains_%s_insert AFTER INSERT ON %s BEGIN %s END" % (table, table, increment))
+		db.execute("CREATE TRIGGER IF NOT EXISTS domains_%s_delete AFTER DELETE ON %s BEGIN %s END" % (table, table, decrement))
+		db.execute("CREATE TRIGGER IF NOT EXISTS domains_%s_update AFTER UPDATE OF %s ON %s BEGIN %s %s END" % (table, column, table, decrement, increment))
+
+	# Backfill.
+	db.execute("DELETE FROM domains")
+	db.execute("""INSERT INTO domains (domain, users, aliases)
+		SELECT domain, SUM(users), SUM(aliases) FROM (
+			SELECT substr(email, instr(email, '@') + 1) AS domain, 1 AS users, 0 AS aliases FROM users
+			UNION ALL
+			SELECT substr(source, instr(source, '@') + 1) AS domain, 0 AS users, 1 AS aliases FROM aliases
+		) GROUP BY domain COLLATE NOCASE""")
+
+	db.commit()
+	db.close()
+
+	# Have Postfix use the new table. (setup/mail-users.sh writes this file
+	# again on every run of the setup scripts.)
+	fn = "/etc/postfix/virtual-mailbox-domains.cf"
+	if os.path.exists(fn):
+		with open(fn) as f:
+			conf = f.read()
+		conf = re.sub(r"query = .*", "query = SELECT 1 FROM domains WHERE domain='%s'", conf)
+		with open(fn, "w") as f:
+			f.write(conf)
+
+def migration_4(env):
+	# Add an indexed domain column to the users and aliases tables, filled in
+	# by triggers, so that the management daemon can list the addresses on a
+	# domain a page at a time, and a counter that triggers bump whenever the
+	# lists of users or aliases change. This is the same as what
+	# setup/mail-users.sh creates for new databases.
+	import sqlite3
+	db = sqlite3.connect(os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite"))
+
+	for table, column in (("users", "email"), ("aliases", "source")):
+		set_domain = "UPDATE {table} SET domain = substr(NEW.{column}, instr(NEW.{column}, '@') + 1) WHERE id = NEW.id;".format(table=table, column=column)
+		db.execute("ALTER TABLE %s ADD COLUMN domain TEXT COLLATE NOCASE" % table)
+		db.execute("UPDATE {table} SET domain = substr({column}, instr({column}, '@') + 1)".format(table=table, column=column))
+		db.execute("CREATE INDEX {table}_domain_{column} ON {table} (domain, {column})".format(table=table, column=column))
+		db.execute("CREATE TRIGGER %s_set_domain AFTER INSERT ON %s BEGIN %s END" % (table, table, set_domain))
+		db.execute("CREATE TRIGGER %s_update_domain AFTER UPDATE OF %s ON %s BEGIN %s END" % (table, column, table, set_domain))
+
+	db.execute("CREATE TABLE change_counter (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)")
+	db.execute("INSERT INTO change_counter (id, value) VALUES (1, 0)")
+	for table, columns in (("users", "email"), ("aliases", "source, destination")):
+		bump = "UPDATE change_counter SET value = value + 1;"
+		db.execute("CREATE TRIGGER change_counter_%s_insert AFTER INSERT ON %s BEGIN %s END" % (table, table, bump))
+		db.execute("CREATE TRIGGER change_counter_%s_delete AFTER DELETE ON %s BEGIN %s END" % (table, table, bump))
+		db.execute("CREATE TRIGGER change_counter_%s_update AFTER UPDATE OF %s ON %s BEGIN %s END" % (table, columns, table, bump))
+
+	db.commit()
+	db.close()
+
+def migration_5(env):
+	# Add the alias_expansions table, which holds the final addresses each
+	# alias delivers to, and the alias_destinations table, which indexes
+	# the addresses in each alias's destination, and have Postfix look up
+	# aliases in alias_expansions. This is the same as what
+	# setup/mail-users.sh creates for new databases. The aliases are
+	# expanded here rather than with the management daemon's code, which
+	# may change, the same way the daemon does it: an alias that loops, is
+	# nested too deeply or expands to too many addresses is stored as is.
+	import sqlite3
+	max_depth = 100
+	max_expansion = 1000
+
+	db = sqlite3.connect(os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite"))
+	aliases = { }
+	for source, destination in db.execute("SELECT source, destination FROM aliases"):
+		aliases[source] = [d.strip() for d in destination.split(",") if d.strip() != ""]
+
+	def expand(source, memo, path):
+		if source in memo: return memo[source]
+		if source in path or len(path) >= max_depth: raise ValueError()
+		expansion = set()
+		for d in aliases[source]:
+			if d == source or d not in aliases:
+				expansion.add(d)
+			else:
+				expansion |= expand(d, memo, path + (source,))
+			if len(expansion) > max_expansion: raise ValueError()
+		memo[source] = expansion
+		return expansion
+
+	memo = { }
+	expansions = []
+	destinations = []
+	for source in sorted(aliases):
+		try:
+			expansion = expand(source, memo, ())
+		except ValueError:
+			expansion = aliases[source]
+		expansions.extend((source, d) for d in sorted(set(expansion)))
+		destinations.extend((source, d) for d in sorted(set(aliases[source])))
+
+	db.execute("CREATE TABLE alias_expansions (source TEXT NOT NULL, destination TEXT NOT NULL, PRIMARY KEY (source, destination))")
+	db.execute("CREATE TABLE alias_destinations (source TEXT NOT NULL, destination TEXT NOT NULL, PRIMARY KEY (source, destination))")
+	db.execute("CREATE INDEX alias_destinations_destination ON alias_destinations (destination)")
+	db.executemany("INSERT INTO alias_expansions (source, destination) VALUES (?, ?)", expansions)
+	db.executemany("INSERT INTO alias_destinations (source, destination) VALUES (?, ?)", destinations)
+	db.commit()
+	db.close()
+
+	fn = "/etc/postfix/virtual-alias-maps.cf"
+	if os.path.exists(fn):
+		with open(fn) as f:
+			conf = f.read()
+		conf = re.sub(r"query = .*", "query = SELECT destination FROM alias_expansions WHERE source='%s'", conf)
+		with open(fn, "w") as f:
+			f.write(conf)
+
 def get_current_migration():
 	ver = 0
 	while True:
@@ -91,12 +91,8 @@ tools/editconf.py /usr/local/lib/roundcubemail/plugins/password/config.inc.php \
 # so PHP can use doveadm, for the password changing plugin
 usermod -a -G dovecot www-data
 
-# set permissions so that PHP can use users.sqlite
-# could use dovecot instead of www-data, but not sure it matters
-chown root.www-data $STORAGE_ROOT/mail
-chmod 775 $STORAGE_ROOT/mail
-chown root.www-data $STORAGE_ROOT/mail/users.sqlite 
-chmod 664 $STORAGE_ROOT/mail/users.sqlite 
+# PHP can use users.sqlite because www-data is in the userdb group that
+# owns it (see mail-users.sh).
 
 # Enable PHP modules.
 php5enmod mcrypt
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Measures how long it takes to generate the DNS configuration of a box with
+# many domains. For each size it makes a users.sqlite and a custom.yaml with
+# that many domains (a tenth of them with a subdomain, and about as many
+# custom records as domains) in a temporary STORAGE_ROOT, then times each
+# step of management/dns_update.py on them: get_dns_zones, build_zone,
+# write_nsd_zone, write_nsd_conf, write_opendkim_tables, and then all of
+# do_dns_update, once on fresh zone files and once again with nothing
+# changed.
+#
+# Nothing on this machine is touched. The zone files, nsd.conf and OpenDKIM's
+# tables go in the temporary directory too, and nothing is run: nsd-control,
+# ldns-signzone, openssl and service are replaced with stand-ins, and zones
+# are "signed" by copying them.
+#
+# Each size runs in its own process so that its peak memory use isn't
+# mixed up with another's. The results are printed and saved as JSON, and
+# can be compared with saved results from another version. This needs the
+# management daemon's Python packages (rtyaml). Run it from the mailinabox
+# directory:
+#
+# tests/benchmark_dns.py [-o results.json] [-c old-results.json] [size ...]
+#
+# The default sizes are 1000, 10000 and 100000 domains.
+
+import sys, os, os.path, re, json, time, datetime, platform, resource, sqlite3, shutil, subprocess, tempfile
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+mailinabox_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def get_version():
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+			cwd=mailinabox_dir, stderr=subprocess.DEVNULL).decode("ascii").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+def get_users_schema():
+	# The SQL that setup/mail-users.sh uses to make a new users.sqlite, so
+	# that the benchmark's database has the same tables and triggers.
+	with open(os.path.join(mailinabox_dir, "setup/mail-users.sh")) as f:
+		script = f.read()
+	script = script[script.index("if [ ! -f $db_path ]; then"):]
+	script = script[:script.index("\nfi\n")]
+	sql = re.findall(r'echo "(CREATE [^"]*)" \| sqlite3', script)
+	sql += re.findall(r"sqlite3 \$db_path << EOF;\n(.*?)\nEOF\n", script, re.S)
+	return "\n".join(sql)
+
+########################################################################
+
+def make_box(storage_root, n):
+	# Make a STORAGE_ROOT with n domains. Returns the env and how many
+	# subdomains and custom records it has.
+	import rtyaml
+
+	os.makedirs(os.path.join(storage_root, "mail/dkim"))
+	os.makedirs(os.path.join(storage_root, "dns"))
+
+	domains = ["domain%d.com" % i for i in range(n)]
+	subdomains = ["lists." + domain for domain in domains[::10]]
+
+	conn = sqlite3.connect(os.path.join(storage_root, "mail/users.sqlite"))
+	conn.executescript(get_users_schema())
+	conn.executemany("INSERT INTO users (email, password) VALUES (?, '{SHA512-CRYPT}x')",
+		(("user@" + domain,) for domain in domains + subdomains))
+	conn.executemany("INSERT INTO aliases (source, destination) VALUES (?, ?)",
+		(("postmaster@" + domain, "user@" + domain) for domain in domains))
+	conn.commit()
+	conn.close()
+
+	# Custom records: a different address for every domain's www, and a
+	# TXT record and an MX record on some.
+	custom = { }
+	for i, domain in enumerate(domains):
+		custom["www." + domain] = "192.0.2.%d" % (i % 250 + 1)
+		if i % 5 == 0:
+			custom["_dmarc." + domain] = { "TXT": "v=DMARC1; p=quarantine" }
+		if i % 20 == 0:
+			custom["backup." + domain] = { "A": "198.51.100.1", "MX": "20 mx.example.net." }
+	custom_records = sum(1 if isinstance(value, str) else len(value) for value in custom.values())
+	with open(os.path.join(storage_root, "dns/custom.yaml"), "w") as f:
+		f.write(rtyaml.dump(custom))
+
+	# OpenDKIM's key and record, so that the DKIM record and tables are made.
+	with open(os.path.join(storage_root, "mail/dkim/mail.private"), "w") as f:
+		f.write("not a real key\n")
+	with open(os.path.join(storage_root, "mail/dkim/mail.txt"), "w") as f:
+		f.write('mail._domainkey\tIN\tTXT\t( "v=DKIM1; k=rsa; "\n\t  "p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC" )  ; ----- DKIM key mail\n')
+
+	env = {
+		"STORAGE_ROOT": storage_root,
+		"PRIMARY_HOSTNAME": "box." + domains[0],
+		"PUBLIC_IP": "192.0.2.1",
+		"PUBLIC_IPV6": "2001:db8::1",
+	}
+	return env, len(subdomains), custom_records
+
+def snapshot(path):
+	files = { }
+	for root, dirs, filenames in os.walk(path):
+		for fn in filenames:
+			fn = os.path.join(root, fn)
+			st = os.stat(fn)
+			files[fn] = (st.st_mtime_ns, st.st_size)
+	return files
+
+def sign_zone(domain, zonefile, records, serial, env, renew_before=None):
+	# The stand-in for dns_update.sign_zone: "signs" a zone by copying it.
+	import dns_update, dnssec_schedule
+	zonefile = os.path.join(dns_update.ZONES_DIR, zonefile)
+	shutil.copyfile(zonefile, zonefile + ".signed")
+	now = datetime.datetime.utcnow()
+	return (dnssec_schedule.format_time(now), dnssec_schedule.format_time(now + datetime.timedelta(days=30)))
+
+def run_benchmark(n):
+	# Run the steps on a box with n domains in this process. Returns the
+	# results for this size.
+	sys.path.insert(0, os.path.join(mailinabox_dir, "management"))
+	import dns_update, dnssec_schedule, service_reload
+
+	tmpdir = tempfile.mkdtemp(prefix="mailinabox-benchmark-")
+	try:
+		env, subdomain_count, custom_record_count = make_box(os.path.join(tmpdir, "storage"), n)
+
+		# Keep everything dns_update.py writes in the temporary directory.
+		zones_dir = os.path.join(tmpdir, "zones")
+		os.makedirs(zones_dir)
+		os.makedirs(os.path.join(tmpdir, "opendkim"))
+		dns_update.ZONES_DIR = zones_dir
+		dns_update.NSD_CONF = os.path.join(tmpdir, "nsd.conf")
+		open(dns_update.NSD_CONF, "w").close()
+		dns_update.OPENDKIM_DIR = os.path.join(tmpdir, "opendkim")
+		dns_update.ZONE_STATE_FILE = os.path.join(tmpdir, "dns-zones.json")
+		dnssec_schedule.SIGNING_STATE_DB = os.path.join(tmpdir, "dnssec-signing.sqlite")
+
+		# Stand-ins for the programs it would run.
+		def shell(method, cmd_args, *args, **kwargs):
+			if cmd_args[0] == "/bin/hostname": return "192.0.2.1\n"
+			return 0 if method == "check_call" else ""
+		dns_update.shell = shell
+		service_reload.shell = shell
+		dns_update.update_nsd_zones = lambda zones, changed_zones, restart=False : []
+		dns_update.build_tlsa_record = lambda env : "3 0 1 " + "0" * 64
+		dns_update.sign_zone = sign_zone
+		dns_update.SIGNING_PROCESSES = 0 # so that the stand-in is used
+
+		stages = []
+		def stage(name, func):
+			before = snapshot(tmpdir)
+			start = time.perf_counter()
+			ret = func()
+			seconds = time.perf_counter() - start
+			after = snapshot(tmpdir)
+			stages.append({
+				"stage": name,
+				"seconds": round(seconds, 4),
+				"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+				"files_written": sum(1 for fn, st in after.items() if before.get(fn) != st),
+			})
+			print("  %-28s %9.3fs %9d KB %7d files" % (name, seconds, stages[-1]["max_rss_kb"], stages[-1]["files_written"]), file=sys.stderr)
+			return ret
+
+		# The steps of do_dns_update, one at a time.
+		zonefiles = stage("get_dns_zones", lambda : dns_update.get_dns_zones(env))
+		def build_zones():
+			import rtyaml
+			from utils import DomainTrie
+			with open(os.path.join(env["STORAGE_ROOT"], "dns/custom.yaml")) as f:
+				additional_records = rtyaml.load(f)
+			domain_trie = DomainTrie(dns_update.get_dns_domains(env))
+			zone_trie = DomainTrie(zone[0] for zone in zonefiles)
+			zone_custom_records = { }
+			for qname, value in additional_records.items():
+				zone = zone_trie.find_parent(qname)
+				if zone is not None:
+					zone_custom_records.setdefault(zone, { })[qname] = value
+			return [(domain, zonefile, dns_update.build_zone(domain, sorted(domain_trie.subtree(domain)), zone_custom_records.get(domain, { }), env))
+				for domain, zonefile in zonefiles]
+		zones = stage("build_zone", build_zones)
+		stage("write_nsd_zone", lambda : [dns_update.write_nsd_zone(domain, os.path.join(zones_dir, zonefile), records, env, False)
+			for domain, zonefile, records in zones])
+		reloads = service_reload.ServiceReloads()
+		stage("write_nsd_conf", lambda : dns_update.write_nsd_conf(reloads))
+		stage("write_opendkim_tables", lambda : dns_update.write_opendkim_tables(zonefiles, env, reloads))
+		reloads.run()
+
+		# And all together.
+		stage("do_dns_update (first)", lambda : dns_update.do_dns_update(env))
+		stage("do_dns_update (unchanged)", lambda : dns_update.do_dns_update(env))
+
+		return {
+			"domains": n,
+			"zones": len(zonefiles),
+			"subdomains": subdomain_count,
+			"custom_records": custom_record_count,
+			"stages": stages,
+		}
+	finally:
+		shutil.rmtree(tmpdir)
+
+########################################################################
+
+def compare(results, old_results):
+	print()
+	print("Compared with %s (%s):" % (old_results["version"], old_results["date"]))
+	old = { (r["domains"], s["stage"]): s for r in old_results["results"] for s in r["stages"] }
+	for r in results["results"]:
+		for s in r["stages"]:
+			o = old.get((r["domains"], s["stage"]))
+			if o is None: continue
+			print("  %7d %-28s %9.3fs -> %9.3fs (%+.0f%%)   %9d KB -> %9d KB" % (
+				r["domains"], s["stage"], o["seconds"], s["seconds"],
+				(s["seconds"] / o["seconds"] - 1) * 100 if o["seconds"] else 0,
+				o["max_rss_kb"], s["max_rss_kb"]))
+
+def main(args):
+	output = None
+	compare_with = None
+	sizes = []
+	while args:
+		arg = args.pop(0)
+		if arg in ("-o", "--output"):
+			output = args.pop(0)
+		elif arg in ("-c", "--compare"):
+			compare_with = args.pop(0)
+		elif arg == "--run-one":
+			# Run one size in this process and write the result to a file
+			# for the parent process.
+			n, result_file = int(args.pop(0)), args.pop(0)
+			with open(result_file, "w") as f:
+				json.dump(run_benchmark(n), f)
+			return
+		else:
+			sizes.append(int(arg))
+	sizes = sizes or DEFAULT_SIZES
+
+	version = get_version()
+	results = {
+		"version": version,
+		"date": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"cpus": os.cpu_count(),
+		"results": [],
+	}
+	for n in sizes:
+		print("%d domains:" % n, file=sys.stderr)
+		with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+			subprocess.check_call([sys.executable, os.path.abspath(__file__), "--run-one", str(n), result_file.name])
+			with open(result_file.name) as f:
+				results["results"].append(json.load(f))
+
+	output = output or "dns-benchmark-%s.json" % version
+	with open(output, "w") as f:
+		json.dump(results, f, indent=2)
+	print("Saved the results to %s." % output)
+
+	if compare_with:
+		with open(compare_with) as f:
+			compare(results, json.load(f))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Checks that management/mailconfig.py reads CSV and JSON batches of mail
+# users for /mail/users/bulk, and that a batch it can't read raises the
+# errors the daemon turns into a 400. This doesn't need a Mail-in-a-Box.
+# Run it from the mailinabox directory:
+#
+# tests/test_bulk_users.py
+
+import sys, os, io, csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../management"))
+from mailconfig import read_bulk_users
+
+failed = 0
+def test(description, batch, format, expected):
+	global failed
+	try:
+		rows = list(read_bulk_users(io.StringIO(batch), format))
+	except Exception as e:
+		rows = e
+	if isinstance(rows, Exception) and isinstance(expected, type):
+		ok = isinstance(rows, expected) # e.g. JSONDecodeError is a ValueError
+	else:
+		ok = (rows == expected)
+	if not ok:
+		print("FAILED:", description)
+		print("  got:", rows)
+		print("  expected:", expected)
+		failed += 1
+	else:
+		print("ok:", description)
+
+test("CSV rows",
+	"alice@example.com,secret1\nbob@example.com,secret2\n", "csv",
+	[(1, "alice@example.com", "secret1"), (2, "bob@example.com", "secret2")])
+
+test("CSV header row and blank lines are skipped",
+	"Email,Password\n\nalice@example.com,secret1\n", "csv",
+	[(3, "alice@example.com", "secret1")])
+
+test("CSV addresses are stripped, passwords are not",
+	" alice@example.com , secret1 \n", "csv",
+	[(1, "alice@example.com", " secret1 ")])
+
+test("CSV quoted passwords can have commas",
+	'alice@example.com,"a,b"\n', "csv",
+	[(1, "alice@example.com", "a,b")])
+
+test("CSV rows without two columns are reported by row number",
+	"alice@example.com\nbob@example.com,secret2,extra\ncarol@example.com,secret3\n", "csv",
+	[(1, None, None), (2, None, None), (3, "carol@example.com", "secret3")])
+
+test("CSV that can't be parsed raises csv.Error",
+	"alice@example.com," + "x" * (csv.field_size_limit() + 1) + "\n", "csv",
+	csv.Error)
+
+test("JSON list of objects",
+	'[{"email": "alice@example.com", "password": "secret1"}, {"email": "bob@example.com"}]', "json",
+	[(1, "alice@example.com", "secret1"), (2, "bob@example.com", None)])
+
+test("JSON items that aren't objects are reported by row number",
+	'[["alice@example.com", "secret1"], 5]', "json",
+	[(1, None, None), (2, None, None)])
+
+test("JSON that isn't a list raises ValueError",
+	'{"email": "alice@example.com", "password": "secret1"}', "json",
+	ValueError)
+
+test("JSON that isn't a list or an object raises ValueError",
+	'5', "json",
+	ValueError)
+
+test("invalid JSON raises ValueError",
+	'[{"email": ', "json",
+	ValueError)
+
+test("unknown formats raise ValueError",
+	"", "xml",
+	ValueError)
+
+if failed:
+	sys.exit(1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Checks that management/dns_service.py adds, removes and reloads zones one
+# at a time and only restarts nsd when it has to, using tests/fake-nsd-control
+# in place of nsd. This doesn't need a Mail-in-a-Box. Run it from the
+# mailinabox directory:
+#
+# tests/test_dns_service.py
+
+import sys, os, json, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../management"))
+import dns_service
+
+tmpdir = tempfile.mkdtemp()
+dns_service.NSD_CONTROL = os.path.abspath(os.path.join(os.path.dirname(__file__), "fake-nsd-control"))
+dns_service.NSD_CONF = os.path.join(tmpdir, "nsd.conf")
+dns_service.NSD_RESTART = ["/bin/rm", "-f", dns_service.NSD_CONF + ".fake-down"] # "starting" the fake nsd
+
+def fake_state():
+	with open(dns_service.NSD_CONF + ".fake-state") as f:
+		state = json.load(f)
+	with open(dns_service.NSD_CONF + ".fake-state", "w") as f:
+		json.dump({ "zones": state["zones"], "log": [] }, f)
+	return state
+
+failed = 0
+def test(description, actions, expected_actions, expected_zones):
+	global failed
+	state = fake_state()
+	if actions != expected_actions or sorted(state["zones"]) != sorted(expected_zones):
+		print("FAILED:", description)
+		print("  actions:", actions, "expected", expected_actions)
+		print("  zones:", sorted(state["zones"]), "expected", sorted(expected_zones))
+		failed += 1
+	elif any(command[0] == "reload" and len(command) == 1 for command in state["log"]):
+		print("FAILED:", description, "reloaded every zone")
+		failed += 1
+	else:
+		print("ok:", description)
+
+# nsd isn't running at first, so it's started and the zones are added.
+open(dns_service.NSD_CONF + ".fake-down", "w").close()
+test("first update starts nsd and adds zones",
+	dns_service.update_nsd_zones(["a.com", "b.com"], ["a.com", "b.com"]),
+	["restarted nsd", "added a.com", "added b.com"],
+	["a.com", "b.com"])
+
+test("a changed zone is reloaded by itself",
+	dns_service.update_nsd_zones(["a.com", "b.com"], ["b.com"]),
+	["reloaded b.com"],
+	["a.com", "b.com"])
+
+test("a new zone is added without reloading the others",
+	dns_service.update_nsd_zones(["a.com", "b.com", "c.com"], ["c.com"]),
+	["added c.com"],
+	["a.com", "b.com", "c.com"])
+
+test("a removed zone is deleted",
+	dns_service.update_nsd_zones(["a.com", "c.com"], []),
+	["removed b.com"],
+	["a.com", "c.com"])
+
+test("nothing changed, nothing done",
+	dns_service.update_nsd_zones(["a.com", "c.com"], []),
+	[],
+	["a.com", "c.com"])
+
+test("a new nsd.conf restarts nsd instead of reloading zones",
+	dns_service.update_nsd_zones(["a.com", "c.com"], ["a.com"], restart=True),
+	["restarted nsd"],
+	["a.com", "c.com"])
+
+# nsd is running but refuses a command. That's not fixed by restarting it.
+open(dns_service.NSD_CONF + ".fake-refuse", "w").close()
+dns_service.NSD_RESTART = ["/usr/bin/touch", dns_service.NSD_CONF + ".fake-restarted"]
+try:
+	actions = dns_service.update_nsd_zones(["a.com", "c.com", "d.com"], ["d.com"])
+except Exception as e:
+	actions = type(e).__name__
+if os.path.exists(dns_service.NSD_CONF + ".fake-restarted"):
+	actions = "restarted nsd"
+test("a refused command is raised without restarting nsd",
+	actions,
+	"CalledProcessError",
+	["a.com", "c.com"])
+
+if failed:
+	sys.exit(1)
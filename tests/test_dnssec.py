@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Signs a sample zone with management/dnssec.py using throwaway keys and
+# checks the result with dnspython: that every RRset has an RRSIG that
+# validates against the zone's DNSKEYs, that the NSEC3 records form a
+# complete chain over every name in the zone with the right types, and
+# that the DS record matches the KSK. This doesn't need a Mail-in-a-Box,
+# but it needs dnspython (python3-dnspython). Run it from the mailinabox
+# directory:
+#
+# tests/test_dnssec.py
+
+import sys, os, base64, hashlib, random, tempfile, struct, shutil, subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../management"))
+import dnssec
+
+import dns.name, dns.zone, dns.dnssec, dns.rdatatype, dns.rdataclass, dns.rrset
+
+failed = 0
+def test(description, ok, detail=None):
+	global failed
+	if not ok:
+		print("FAILED:", description)
+		if detail: print("  ", detail)
+		failed += 1
+	else:
+		print("ok:", description)
+
+# Make RSA keys in the BIND format that ldns-keygen writes, small ones so
+# that this is quick.
+
+def is_probable_prime(n):
+	for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+		if n % p == 0: return n == p
+	d, r = n - 1, 0
+	while d % 2 == 0:
+		d //= 2
+		r += 1
+	for i in range(20):
+		x = pow(random.randrange(2, n - 1), d, n)
+		if x in (1, n - 1): continue
+		for j in range(r - 1):
+			x = pow(x, 2, n)
+			if x == n - 1: break
+		else:
+			return False
+	return True
+
+def random_prime(bits, e):
+	while True:
+		n = random.getrandbits(bits) | (3 << (bits - 2)) | 1
+		if is_probable_prime(n) and (n - 1) % e != 0:
+			return n
+
+def modinv(a, m):
+	g, x, y = m, 0, 1
+	while a:
+		q = g // a
+		g, a = a, g - q * a
+		x, y = y, x - q * y
+	return x % m
+
+def b64(n):
+	return base64.b64encode(n.to_bytes((n.bit_length() + 7) // 8, "big")).decode("ascii")
+
+def make_key(dir, name, flags, algorithm, bits=1024):
+	e = 65537
+	p, q = random_prime(bits // 2, e), random_prime(bits // 2, e)
+	n, d = p * q, modinv(e, (p - 1) * (q - 1))
+	public_key = bytes([3]) + e.to_bytes(3, "big") + n.to_bytes((n.bit_length() + 7) // 8, "big")
+	key_tag = dnssec.get_key_tag(struct.pack("!HBB", flags, 3, algorithm) + public_key)
+	with open(os.path.join(dir, name + ".key"), "w") as f:
+		f.write("_domain_.\tIN\tDNSKEY\t%d 3 %d %s ;{id = %d (%s), size = %db}\n"
+			% (flags, algorithm, base64.b64encode(public_key).decode("ascii"), key_tag, "ksk" if flags & 1 else "zsk", bits))
+	with open(os.path.join(dir, name + ".private"), "w") as f:
+		f.write("Private-key-format: v1.2\nAlgorithm: %d\n" % algorithm)
+		for field, value in (("Modulus", n), ("PublicExponent", e), ("PrivateExponent", d), ("Prime1", p), ("Prime2", q),
+			("Exponent1", d % (p - 1)), ("Exponent2", d % (q - 1)), ("Coefficient", modinv(q, p))):
+			f.write("%s: %s\n" % (field, b64(value)))
+
+# A zone with most of the record types we write, names more than one
+# label below the zone with nothing at the names in between (empty
+# non-terminals), and a wildcard.
+RECORDS = [
+	(None, "SOA", "ns1.box.example.com. hostmaster.box.example.com. 2026101600 28800 7200 864000 86400"),
+	(None, "NS", "ns1.box.example.com."),
+	(None, "NS", "ns2.box.example.com."),
+	(None, "A", "192.0.2.1"),
+	(None, "AAAA", "2001:db8::1"),
+	(None, "MX", "10 box.example.com."),
+	(None, "TXT", '"v=spf1 mx -all"'),
+	(None, "CAA", '0 issue "letsencrypt.org"'),
+	("mail._domainkey", "TXT", '( "v=DKIM1; k=rsa; " "p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC" )'),
+	("_dmarc", "TXT", '"v=DMARC1; p=quarantine"'),
+	("_25._tcp.mail", "TLSA", "3 0 1 " + "ab" * 32),
+	("_imaps._tcp", "SRV", "0 1 993 box.example.com."),
+	("box", "SSHFP", "1 2 " + "cd" * 32),
+	("www", "CNAME", "example.com."),
+	("*.wild", "A", "192.0.2.2"),
+]
+
+def sign(env, zonefile, records):
+	dnssec._keys.clear()
+	dnssec.sign_zone("example.com", records, zonefile, env)
+	with open(zonefile + ".signed") as f:
+		return dns.zone.from_text(f.read(), origin="example.com.", relativize=False, check_origin=False)
+
+def check_zone(zone, zonefile, algorithm):
+	origin = dns.name.from_text("example.com.")
+	dnskeys = zone.find_rrset(origin, "DNSKEY")
+	keys = { origin: dnskeys }
+
+	# Every RRset has an RRSIG by each key that should sign it, and they validate.
+	bad = []
+	count = 0
+	for name, node in zone.nodes.items():
+		for rdataset in node.rdatasets:
+			if rdataset.rdtype == dns.rdatatype.RRSIG: continue
+			rrset = dns.rrset.RRset(name, rdataset.rdclass, rdataset.rdtype)
+			rrset.update(rdataset)
+			sigs = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.RRSIG, rdataset.rdtype)
+			expected_sigs = 2 if rdataset.rdtype == dns.rdatatype.DNSKEY else 1
+			if sigs is None or len(sigs) != expected_sigs:
+				bad.append("%s %s has %d RRSIGs" % (name, dns.rdatatype.to_text(rdataset.rdtype), 0 if sigs is None else len(sigs)))
+				continue
+			for sig in sigs:
+				sigset = dns.rrset.RRset(name, dns.rdataclass.IN, dns.rdatatype.RRSIG, rdataset.rdtype)
+				sigset.add(sig)
+				try:
+					dns.dnssec.validate(rrset, sigset, keys)
+					count += 1
+				except Exception as e:
+					bad.append("%s %s: %s" % (name, dns.rdatatype.to_text(rdataset.rdtype), e))
+	test("algorithm %d: all %d RRSIGs validate" % (algorithm, count), count > 0 and not bad, "; ".join(bad))
+
+	# There's an NSEC3 record at the hash of every name in the zone and
+	# at no other hash, including the names between the zone and deeper
+	# names, and they link up in order of hash.
+	nsec3s = { }
+	names = set()
+	for name, node in zone.nodes.items():
+		rdataset = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.NSEC3)
+		if rdataset is not None:
+			nsec3s[name.labels[0].decode("ascii").lower()] = rdataset[0]
+			continue
+		while name != origin:
+			names.add(name)
+			name = name.parent()
+	names.add(origin)
+	base32hex = bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", b"0123456789abcdefghijklmnopqrstuv")
+	def nsec3_hash(name):
+		return base64.b32encode(hashlib.sha1(name.to_digestable()).digest()).translate(base32hex).decode("ascii")
+	hashes = { nsec3_hash(name): name for name in names }
+	test("algorithm %d: an NSEC3 record for each of the %d names" % (algorithm, len(hashes)),
+		set(hashes) == set(nsec3s), sorted(str(hashes.get(h, h)) for h in set(hashes) ^ set(nsec3s)))
+
+	order = sorted(nsec3s)
+	bad = []
+	for i, h in enumerate(order):
+		fields = nsec3s[h].to_text().split()
+		next_hash = fields[4].lower()
+		if next_hash != order[(i + 1) % len(order)]:
+			bad.append("%s points to %s" % (h, next_hash))
+		if h not in hashes: continue
+		node = zone.get_node(hashes[h])
+		types = set(dns.rdatatype.to_text(rdataset.rdtype) for rdataset in node.rdatasets) if node is not None else set()
+		if types - { "RRSIG" }: types.add("RRSIG")
+		if set(fields[5:]) != types:
+			bad.append("%s has types %s, not %s" % (hashes[h], " ".join(sorted(fields[5:])), " ".join(sorted(types))))
+	test("algorithm %d: the NSEC3 chain is in order with the right types" % algorithm, not bad, "; ".join(bad))
+
+	# The DS record is for the KSK.
+	ksk = [dnskey for dnskey in dnskeys if dnskey.flags == 257][0]
+	ds = dns.dnssec.make_ds(origin, ksk, "SHA256")
+	with open(zonefile + ".ds") as f:
+		ds_record = f.read().split()
+	test("algorithm %d: the DS record matches the KSK" % algorithm,
+		ds_record[0] == "example.com." and ds_record[3] == "DS"
+			and " ".join(ds_record[4:]).upper() == ds.to_text().upper(),
+		" ".join(ds_record))
+
+for algorithm in (7, 8):
+	tmpdir = tempfile.mkdtemp()
+	keydir = os.path.join(tmpdir, "dns/dnssec")
+	os.makedirs(keydir)
+	make_key(keydir, "K_domain_.+%03d+00001" % algorithm, 257, algorithm)
+	make_key(keydir, "K_domain_.+%03d+00002" % algorithm, 256, algorithm)
+	with open(os.path.join(keydir, "keys.conf"), "w") as f:
+		f.write("KSK=K_domain_.+%03d+00001\nZSK=K_domain_.+%03d+00002\n" % (algorithm, algorithm))
+	env = { "STORAGE_ROOT": tmpdir }
+	zonefile = os.path.join(tmpdir, "example.com.txt")
+
+	zone = sign(env, zonefile, RECORDS)
+	check_zone(zone, zonefile, algorithm)
+
+	# Sign it again with a record changed and a name added. The saved
+	# signatures of the RRsets that didn't change are used again.
+	records = [r if r[1] != "A" or r[0] is not None else (None, "A", "192.0.2.3") for r in RECORDS]
+	records.append(("new.deep", "A", "192.0.2.4"))
+	zone2 = sign(env, zonefile, records)
+	check_zone(zone2, zonefile, algorithm)
+	origin = dns.name.from_text("example.com.")
+	def sig(zone, rtype):
+		return zone.find_rdataset(origin, "RRSIG", rtype)[0].signature
+	test("algorithm %d: unchanged RRsets keep their signatures" % algorithm,
+		sig(zone, "MX") == sig(zone2, "MX") and sig(zone, "A") != sig(zone2, "A"))
+
+# A key whose CRT values are wrong makes signatures that don't verify,
+# and that would give away the private key, so they aren't used.
+with open(os.path.join(keydir, "K_domain_.+008+00002.private")) as f:
+	private = f.read()
+with open(os.path.join(keydir, "K_domain_.+008+00002.private"), "w") as f:
+	f.write("".join(line if not line.startswith("Coefficient:") else "Coefficient: " + b64(12345) + "\n" for line in private.splitlines(True)))
+try:
+	sign(env, zonefile, RECORDS)
+	result = "signed"
+except ValueError as e:
+	result = str(e)
+test("a bad private key raises an error instead of signing", "didn't verify" in result, result)
+
+# Keys made by ldns-keygen itself load, if it's installed.
+if shutil.which("ldns-keygen"):
+	keydir = tempfile.mkdtemp()
+	for args in (["-k"], []):
+		fn = subprocess.check_output(["ldns-keygen", "-a", "RSASHA1-NSEC3-SHA1", "-b", "1024"] + args + ["-r", "/dev/urandom", "_domain_"],
+			cwd=keydir).decode("ascii").strip()
+		try:
+			key = dnssec.SigningKey(os.path.join(keydir, fn))
+			result = "%d %d" % (key.flags, key.key_tag)
+		except Exception as e:
+			result = repr(e)
+		test("an ldns-keygen key loads", result == "%d %d" % (257 if args else 256, int(fn.split("+")[-1])), result)
+
+if failed:
+	sys.exit(1)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Benchmarks the management daemon's in-process password hashing against
+# `doveadm pw` and checks that Dovecot accepts the hashes it makes. Run this
+# on a Mail-in-a-Box from the mailinabox directory:
+#
+# tests/test_password_hash.py [count]
+
+import sys, os, time, uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../management"))
+from password_hash import hash_password, hash_passwords, hash_password_doveadm, verify_password_doveadm
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+passwords = [uuid.uuid4().hex for i in range(count)]
+
+def bench(description, func):
+	start = time.time()
+	hashes = func()
+	elapsed = time.time() - start
+	print(description.ljust(32), "%6.2f sec" % elapsed, "%8.1f hashes/sec" % (count / elapsed), sep='\t')
+	return hashes
+
+print("Hashing %d passwords on %d cores..." % (count, os.cpu_count()))
+print()
+bench("doveadm pw", lambda : [hash_password_doveadm(pw) for pw in passwords])
+bench("in-process", lambda : [hash_password(pw) for pw in passwords])
+hashes = bench("in-process (worker pool)", lambda : hash_passwords(passwords))
+print()
+
+# Check that Dovecot can verify what we made, and that it rejects the
+# wrong password.
+failed = 0
+for pw, pw_hash in list(zip(passwords, hashes))[0:10]:
+	if not pw_hash.startswith("{SHA512-CRYPT}$6$"):
+		print("Hash is not in the SHA512-CRYPT format:", pw_hash)
+		failed += 1
+	elif not verify_password_doveadm(pw_hash, pw):
+		print("Dovecot did not verify the hash", pw_hash)
+		failed += 1
+	elif verify_password_doveadm(pw_hash, pw + "x"):
+		print("Dovecot verified the hash", pw_hash, "with the wrong password")
+		failed += 1
+
+if failed:
+	sys.exit(1)
+print("Dovecot verifies the hashes.")
@@ -1,13 +1,17 @@
 #!/usr/bin/python3
 
-import sys, getpass, urllib.request, urllib.error
+import sys, os, getpass, urllib.request, urllib.error
 
-def mgmt(cmd, data=None):
+def mgmt(cmd, data=None, content_type=None):
 	mgmt_uri = 'http://localhost:10222'
 
 	setup_key_auth(mgmt_uri)
 
-	req = urllib.request.Request(mgmt_uri + cmd, urllib.parse.urlencode(data).encode("utf8") if data else None)
+	if content_type is not None:
+		# Send the data as the raw request body.
+		req = urllib.request.Request(mgmt_uri + cmd, data, { "Content-Type": content_type })
+	else:
+		req = urllib.request.Request(mgmt_uri + cmd, urllib.parse.urlencode(data).encode("utf8") if data else None)
 	try:
 		response = urllib.request.urlopen(req)
 	except urllib.error.HTTPError as e:
@@ -15,6 +19,37 @@ def mgmt(cmd, data=None):
 		sys.exit(1)
 	return response.read().decode('utf8')
 
+def mgmt_list(cmd):
+	# Listings are cached along with the ETag the server sent with them.
+	# If nothing has changed since, the server answers with a 304 (Not
+	# Modified) and we use the cached copy rather than getting it all again.
+	mgmt_uri = 'http://localhost:10222'
+
+	setup_key_auth(mgmt_uri)
+
+	cache_fn = os.path.join(os.path.expanduser("~/.cache/mailinabox"), urllib.parse.quote(cmd, safe=''))
+	req = urllib.request.Request(mgmt_uri + cmd)
+	etag, body = None, None
+	if os.path.exists(cache_fn):
+		with open(cache_fn) as f:
+			etag, body = f.read().split("\n", 1)
+		req.add_header("If-None-Match", etag)
+
+	try:
+		response = urllib.request.urlopen(req)
+	except urllib.error.HTTPError as e:
+		if e.code == 304 and body is not None:
+			return body
+		print(e.read().decode('utf8'))
+		sys.exit(1)
+
+	body = response.read().decode('utf8')
+	if response.headers.get("ETag"):
+		os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+		with open(cache_fn, "w") as f:
+			f.write(response.headers["ETag"] + "\n" + body)
+	return body
+
 def read_password():
 	first  = getpass.getpass('password: ')
 	second = getpass.getpass(' (again): ')
@@ -42,15 +77,21 @@ if len(sys.argv) < 2:
 	print("  tools/mail.py user add user@domain.com [password]")
 	print("  tools/mail.py user password user@domain.com [password]")
 	print("  tools/mail.py user remove user@domain.com")
+	print("  tools/mail.py user import users.csv  (or users.json)")
+	print("  tools/mail.py user usage  (lists mailbox sizes, largest first)")
+	print("  tools/mail.py user quota user@domain.com [bytes]  (no bytes removes the quota)")
 	print("  tools/mail.py alias  (lists aliases)")
 	print("  tools/mail.py alias add incoming.name@domain.com sent.to@other.domain.com")
 	print("  tools/mail.py alias remove incoming.name@domain.com")
 	print()
 	print("Removing a mail user does not delete their mail folders on disk. It only prevents IMAP/SMTP login.")
 	print()
+	print("An import file is either CSV with one 'email,password' row per user or")
+	print("JSON with a list of {\"email\": ..., \"password\": ...} objects.")
+	print()
 
 elif sys.argv[1] == "user" and len(sys.argv) == 2:
-	print(mgmt("/mail/users"))
+	print(mgmt_list("/mail/users"))
 
 elif sys.argv[1] == "user" and sys.argv[2] in ("add", "password"):
 	if len(sys.argv) < 5:
@@ -67,11 +108,22 @@ elif sys.argv[1] == "user" and sys.argv[2] in ("add", "password"):
 	elif sys.argv[2] == "password":
 		print(mgmt("/mail/users/password", { "email": email, "password": pw }))
 
+elif sys.argv[1] == "user" and sys.argv[2] == "import" and len(sys.argv) == 4:
+	with open(sys.argv[3], 'rb') as f:
+		content_type = "application/json" if sys.argv[3].endswith(".json") else "text/csv"
+		print(mgmt("/mail/users/bulk", f.read(), content_type=content_type))
+
+elif sys.argv[1] == "user" and sys.argv[2] == "usage" and len(sys.argv) == 3:
+	print(mgmt("/mail/users/usage"))
+
+elif sys.argv[1] == "user" and sys.argv[2] == "quota" and len(sys.argv) in (4, 5):
+	print(mgmt("/mail/users/quota", { "email": sys.argv[3], "quota": sys.argv[4] if len(sys.argv) == 5 else "" }))
+
 elif sys.argv[1] == "user" and sys.argv[2] == "remove" and len(sys.argv) == 4:
 	print(mgmt("/mail/users/remove", { "email": sys.argv[3] }))
 
 elif sys.argv[1] == "alias" and len(sys.argv) == 2:
-	print(mgmt("/mail/aliases"))
+	print(mgmt_list("/mail/aliases"))
 
 elif sys.argv[1] == "alias" and sys.argv[2] == "add" and len(sys.argv) == 5:
 	print(mgmt("/mail/aliases/add", { "source": sys.argv[3], "destination": sys.argv[4] }))